@@ -1,15 +1,19 @@
 from base64 import b64encode, b64decode
+from contextlib import ExitStack, closing
 from datetime import datetime, timezone, timedelta
-from typing import Any, Union, Tuple, Optional, Dict, List
-import pickle
+from typing import Any, Callable, Iterator, Union, Tuple, Optional, Dict
 from hashlib import pbkdf2_hmac
 import os
-from itertools import groupby
 import secrets
+import shutil
+from tempfile import TemporaryFile
+from zipfile import BadZipFile, ZipFile
 
-import pika  # type: ignore
-from flask import Flask, abort, request, Response, make_response, send_file
+from flask import (
+    Flask, abort, request, Response, make_response,
+    stream_with_context)
 from zstandard import ZstdCompressor, ZstdDecompressor  # type: ignore
+from werkzeug.wsgi import wrap_file
 from openapi_core import create_spec  # type: ignore
 from openapi_core.shortcuts import RequestValidator  # type: ignore
 from openapi_core.contrib.flask import FlaskOpenAPIRequest  # type: ignore
@@ -17,18 +21,37 @@ import yaml
 from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
 
+from penguin_judge.autoscale import desired_workers
+from penguin_judge.cache import TTLCache, listen, notify
+from penguin_judge.dataset import (
+    content_size, import_tests, iter_archive, iter_decompressed,
+    open_test_data)
+from penguin_judge.job import encode_job, make_job
 from penguin_judge.models import (
     transaction, scoped_session, Contest, Environment, JudgeResult,
     JudgeStatus, Problem, Submission, TestCase, Token, User, Worker)
-from penguin_judge.mq import get_mq_conn_params
-from penguin_judge.utils import json_dumps, pagination_header
+from penguin_judge.mq import (
+    PRIORITY_REJUDGE, PRIORITY_SUBMISSION, get_publisher, judge_queue_name,
+    queue_depths)
+from penguin_judge.pagination import (
+    TOrder, count as count_rows, paginate)
+from penguin_judge.ranking import get_rankings, update as update_standings
+from penguin_judge.utils import content_hash, json_dumps, pagination_header
 
 DEFAULT_MEMORY_LIMIT = 256  # MiB
+_UPLOAD_CHUNK_SIZE = 1 << 20
+_DOWNLOAD_CHUNK_SIZE = 1 << 20
 
 app = Flask(__name__)
 with open(os.path.join(os.path.dirname(__file__), 'schema.yaml'), 'r') as f:
     _spec = create_spec(yaml.safe_load(f))
 _request_validator = RequestValidator(_spec)
+_TOKEN_CHANNEL = 'penguin_judge_tokens'
+_RESPONSE_CHANNEL = 'penguin_judge_responses'
+_caches: Dict[str, Tuple[Tuple[int, float], TTLCache]] = {}
+
+# (JSONにする値またはエラーのステータスコード, 値が変わる日時)
+TBuildResult = Tuple[Union[int, dict, list], Optional[datetime]]
 
 
 def response204() -> Response:
@@ -94,24 +117,125 @@ def _validate_token(
         abort(401)
     utc_now = datetime.now(tz=timezone.utc)
 
-    def _check(s: scoped_session) -> Optional[dict]:
+    def _lookup(s: scoped_session) -> Optional[Tuple[datetime, dict]]:
         ret = s.query(Token.expires, User).filter(
             Token.token == token_bytes, Token.user_id == User.id).first()
-        if not ret or ret[0] <= utc_now:
-            if required or admin_required:
-                abort(401)
-            else:
-                return None
-        if admin_required and not ret[1].admin:
-            abort(401)
+        if not ret:
+            return None
         tmp = ret[1].to_summary_dict()
-        tmp['_token_bytes'] = token_bytes
         tmp['login_id'] = ret[1].login_id
-        return tmp
-    if s:
-        return _check(s)
-    with transaction() as s:
-        return _check(s)
+        return ret[0], tmp
+
+    cache = _get_token_cache()
+    cache_key = content_hash(token_bytes)
+    entry: Optional[Tuple[datetime, dict]] = cache.get(cache_key)
+    if entry is None:
+        if s:
+            entry = _lookup(s)
+        else:
+            with transaction() as s:
+                entry = _lookup(s)
+        if entry:
+            cache.put(cache_key, entry,
+                      ttl=(entry[0] - utc_now).total_seconds())
+    if not entry or entry[0] <= utc_now:
+        if required or admin_required:
+            abort(401)
+        return None
+    if admin_required and not entry[1]['admin']:
+        abort(401)
+    tmp = dict(entry[1])
+    tmp['_token_bytes'] = token_bytes
+    return tmp
+
+
+def _get_cache(name: str, channel: Optional[str] = None,
+               on_notify: Callable[[str], None] = lambda _: None
+               ) -> TTLCache:
+    # nameで始まるコンフィグ(<name>_size, <name>_ttl)に従って生成する
+    params = (app.config.get(name + '_size', 0),
+              app.config.get(name + '_ttl', 0))
+    item = _caches.get(name)
+    if item is None or item[0] != params:
+        item = _caches[name] = (params, TTLCache(*params))
+    if item[1].enabled and channel:
+        # 他のプロセスでの更新を受け取って破棄する
+        listen(channel, on_notify, lambda: _caches[name][1].clear())
+    return item[1]
+
+
+def _get_token_cache() -> TTLCache:
+    return _get_cache('token_cache', _TOKEN_CHANNEL, _on_token_notify)
+
+
+def _on_token_notify(payload: str) -> None:
+    kind, _, value = payload.partition(':')
+    cache = _get_token_cache()
+    if kind == 'token':
+        cache.pop(value)
+    elif kind == 'user':
+        user_id = int(value)
+        cache.remove_if(lambda _, v: v[1]['id'] == user_id)
+
+
+def _invalidate_token_cache(s: scoped_session, payload: str) -> None:
+    # 'token:<トークンのハッシュ値>'または'user:<ユーザID>'を指定する
+    _on_token_notify(payload)
+    notify(s, _TOKEN_CHANNEL, payload)
+
+
+def _get_response_cache() -> TTLCache:
+    return _get_cache('response_cache', _RESPONSE_CHANNEL, _on_response_notify)
+
+
+def _on_response_notify(payload: str) -> None:
+    prefix = tuple(payload.split('/'))
+    _get_response_cache().remove_if(
+        lambda k, _: k[0][:len(prefix)] == prefix)
+
+
+def _invalidate_responses(s: scoped_session, *resource: str) -> None:
+    # 指定したリソースとその配下のリソースのキャッシュを破棄する
+    payload = '/'.join(resource)
+    _on_response_notify(payload)
+    notify(s, _RESPONSE_CHANNEL, payload)
+
+
+def _visibility(u: Optional[dict]) -> str:
+    if not u:
+        return 'anonymous'
+    return 'admin' if u['admin'] else 'user'
+
+
+def _cached_json(resource: Tuple[str, ...], u: Optional[dict],
+                 build: Callable[[scoped_session], TBuildResult]) -> Response:
+    """GETのレスポンスを(リソース, 閲覧者の種別)単位でキャッシュし、
+    ETagによる条件付きGETに応答する
+
+    buildが返した日時を過ぎると内容が変わる(コンテストの開始等)ため、
+    その日時までしかキャッシュしない"""
+    cache = _get_response_cache()
+    key = (resource, _visibility(u))
+    entry = cache.get(key)
+    if entry is None:
+        with transaction() as s:
+            ret, valid_until = build(s)
+        if isinstance(ret, int):
+            entry = (ret, b'', '')
+        else:
+            body = json_dumps(ret)
+            entry = (200, body, content_hash(body))
+        ttl = None
+        if valid_until is not None:
+            ttl = (valid_until - datetime.now(tz=timezone.utc)
+                   ).total_seconds()
+        cache.put(key, entry, ttl=ttl)
+    status, body, etag = entry
+    if status != 200:
+        abort(status)
+    resp = app.response_class(body, mimetype=app.config['JSONIFY_MIMETYPE'])
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
 
 
 @app.route('/auth', methods=['POST'])
@@ -143,6 +267,8 @@ def deleteToken() -> Response:
         s.query(Token).filter(
             Token.token == u['_token_bytes']
         ).delete(synchronize_session=False)
+        _invalidate_token_cache(
+            s, 'token:' + content_hash(u['_token_bytes']))
     resp = make_response((b'', 204))
     resp.headers.pop(key='content-type')
     resp.headers.add('Set-Cookie', 'AuthToken=; Max-Age=0')
@@ -189,6 +315,7 @@ def update_user(user_id: int) -> Response:
                     abort(401)
             user.salt = secrets.token_bytes()
             user.password = _kdf(body.new_password, user.salt)
+        _invalidate_token_cache(s, 'user:{}'.format(user.id))
         try:
             s.commit()
         except IntegrityError:
@@ -219,16 +346,16 @@ def create_user() -> Response:
 
 @app.route('/environments')
 def list_environments() -> Response:
-    ret = []
-    with transaction() as s:
-        u = _validate_token(s)
+    u = _validate_token()
+
+    def _build(s: scoped_session) -> TBuildResult:
         is_admin = u and u['admin']
         q = s.query(Environment)
         if not is_admin:
             q = q.filter(Environment.published.is_(True))
-        for c in q:
-            ret.append(c.to_dict() if is_admin else c.to_summary_dict())
-    return jsonify(ret)
+        return [
+            c.to_dict() if is_admin else c.to_summary_dict() for c in q], None
+    return _cached_json(('environments',), u, _build)
 
 
 @app.route('/environments', methods=['POST'])
@@ -244,6 +371,7 @@ def register_environment() -> Response:
             test_image_name=body.test_image_name)
         s.add(e)
         s.flush()
+        _invalidate_responses(s, 'environments')
         return jsonify(e.to_dict())
 
 
@@ -260,6 +388,7 @@ def update_environment(environment_id: str) -> Response:
             if not hasattr(body, key):
                 continue
             setattr(c, key, getattr(body, key))
+        _invalidate_responses(s, 'environments')
         ret = c.to_dict()
     return jsonify(ret)
 
@@ -272,13 +401,36 @@ def delete_environment(environment_id: str) -> Response:
             Environment.id == environment_id).delete(synchronize_session=False)
         if not deleted:
             abort(404)
+        _invalidate_responses(s, 'environments')
     return response204()
 
 
+def _paginate(s: scoped_session, q: Any, order: TOrder, query: dict,
+              entity: Callable[[Any], Any] = lambda x: x
+              ) -> Tuple[list, Dict[str, Any]]:
+    # cursorを指定した場合はキーセットによるページング(OFFSETもCOUNTも不要)。
+    # 件数(X-Total)はtotalで正確な値/推定値/省略を選択でき、
+    # 省略時はページ番号によるページングのみ正確な値を返す
+    page, per_page = query['page'], query['per_page']
+    cursor = query.get('cursor')
+    if cursor is not None:
+        page = None
+    try:
+        rows, headers = paginate(
+            q, order, per_page, page=page, cursor=cursor, entity=entity)
+    except ValueError:
+        abort(400)
+    total = count_rows(
+        s, q, query.get('total') or ('none' if cursor is not None
+                                     else 'exact'),
+        _get_cache('count_cache'))
+    headers.update(pagination_header(total, page, per_page))
+    return rows, headers
+
+
 @app.route('/contests')
 def list_contests() -> Response:
     params, _ = _validate_request()
-    page, per_page = params.query['page'], params.query['per_page']
     ret = []
     with transaction() as s:
         u = _validate_token(s)
@@ -298,11 +450,12 @@ def list_contests() -> Response:
             elif v == 'finished':
                 q = q.filter(Contest.end_time <= now)
 
-        count = q.count()
-        q = q.order_by(Contest.start_time.desc())
-        for c in q.offset((page - 1) * per_page).limit(per_page):
+        rows, headers = _paginate(
+            s, q, [(Contest.start_time, True), (Contest.id, False)],
+            params.query)
+        for c in rows:
             ret.append(c.to_summary_dict())
-    return jsonify(ret, headers=pagination_header(count, page, per_page))
+    return jsonify(ret, headers=headers)
 
 
 @app.route('/contests', methods=['POST'])
@@ -325,6 +478,8 @@ def create_contest() -> Response:
         contest = Contest(**contest_values)
         s.add(contest)
         s.flush()
+        # 存在しないことをキャッシュしている場合があるため破棄する
+        _invalidate_responses(s, 'contests', contest.id)
         ret = contest.to_dict()
     return jsonify(ret)
 
@@ -345,39 +500,44 @@ def update_contest(contest_id: str) -> Response:
             setattr(c, key, getattr(body, key))
         if c.start_time >= c.end_time:
             abort(400, {'detail': 'start_time must be lesser than end_time'})
+        _invalidate_responses(s, 'contests', c.id)
         ret = c.to_dict()
     return jsonify(ret)
 
 
 @app.route('/contests/<contest_id>')
 def get_contest(contest_id: str) -> Response:
-    with transaction() as s:
-        u = _validate_token(s)
+    u = _validate_token()
+
+    def _build(s: scoped_session) -> TBuildResult:
         contest = s.query(Contest).filter(Contest.id == contest_id).first()
         if not (contest and contest.is_accessible(u)):
-            abort(404)
+            return 404, None
         ret = contest.to_dict()
-        if contest.is_begun() or (u and u['admin']):
-            problems = s.query(Problem).filter(
-                Problem.contest_id == contest_id
-            ).order_by(Problem.id).all()
-            if problems:
-                ret['problems'] = [p.to_dict() for p in problems]
-    return jsonify(ret)
+        if not (contest.is_begun() or (u and u['admin'])):
+            return ret, contest.start_time
+        problems = s.query(Problem).filter(
+            Problem.contest_id == contest_id
+        ).order_by(Problem.id).all()
+        if problems:
+            ret['problems'] = [p.to_dict() for p in problems]
+        return ret, None
+    return _cached_json(('contests', contest_id), u, _build)
 
 
 @app.route('/contests/<contest_id>/problems')
 def list_problems(contest_id: str) -> Response:
-    with transaction() as s:
-        u = _validate_token(s)
+    u = _validate_token()
+
+    def _build(s: scoped_session) -> TBuildResult:
         contest = s.query(Contest).filter(Contest.id == contest_id).first()
         if not (contest and contest.is_accessible(u)):
-            abort(404)
+            return 404, None
         if not (contest.is_begun() or (u and u['admin'])):
-            abort(403)
-        ret = [p.to_summary_dict() for p in s.query(Problem).filter(
-            Problem.contest_id == contest_id).order_by(Problem.id).all()]
-    return jsonify(ret)
+            return 403, contest.start_time
+        return [p.to_summary_dict() for p in s.query(Problem).filter(
+            Problem.contest_id == contest_id).order_by(Problem.id)], None
+    return _cached_json(('contests', contest_id, 'problems'), u, _build)
 
 
 @app.route('/contests/<contest_id>/problems', methods=['POST'])
@@ -398,9 +558,12 @@ def create_problem(contest_id: str) -> Response:
             time_limit=body.time_limit,
             memory_limit=getattr(body, 'memory_limit', DEFAULT_MEMORY_LIMIT),
             description=body.description,
-            score=body.score)
+            score=body.score,
+            parallelism=getattr(body, 'parallelism', None),
+            max_failures=getattr(body, 'max_failures', None))
         s.add(problem)
         s.flush()
+        _invalidate_responses(s, 'contests', contest_id)
         ret = problem.to_dict()
     return jsonify(ret, status=201)
 
@@ -418,6 +581,7 @@ def update_problem(contest_id: str, problem_id: str) -> Response:
             if not hasattr(body, key):
                 continue
             setattr(problem, key, getattr(body, key))
+        _invalidate_responses(s, 'contests', contest_id)
         ret = problem.to_dict()
     return jsonify(ret)
 
@@ -429,31 +593,33 @@ def delete_problem(contest_id: str, problem_id: str) -> Response:
         s.query(Problem).filter(
             Problem.contest_id == contest_id,
             Problem.id == problem_id).delete(synchronize_session=False)
+        _invalidate_responses(s, 'contests', contest_id)
     return response204()
 
 
 @app.route('/contests/<contest_id>/problems/<problem_id>')
 def get_problem(contest_id: str, problem_id: str) -> Response:
-    with transaction() as s:
-        u = _validate_token(s)
+    u = _validate_token()
+
+    def _build(s: scoped_session) -> TBuildResult:
         contest = s.query(Contest).filter(Contest.id == contest_id).first()
         if not (contest and contest.is_accessible(u)):
-            abort(404)
+            return 404, None
         if not (contest.is_begun() or (u and u['admin'])):
-            abort(404)  # ここは403ではなく404にする
-        ret = s.query(Problem).filter(
+            return 404, contest.start_time  # ここは403ではなく404にする
+        problem = s.query(Problem).filter(
             Problem.contest_id == contest_id,
             Problem.id == problem_id).first()
-        if not ret:
-            abort(404)
-        ret = ret.to_dict()
-    return jsonify(ret)
+        if not problem:
+            return 404, None
+        return problem.to_dict(), None
+    return _cached_json(
+        ('contests', contest_id, 'problems', problem_id), u, _build)
 
 
 @app.route('/contests/<contest_id>/submissions')
 def list_submissions(contest_id: str) -> Response:
     params, body = _validate_request()
-    page, per_page = params.query['page'], params.query['per_page']
     ret = []
     with transaction() as s:
         u = _validate_token(s)
@@ -487,24 +653,17 @@ def list_submissions(contest_id: str) -> Response:
         if params.query.get('user_name'):
             q = q.filter(User.name.contains(params.query.get('user_name')))
 
-        count = q.count()
-
-        if params.query.get('sort'):
-            sort_keys = []
-            for key in params.query['sort']:
-                f = getattr(Submission, key.lstrip('-'))
-                if key[0] == '-':
-                    f = f.desc()
-                sort_keys.append(f)
-            q = q.order_by(*sort_keys)
-        else:
-            q = q.order_by(Submission.created)
-
-        for c, name in q.offset((page - 1) * per_page).limit(per_page):
+        order: TOrder = [
+            (getattr(Submission, key.lstrip('-')), key[0] == '-')
+            for key in params.query.get('sort') or ['created']]
+        order.append((Submission.id, False))
+        rows, headers = _paginate(
+            s, q, order, params.query, entity=lambda x: x[0])
+        for c, name in rows:
             tmp = c.to_summary_dict()
             tmp['user_name'] = name
             ret.append(tmp)
-    return jsonify(ret, headers=pagination_header(count, page, per_page))
+    return jsonify(ret, headers=headers)
 
 
 @app.route('/contests/<contest_id>/submissions', methods=['POST'])
@@ -519,12 +678,15 @@ def post_submission(contest_id: str) -> Response:
     with transaction() as s:
         u = _validate_token(s, required=True)
         assert(u)
-        if not s.query(Environment).filter(Environment.id == env_id).count():
+        env = s.query(Environment).filter(Environment.id == env_id).first()
+        if not env:
             abort(400)  # bodyが不正なので400
         if not s.query(Contest).filter(Contest.id == contest_id).count():
             abort(404)  # contest_idはURLに含まれるため404
-        if not s.query(Problem).filter(Problem.contest_id == contest_id,
-                                       Problem.id == problem_id).count():
+        problem = s.query(Problem).filter(
+            Problem.contest_id == contest_id,
+            Problem.id == problem_id).first()
+        if not problem:
             abort(400)  # bodyが不正なので400
         queued_submission_count = s.query(Submission).filter(
             Submission.user_id == u['id'],
@@ -537,17 +699,14 @@ def post_submission(contest_id: str) -> Response:
             code=code, code_bytes=len(code_encoded), environment_id=env_id)
         s.add(submission)
         s.flush()
+        update_standings(s, contest_id, problem_id, [u['id']])
         ret = submission.to_summary_dict()
         ret['user_name'] = u['name']
+        job = make_job(contest_id, problem_id, [(ret['id'], u['id'])], [env])
 
-    conn = pika.BlockingConnection(get_mq_conn_params())
-    ch = conn.channel()
-    ch.queue_declare(queue='judge_queue')
-    ch.basic_publish(
-        exchange='', routing_key='judge_queue', body=pickle.dumps(
-            (contest_id, problem_id, ret['id'])))
-    ch.close()
-    conn.close()
+    get_publisher().publish(
+        encode_job(job), routing_key=judge_queue_name(PRIORITY_SUBMISSION),
+        headers={'user_id': u['id']})
     return jsonify(ret, status=201)
 
 
@@ -570,6 +729,9 @@ def get_submission(contest_id: str, submission_id: str) -> Response:
         if not submission.is_accessible(contest, u):
             abort(404)
         ret = submission.to_dict()
+        for k in ('lease_hostname', 'lease_pid', 'lease_expires',
+                  'lease_priority'):
+            ret.pop(k, None)
         ret['user_name'] = user_name
         ret['tests'] = []
         for t_raw in s.query(JudgeResult).filter(
@@ -605,88 +767,7 @@ def list_rankings(contest_id: str) -> Response:
             abort(404)
         if not contest.is_begun():
             abort(403)
-        contest_penalty = contest.penalty
-        contest_start_time = contest.start_time
-
-        problems = {p.id: p.score for p in s.query(
-            Problem.id, Problem.score).filter(Problem.contest_id == contest_id)
-        }
-
-        # 一度も提出していない人をランキングに載せるために利用
-        users_never_submitted = {
-            u.id: u.to_summary_dict()
-            for u in s.query(User).filter(User.admin.is_(False))}
-
-        q = s.query(
-            Submission.user_id, Submission.problem_id,
-            Submission.status, Submission.created,
-        ).filter(
-            Submission.contest_id == contest_id,
-            Submission.created >= contest.start_time,
-            Submission.created < contest.end_time,
-        )
-
-        users: Dict[int, List[Tuple[str, timedelta, JudgeStatus]]] = {}
-        for (uid, pid, st, t) in q:
-            if uid not in users:
-                users[uid] = []
-                users_never_submitted.pop(uid, None)
-            users[uid].append((pid, t, st))
-
-        user_names = {}
-        for id, name in s.query(User.id, User.name):
-            user_names[id] = name
-
-    results = []
-    for uid, all_submission in users.items():
-        all_submission.sort(key=lambda x: (x[0], x[1]))
-        max_time = contest_start_time
-        total_score = 0
-        total_penalties = 0
-        ret = dict(user_id=uid, user_name=user_names[uid], problems={})
-        for problem_id, submissions in groupby(
-                all_submission, key=lambda x: x[0]):
-            n_penalties = 0
-            tmp: Dict[str, Union[float, int, timedelta, bool]] = {}
-            has_pending = False
-            for (_, submit_time, submit_status) in submissions:
-                if submit_status == JudgeStatus.Accepted:
-                    tmp['time'] = submit_time - contest_start_time
-                    score = tmp['score'] = problems[problem_id]
-                    max_time = max(max_time, submit_time)
-                    total_score += score
-                    total_penalties += n_penalties
-                    break
-                elif submit_status in (
-                        JudgeStatus.Waiting,
-                        JudgeStatus.Running):
-                    has_pending = True
-                elif submit_status not in (
-                        JudgeStatus.CompilationError,
-                        JudgeStatus.InternalError):
-                    n_penalties += 1
-            tmp['penalties'] = n_penalties
-            tmp['pending'] = has_pending
-            ret['problems'][problem_id] = tmp
-        total_time = max_time - contest_start_time
-        ret.update(dict(
-            time=total_time, score=total_score, penalties=total_penalties,
-            adjusted_time=total_time + total_penalties * contest_penalty))
-        results.append(ret)
-
-    results.sort(key=lambda x: (-x['score'], x['adjusted_time']))
-    ranking = 0
-    for i, r in enumerate(results):
-        if i == 0 or results[i - 1]['score'] != 0:  # 0点の人は同じ順位とする
-            ranking += 1
-        r['ranking'] = ranking
-
-    # 一度も提出していない人をランキング末尾に同じ順位で追加
-    ranking += 1
-    for u in users_never_submitted.values():
-        results.append(dict(
-            ranking=ranking, user_id=u['id'], problems={}))
-
+        results = get_rankings(s, contest)
     return jsonify(results)
 
 
@@ -707,89 +788,110 @@ def list_tests(contest_id: str, problem_id: str) -> Response:
 @app.route('/contests/<contest_id>/problems/<problem_id>/tests',
            methods=['PUT'])
 def upload_test_dataset(contest_id: str, problem_id: str) -> Response:
-    from collections import Counter
-    import shutil
-    from zipfile import ZipFile
-    from contextlib import ExitStack
-    from tempfile import TemporaryFile
-
-    zctx = ZstdCompressor()
-    test_cases = []
-    ret = []
+    # リクエストボディを読み込む前に認証する。
+    # zipは末尾の目次から読む必要があるため一旦ディスクに書き出す
+    _validate_token(admin_required=True)
+    progress = request.args.get('progress', '').lower() == 'true'
     with ExitStack() as stack:
         f = stack.enter_context(TemporaryFile())
-        shutil.copyfileobj(request.stream, f)
+        shutil.copyfileobj(request.stream, f, _UPLOAD_CHUNK_SIZE)
         f.seek(0)
-        z = stack.enter_context(ZipFile(f))
-        counts = Counter()  # type: ignore
-        path_mapping = {}
-        for x in z.namelist():
-            if not (x.endswith('.in') or x.endswith('.out')):
-                continue
-            name = os.path.basename(x)
-            counts.update([os.path.splitext(name)[0]])
-            path_mapping[name] = x
-
-        for k, v in counts.items():
-            if v != 2:
-                continue
-            try:
-                with z.open(path_mapping[k + '.in']) as zi:
-                    in_data = zctx.compress(zi.read())
-                with z.open(path_mapping[k + '.out']) as zo:
-                    out_data = zctx.compress(zo.read())
-            except Exception:
-                continue
-            test_cases.append(dict(
-                contest_id=contest_id,
-                problem_id=problem_id,
-                id=k,
-                input=in_data,
-                output=out_data))
-            ret.append(k)
-
-    # 参照がないテストケースのみを削除し、
-    # 参照があるテストケースはUPDATE、
-    # 新規テストケースはINSERTする
-    from sqlalchemy import exists
-    with transaction() as s:
-        _ = _validate_token(s, admin_required=True)
-        s.query(TestCase).filter(
-            TestCase.contest_id == contest_id,
-            TestCase.problem_id == problem_id,
-            ~exists().where(JudgeResult.test_id == TestCase.id)
-        ).delete(synchronize_session=False)
-        for kwargs in test_cases:
-            q = s.query(TestCase).filter(
-                TestCase.contest_id == contest_id,
-                TestCase.problem_id == problem_id,
-                TestCase.id == kwargs['id'])
-            if q.count() == 0:
-                s.add(TestCase(**kwargs))
-            else:
-                kwargs.pop('contest_id')
-                kwargs.pop('problem_id')
-                kwargs.pop('id')
-                q.update(kwargs, synchronize_session=False)
-    return jsonify(ret)
+        try:
+            z = stack.enter_context(ZipFile(f))
+        except BadZipFile:
+            abort(400)
+        if not progress:
+            with transaction() as s:
+                ret = [x['id'] for x in import_tests(
+                    s, contest_id, problem_id, z)]
+            return jsonify(ret)
+
+        # 取り込んだテストごとに進捗を1行のJSONとして返し、
+        # 最後の行にテストIDの一覧を返す
+        cleanup = stack.pop_all()
+
+    def _generate() -> Iterator[bytes]:
+        with cleanup, transaction() as s:
+            ret = []
+            for x in import_tests(s, contest_id, problem_id, z):
+                ret.append(x['id'])
+                yield json_dumps(x) + b'\n'
+        yield json_dumps({'tests': ret}) + b'\n'
+    return Response(stream_with_context(_generate()),
+                    mimetype='application/x-ndjson')
 
 
 def _get_test_data(contest_id: str, problem_id: str, test_id: str,
                    is_input: bool) -> Response:
-    zctx = ZstdDecompressor()
-    from io import BytesIO
+    # 展開後のデータ全体をメモリに載せずにチャンクごとに展開して返す
     with transaction() as s:
         _ = _validate_token(s, admin_required=True)
-        tc = s.query(TestCase).filter(
+        name = 'input' if is_input else 'output'
+        columns = [getattr(TestCase, name + suffix)
+                   for suffix in ('', '_hash', '_size')]
+        row = s.query(*columns).filter(
             TestCase.contest_id == contest_id,
             TestCase.problem_id == problem_id,
             TestCase.id == test_id).first()
-        if not tc:
+    if row is None:
+        abort(404)
+    assert row
+    data, h, size = row
+    try:
+        f = open_test_data(data, h)
+    except KeyError:
+        abort(404)
+    headers = {
+        'Content-Disposition': 'attachment; filename={}.{}'.format(
+            test_id, 'in' if is_input else 'out'),
+        'Accept-Ranges': 'bytes',
+        'Vary': 'Accept-Encoding',
+    }
+    mimetype = 'application/octet-stream'
+
+    # zstdを受け付けるクライアントには保存しているフレームをそのまま返す
+    if request.range is None and any(
+            k == 'zstd' and q > 0 for k, q in request.accept_encodings):
+        headers['Content-Encoding'] = 'zstd'
+        return Response(wrap_file(request.environ, f, _DOWNLOAD_CHUNK_SIZE),
+                        headers=headers, mimetype=mimetype,
+                        direct_passthrough=True)
+
+    if size is None:  # サイズ導入前に登録されたデータ
+        size = content_size(data)
+    start, stop, status = 0, size, 200
+    if request.range is not None:
+        r = request.range.range_for_length(size)
+        if r is None:
+            f.close()
+            headers['Content-Range'] = 'bytes */{}'.format(size)
+            return Response(status=416, headers=headers)
+        start, stop = r
+        status = 206
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+            start, stop - 1, size)
+    headers['Content-Length'] = str(stop - start)
+
+    def _generate() -> Iterator[bytes]:
+        with closing(f):
+            yield from iter_decompressed(f, start, stop)
+    return Response(_generate(), status=status, headers=headers,
+                    mimetype=mimetype, direct_passthrough=True)
+
+
+@app.route('/contests/<contest_id>/problems/<problem_id>/tests/archive')
+def download_test_dataset(contest_id: str, problem_id: str) -> Response:
+    with transaction() as s:
+        _ = _validate_token(s, admin_required=True)
+        if not s.query(Problem).filter(
+                Problem.contest_id == contest_id,
+                Problem.id == problem_id).count():
             abort(404)
-        f = BytesIO(zctx.decompress(tc.input if is_input else tc.output))
-        return send_file(
-            f, as_attachment=True, attachment_filename='{}.{}'.format(
-                test_id, 'in' if is_input else 'out'))
+    return Response(
+        stream_with_context(iter_archive(contest_id, problem_id)),
+        mimetype='application/zip', headers={
+            'Content-Disposition': 'attachment; filename={}.zip'.format(
+                problem_id)})
 
 
 @app.route('/contests/<contest_id>/problems/<problem_id>/tests/<test_id>/in')
@@ -818,29 +920,45 @@ def rejudge(contest_id: str, problem_id: str) -> Response:
             Submission.problem_id == problem_id
         ).update({
             Submission.status: JudgeStatus.Waiting,
+            # ジャッジ中だった提出のリースが期限切れで回収されないようにする
+            Submission.lease_hostname: None,
+            Submission.lease_pid: None,
+            Submission.lease_expires: None,
+            Submission.lease_priority: None,
         }, synchronize_session=False)
-        q = s.query(Submission.id).filter(
+        update_standings(s, contest_id, problem_id)
+        q = s.query(
+            Submission.id, Submission.user_id, Submission.environment_id
+        ).filter(
             Submission.contest_id == contest_id,
             Submission.problem_id == problem_id
-        )
-        rejudge_list = [x for x, in q]
-
-    conn = pika.BlockingConnection(get_mq_conn_params())
-    ch = conn.channel()
-    ch.queue_declare(queue='judge_queue')
-    for submission_id in rejudge_list:
-        ch.basic_publish(
-            exchange='', routing_key='judge_queue', body=pickle.dumps(
-                (contest_id, problem_id, submission_id)))
-    ch.close()
-    conn.close()
+        ).order_by(Submission.id)
+        rejudge_list = q.all()
+        envs = s.query(Environment).filter(Environment.id.in_(
+            {env_id for _, _, env_id in rejudge_list})).all()
+
+        # 大量のリジャッジが提出のジャッジを妨げないように優先度の低いキューに
+        # 積む。複数の提出を1つのメッセージにまとめる
+        n = app.config['rejudge_batch_size']
+        jobs = []
+        for i in range(0, len(rejudge_list), n):
+            batch = rejudge_list[i:i + n]
+            batch_envs = {env_id for _, _, env_id in batch}
+            jobs.append(make_job(
+                contest_id, problem_id,
+                [(submission_id, user_id)
+                 for submission_id, user_id, _ in batch],
+                [e for e in envs if e.id in batch_envs]))
+    get_publisher().publish_batch(
+        [encode_job(job) for job in jobs],
+        routing_key=judge_queue_name(PRIORITY_REJUDGE))
 
     return jsonify({})
 
 
 @app.route('/status')
 def get_status() -> Response:
-    ret = {}
+    ret: Dict[str, Any] = {}
     with transaction() as s:
         _ = _validate_token(s, admin_required=True)
         ret['workers'] = [
@@ -848,10 +966,13 @@ def get_status() -> Response:
                 func.now() - Worker.last_contact < timedelta(seconds=60 * 10),
             ).order_by(Worker.startup_time)]
 
-    conn = pika.BlockingConnection(get_mq_conn_params())
-    ch = conn.channel()
-    queue = ch.queue_declare(queue='judge_queue')
-    ret['queued'] = queue.method.message_count
-    ch.close()
-    conn.close()
+    ret['queues'] = queue_depths()
+    ret['queued'] = sum(ret['queues'].values())
+    # 外部からワーカーノードを増減させるための指標
+    ret['scaling'] = {
+        'current_workers': len(ret['workers']),
+        'desired_workers': desired_workers(ret['queued'], [
+            (w.get('concurrency'), w.get('running'), w.get('queued'))
+            for w in ret['workers']]),
+    }
     return jsonify(ret)
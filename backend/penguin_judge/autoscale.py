@@ -0,0 +1,63 @@
+from math import ceil
+import os
+from typing import List, Optional, Tuple
+
+
+def cpu_count() -> int:
+    return len(os.sched_getaffinity(0))
+
+
+def host_load() -> float:
+    """直近1分間のロードアベレージをCPU数で割った値"""
+    return os.getloadavg()[0] / cpu_count()
+
+
+def available_memory() -> Optional[int]:
+    """新たに確保可能なメモリのバイト数(/proc/meminfoのMemAvailable)
+
+    取得できない環境ではNone"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def next_concurrency(current: int, lower: int, upper: int, *,
+                     backlog: int, running: int, load: float,
+                     free_memory: Optional[int], target_load: float,
+                     min_free_memory: int) -> int:
+    """ワーカーの次の並列数を[lower, upper]の範囲で1ずつ増減させて求める
+
+    ホストの負荷(CPUあたり)がtarget_loadを超えているか空きメモリが
+    min_free_memoryを下回っている場合は減らす。待ちのタスクがあり全ての枠が
+    使用中で、1つ増やしても負荷がtarget_loadを超えない場合は増やす"""
+    if load > target_load or (
+            free_memory is not None and free_memory < min_free_memory):
+        return max(lower, current - 1)
+    if (backlog > 0 and running >= current and
+            load + 1.0 / cpu_count() <= target_load):
+        return min(upper, current + 1)
+    return max(lower, min(upper, current))
+
+
+def desired_workers(
+        queued: int,
+        workers: List[Tuple[Optional[int], Optional[int], Optional[int]]]
+) -> int:
+    """キューに積まれているタスク数と各ワーカーの(並列数, 実行中の数,
+    受信済みで未処理の数)から、待ちなく処理するために必要なワーカーの数を
+    求める(最低1)
+
+    ワーカーが先読みしたメッセージはキューの件数に含まれないため、
+    ワーカーごとの未処理の数も需要に加える。並列数が不明なワーカーは
+    1として扱う"""
+    if not workers:
+        return 1
+    concurrency = [c or 1 for c, _, _ in workers]
+    per_worker = sum(concurrency) / len(concurrency)
+    demand = queued + sum((r or 0) + (q or 0) for _, r, q in workers)
+    return max(1, ceil(demand / per_worker))
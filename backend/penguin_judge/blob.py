@@ -0,0 +1,192 @@
+from abc import ABCMeta, abstractmethod
+import os
+import re
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import Any, BinaryIO, Dict, Iterator, Optional, Tuple
+
+# テストデータをDB外に保存する場合の設定(blob.*)。
+# キーは展開後のデータのSHA-256で、値はzstdで圧縮したフレーム
+_config: Dict[str, str] = {}
+_store: Optional['BlobStore'] = None
+_store_lock = Lock()
+_KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def configure(**kwargs: Any) -> None:
+    global _config, _store
+    with _store_lock:
+        _config = {k: v for k, v in kwargs.items() if k.startswith('blob.')}
+        _store = None
+
+
+def get_config() -> Dict[str, str]:
+    return _config
+
+
+def get_store() -> Optional['BlobStore']:
+    """設定されたストアを返す。blob.backendがdb(既定)の場合はNone"""
+    global _store
+    backend = _config.get('blob.backend', 'db')
+    if backend == 'db':
+        return None
+    with _store_lock:
+        if _store is None:
+            if backend == 'file':
+                _store = FileBlobStore(_config['blob.dir'])
+            elif backend == 's3':
+                _store = S3BlobStore(
+                    _config['blob.s3_bucket'],
+                    prefix=_config.get('blob.s3_prefix', ''),
+                    endpoint_url=_config.get('blob.s3_endpoint_url') or None)
+            else:
+                raise RuntimeError(
+                    'config error: unknown blob.backend: {}'.format(backend))
+        return _store
+
+
+def _check_key(key: str) -> str:
+    if not _KEY_PATTERN.match(key):
+        raise ValueError('invalid blob key: {}'.format(key))
+    return key
+
+
+class BlobStore(metaclass=ABCMeta):
+    """内容のハッシュ値をキーとするストア。同じ内容は1つだけ保存される"""
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def put(self, key: str, data: bytes) -> None:
+        """保存する。既に存在する場合は内容を書き込まずに更新時刻のみ更新する
+
+        (ガベージコレクション中に再び参照されたblobを削除しないため)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def open(self, key: str) -> BinaryIO:
+        """読み込み用に開く。存在しない場合はKeyError"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def list(self) -> Iterator[Tuple[str, float]]:
+        """(キー, 更新時刻のUNIX時間)を返す"""
+        raise NotImplementedError
+
+
+class FileBlobStore(BlobStore):
+    """ローカルまたは共有ファイルシステム上のディレクトリに
+    <先頭2文字>/<キー>として保存する"""
+
+    def __init__(self, directory: str) -> None:
+        self._dir = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        _check_key(key)
+        return os.path.join(self._dir, key[:2], key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self.path(key)
+        try:
+            os.utime(path)
+            return
+        except FileNotFoundError:
+            pass
+        # 読み込み中のプロセスが書きかけのデータを読まないように
+        # 一時ファイルに書き込んでから置き換える
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        with NamedTemporaryFile(dir=directory, prefix='.',
+                                delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+
+    def open(self, key: str) -> BinaryIO:
+        try:
+            return open(self.path(key), 'rb')
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def delete(self, key: str) -> None:
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self) -> Iterator[Tuple[str, float]]:
+        for entry in os.scandir(self._dir):
+            if not entry.is_dir() or len(entry.name) != 2:
+                continue
+            for f in os.scandir(entry.path):
+                if _KEY_PATTERN.match(f.name):
+                    try:
+                        yield f.name, f.stat().st_mtime
+                    except FileNotFoundError:
+                        continue
+
+
+class S3BlobStore(BlobStore):
+    """S3互換のオブジェクトストレージに<prefix><キー>として保存する
+
+    clientを省略した場合はboto3(別途インストールが必要)のクライアントを使う"""
+
+    def __init__(self, bucket: str, *, prefix: str = '',
+                 client: Any = None, **client_kwargs: Any) -> None:
+        if client is None:
+            import boto3  # type: ignore
+            client = boto3.client('s3', **client_kwargs)
+        self._client = client
+        self._bucket = bucket
+        self._prefix = prefix
+
+    def _name(self, key: str) -> str:
+        return self._prefix + _check_key(key)
+
+    def _is_not_found(self, e: Exception) -> bool:
+        code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+        return code in ('404', 'NoSuchKey', 'NotFound')
+
+    def exists(self, key: str) -> bool:
+        try:
+            self._client.head_object(Bucket=self._bucket, Key=self._name(key))
+        except Exception as e:
+            if self._is_not_found(e):
+                return False
+            raise
+        return True
+
+    def put(self, key: str, data: bytes) -> None:
+        # 更新時刻のみを更新する手段がないため、存在していても上書きする
+        self._client.put_object(
+            Bucket=self._bucket, Key=self._name(key), Body=data)
+
+    def open(self, key: str) -> BinaryIO:
+        try:
+            return self._client.get_object(
+                Bucket=self._bucket, Key=self._name(key))['Body']
+        except Exception as e:
+            if self._is_not_found(e):
+                raise KeyError(key)
+            raise
+
+    def delete(self, key: str) -> None:
+        self._client.delete_object(Bucket=self._bucket, Key=self._name(key))
+
+    def list(self) -> Iterator[Tuple[str, float]]:
+        paginator = self._client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(
+                Bucket=self._bucket, Prefix=self._prefix):
+            for obj in page.get('Contents', []):
+                key = obj['Key'][len(self._prefix):]
+                if _KEY_PATTERN.match(key):
+                    yield key, obj['LastModified'].timestamp()
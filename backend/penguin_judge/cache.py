@@ -0,0 +1,131 @@
+from collections import OrderedDict
+from logging import getLogger
+import os
+from random import uniform
+import select
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from sqlalchemy import engine_from_config, func, select as sql_select
+from sqlalchemy.pool import NullPool
+
+from penguin_judge.models import get_db_config, scoped_session
+
+LOGGER = getLogger(__name__)
+
+
+class TTLCache(object):
+    """有効期限付きのLRUキャッシュ(プロセス内, スレッドセーフ)"""
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = Lock()
+        self._entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = \
+            OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_size > 0 and self._ttl > 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0] <= monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return item[1]
+
+    def put(self, key: Hashable, value: Any,
+            ttl: Optional[float] = None) -> None:
+        if not self.enabled:
+            return
+        ttl = self._ttl if ttl is None else min(ttl, self._ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def remove_if(self, pred: Callable[[Any, Any], bool]) -> None:
+        with self._lock:
+            for key in [k for k, (_, v) in self._entries.items()
+                        if pred(k, v)]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+def notify(s: scoped_session, channel: str, payload: str) -> None:
+    # トランザクションのコミット時に他のプロセスへ通知される
+    s.execute(sql_select([func.pg_notify(channel, payload)]))
+
+
+class Listener(object):
+    """PostgreSQLのLISTEN/NOTIFYで他のプロセスからの通知を受け取る
+
+    接続が切れていた間の通知は受け取れないため、
+    (再)接続時にはon_connectを呼び出してキャッシュ全体を破棄させる"""
+
+    def __init__(self, channel: str, callback: Callable[[str], None],
+                 on_connect: Callable[[], None]) -> None:
+        self._channel = channel
+        self._callback = callback
+        self._on_connect = on_connect
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        engine = engine_from_config(get_db_config(), poolclass=NullPool)
+        while True:
+            try:
+                self._listen(engine)
+            except Exception:
+                LOGGER.warning('LISTEN {} failed. retrying...'.format(
+                    self._channel), exc_info=True)
+            self._on_connect()
+            sleep(uniform(1, 5))
+
+    def _listen(self, engine: Any) -> None:
+        conn = engine.raw_connection()
+        try:
+            dbapi_conn = conn.connection
+            dbapi_conn.autocommit = True
+            with dbapi_conn.cursor() as cur:
+                cur.execute('LISTEN "{}"'.format(self._channel))
+            self._on_connect()
+            while True:
+                if select.select([dbapi_conn], [], [], 60) == ([], [], []):
+                    continue
+                dbapi_conn.poll()
+                while dbapi_conn.notifies:
+                    self._callback(dbapi_conn.notifies.pop(0).payload)
+        finally:
+            conn.close()
+
+
+_listeners: Dict[Tuple[int, str], Listener] = {}
+_listeners_lock = Lock()
+
+
+def listen(channel: str, callback: Callable[[str], None],
+           on_connect: Callable[[], None]) -> None:
+    """チャネルの通知の受信を開始する(プロセスごとに1回だけ有効)"""
+    # gunicornのfork前に開始したスレッドは子プロセスに引き継がれないため
+    # PIDで区別する
+    key = (os.getpid(), channel)
+    with _listeners_lock:
+        if key not in _listeners:
+            _listeners[key] = Listener(channel, callback, on_connect)
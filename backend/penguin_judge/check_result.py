@@ -1,6 +1,9 @@
 
 
-def equal_binary(answer: bytes, output: bytes) -> bool:
+from typing import Union
+
+
+def equal_binary(answer: Union[bytes, memoryview], output: bytes) -> bool:
     if answer == output:
         return True
     return False
@@ -0,0 +1,268 @@
+from contextlib import closing
+from hashlib import sha256
+from io import BytesIO
+from logging import getLogger
+import os
+import time
+from typing import (
+    Any, BinaryIO, Dict, Iterator, List, Optional, Set, Tuple, Union)
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+
+from sqlalchemy import and_, exists
+from sqlalchemy.dialects.postgresql import insert
+from zstandard import (  # type: ignore
+    ZstdCompressor, ZstdDecompressor, frame_content_size)
+
+from penguin_judge.blob import BlobStore, get_store
+from penguin_judge.models import (
+    JudgeResult, TestCase, scoped_session, transaction)
+from penguin_judge.utils import content_hash
+
+LOGGER = getLogger(__name__)
+CHUNK_SIZE = 1 << 20
+# 1回のINSERTにまとめる上限(圧縮後のバイト数/件数)
+BATCH_BYTES = 64 << 20
+BATCH_ROWS = 100
+
+
+class _HashingReader(object):
+    def __init__(self, f: Any) -> None:
+        self._f = f
+        self.hash = sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._f.read(size)
+        self.hash.update(data)
+        return data
+
+
+def find_tests(z: ZipFile) -> List[Tuple[str, ZipInfo, ZipInfo]]:
+    """ファイル名(ディレクトリを除く)が同じ.inと.outの組を
+    (テストID, 入力, 出力)としてzip内の出現順に返す"""
+    members: Dict[str, Dict[str, ZipInfo]] = {}
+    for info in z.infolist():
+        test_id, ext = os.path.splitext(os.path.basename(info.filename))
+        if ext in ('.in', '.out') and not info.is_dir():
+            members.setdefault(test_id, {})[ext] = info
+    return [(k, v['.in'], v['.out']) for k, v in members.items()
+            if len(v) == 2]
+
+
+def compress_member(z: ZipFile, info: ZipInfo,
+                    cctx: ZstdCompressor) -> Tuple[bytes, str]:
+    """zipのメンバを展開しながらzstdで圧縮し(圧縮後のデータ, SHA-256)を返す
+
+    展開後のデータ全体をメモリに保持しない"""
+    out = BytesIO()
+    with z.open(info) as f:
+        reader = _HashingReader(f)
+        # ジャッジ側で展開できるようにフレームに元のサイズを記録する
+        cctx.copy_stream(reader, out,  # type: ignore
+                         size=info.file_size, read_size=CHUNK_SIZE,
+                         write_size=CHUNK_SIZE)
+    return out.getvalue(), reader.hash.hexdigest()
+
+
+def import_tests(s: scoped_session, contest_id: str, problem_id: str,
+                 z: ZipFile, threads: int = -1) -> Iterator[dict]:
+    """zip内のテストデータで問題のテストケースを置き換え、
+    1件取り込むごとに進捗を返す
+
+    参照がないテストケースのみを削除し、それ以外はUPSERTする。
+    圧縮済みのデータはBATCH_BYTES程度ずつ書き込むため、
+    メモリ使用量はデータセット全体のサイズによらない。
+    blobストアが設定されている場合はデータをストアに保存し、
+    DBにはハッシュ値とサイズのみを書き込む"""
+    s.query(TestCase).filter(
+        TestCase.contest_id == contest_id,
+        TestCase.problem_id == problem_id,
+        ~exists().where(and_(
+            JudgeResult.contest_id == TestCase.contest_id,
+            JudgeResult.problem_id == TestCase.problem_id,
+            JudgeResult.test_id == TestCase.id))
+    ).delete(synchronize_session=False)
+
+    store = get_store()
+    cctx = ZstdCompressor(threads=threads)
+    batch: List[dict] = []
+    batch_bytes = 0
+    for test_id, in_info, out_info in find_tests(z):
+        try:
+            in_data, in_hash = compress_member(z, in_info, cctx)
+            out_data, out_hash = compress_member(z, out_info, cctx)
+        except Exception:
+            LOGGER.warning('failed to read test "{}"'.format(test_id),
+                           exc_info=True)
+            continue
+        if store:
+            store.put(in_hash, in_data)
+            store.put(out_hash, out_data)
+        else:
+            batch_bytes += len(in_data) + len(out_data)
+        batch.append(dict(
+            contest_id=contest_id, problem_id=problem_id, id=test_id,
+            input=None if store else in_data,
+            output=None if store else out_data,
+            input_hash=in_hash, output_hash=out_hash,
+            input_size=in_info.file_size, output_size=out_info.file_size))
+        if batch_bytes >= BATCH_BYTES or len(batch) >= BATCH_ROWS:
+            _upsert(s, batch)
+            batch, batch_bytes = [], 0
+        yield dict(id=test_id, input_bytes=in_info.file_size,
+                   output_bytes=out_info.file_size)
+    _upsert(s, batch)
+
+
+def _upsert(s: scoped_session, rows: List[dict]) -> None:
+    if not rows:
+        return
+    stmt = insert(TestCase.__table__).values(rows)
+    s.execute(stmt.on_conflict_do_update(
+        index_elements=['contest_id', 'problem_id', 'id'],
+        set_=dict(
+            input=stmt.excluded.input, output=stmt.excluded.output,
+            input_hash=stmt.excluded.input_hash,
+            output_hash=stmt.excluded.output_hash,
+            input_size=stmt.excluded.input_size,
+            output_size=stmt.excluded.output_size)))
+
+
+def open_test_data(data: Optional[bytes], h: Optional[str]) -> BinaryIO:
+    """DBに保存された圧縮済みデータ(dataがNULLの場合はblobストアの
+    ハッシュ値hのデータ)を読み込み用に開く"""
+    if data is not None:
+        return BytesIO(data)
+    store = get_store()
+    if store is None or h is None:
+        raise KeyError(h)
+    return store.open(h)
+
+
+def load_test_data(data: Optional[bytes], h: Optional[str]) -> bytes:
+    """open_test_dataで開いたデータを展開して返す"""
+    with closing(open_test_data(data, h)) as f:
+        return ZstdDecompressor().decompress(f.read())
+
+
+def content_size(data: bytes) -> int:
+    """zstdフレームの展開後のサイズを返す
+
+    フレームにサイズが記録されていない場合は展開しながら数える"""
+    size = frame_content_size(data)
+    if size >= 0:
+        return size
+    return sum(len(chunk) for chunk in ZstdDecompressor().read_to_iter(
+        data, write_size=CHUNK_SIZE))
+
+
+def iter_decompressed(data: Union[bytes, BinaryIO], start: int = 0,
+                      stop: Optional[int] = None) -> Iterator[bytes]:
+    """zstdフレームを展開しながら[start, stop)の範囲をCHUNK_SIZE程度ずつ返す"""
+    pos = 0
+    for chunk in ZstdDecompressor().read_to_iter(data, write_size=CHUNK_SIZE):
+        end = pos + len(chunk)
+        if end > start:
+            yield chunk[max(start - pos, 0):
+                        len(chunk) if stop is None else stop - pos]
+        pos = end
+        if stop is not None and pos >= stop:
+            break
+
+
+class _StreamBuffer(object):
+    # ZipFileの書き込み先。シークできないためデータディスクリプタ形式になる
+    def __init__(self) -> None:
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        ret = b''.join(self._chunks)
+        self._chunks = []
+        return ret
+
+
+def iter_archive(contest_id: str, problem_id: str) -> Iterator[bytes]:
+    """問題のテストデータセットをzip(<テストID>.in/.out)として逐次返す
+
+    テストケースは1件ずつ読み込むため、メモリ使用量は
+    最大のテストケースの圧縮後のサイズ程度となる"""
+    with transaction() as s:
+        test_ids = [x for x, in s.query(TestCase.id).filter(
+            TestCase.contest_id == contest_id,
+            TestCase.problem_id == problem_id).order_by(TestCase.id)]
+    buf = _StreamBuffer()
+    with ZipFile(buf, 'w', ZIP_DEFLATED, compresslevel=1) as z:  # type: ignore
+        for test_id in test_ids:
+            with transaction() as s:
+                row = s.query(
+                    TestCase.input, TestCase.input_hash,
+                    TestCase.output, TestCase.output_hash).filter(
+                        TestCase.contest_id == contest_id,
+                        TestCase.problem_id == problem_id,
+                        TestCase.id == test_id).first()
+            if row is None:  # 途中で削除された
+                continue
+            for ext, data, h in (('in', row[0], row[1]),
+                                 ('out', row[2], row[3])):
+                name = '{}.{}'.format(test_id, ext)
+                with z.open(name, 'w', force_zip64=True) as f, \
+                        closing(open_test_data(data, h)) as src:
+                    for chunk in iter_decompressed(src):
+                        f.write(chunk)
+                        yield buf.take()
+                yield buf.take()
+    yield buf.take()
+
+
+def migrate_to_store(store: BlobStore) -> int:
+    """DBに保存されているテストデータをblobストアに移し、移した件数を返す
+
+    1件ずつ別のトランザクションで移すため、途中で中断しても再実行できる"""
+    with transaction() as s:
+        keys = s.query(
+            TestCase.contest_id, TestCase.problem_id, TestCase.id).filter(
+                TestCase.input.isnot(None)).all()
+    zctx = ZstdDecompressor()
+    for contest_id, problem_id, test_id in keys:
+        with transaction() as s:
+            tc = s.query(TestCase).filter(
+                TestCase.contest_id == contest_id,
+                TestCase.problem_id == problem_id,
+                TestCase.id == test_id).with_for_update().first()
+            if tc is None or tc.input is None:
+                continue
+            for name in ('input', 'output'):
+                compressed = getattr(tc, name)
+                data = zctx.decompress(compressed)
+                h = content_hash(data)
+                store.put(h, compressed)
+                setattr(tc, name + '_hash', h)
+                setattr(tc, name + '_size', len(data))
+                setattr(tc, name, None)
+    return len(keys)
+
+
+def collect_garbage(store: BlobStore, min_age: float = 3600) -> int:
+    """どのテストケースからも参照されていないblobを削除し、削除した件数を返す
+
+    取り込み中(コミット前)のデータを消さないよう、
+    min_age秒以内に更新されたblobは削除しない"""
+    with transaction() as s:
+        referenced: Set[str] = set()
+        for in_hash, out_hash in s.query(
+                TestCase.input_hash, TestCase.output_hash).filter(
+                    TestCase.input.is_(None)):
+            referenced.update((in_hash, out_hash))
+    deadline = time.time() - min_age
+    removed = 0
+    for key, mtime in store.list():
+        if key not in referenced and mtime < deadline:
+            store.delete(key)
+            removed += 1
+    return removed
@@ -0,0 +1,85 @@
+from dataclasses import dataclass, field
+from io import BytesIO
+import pickle
+from typing import Any, List, Optional, Sequence, Tuple
+
+import msgpack  # type: ignore
+
+from penguin_judge.models import Environment
+
+# ジャッジキューに積むメッセージの形式のバージョン
+JOB_VERSION = 1
+
+
+@dataclass
+class JudgeJob(object):
+    """ジャッジキューのメッセージ。同じ問題の複数の提出をまとめられる
+
+    environmentsが指定されている場合、ワーカーは環境をDBから取得しない。
+    問題の制限はキューで待つ間に変更される(変更後にリジャッジされる)ため
+    メッセージには含めず、ワーカーが常にDBから取得する"""
+    contest_id: str
+    problem_id: str
+    submissions: List[Tuple[int, Optional[int]]]  # (提出ID, ユーザID)
+    # (環境ID, compile_image_name, test_image_name)
+    environments: List[Tuple[int, Optional[str], str]] = field(
+        default_factory=list)
+
+    def environment(self, env_id: int) -> Optional[Tuple[Optional[str], str]]:
+        for i, compile_image, test_image in self.environments:
+            if i == env_id:
+                return compile_image, test_image
+        return None
+
+
+def make_job(contest_id: str, problem_id: str,
+             submissions: List[Tuple[int, Optional[int]]],
+             environments: Sequence[Environment] = ()) -> JudgeJob:
+    return JudgeJob(
+        contest_id=contest_id, problem_id=problem_id,
+        submissions=submissions,
+        environments=[
+            (e.id, e.compile_image_name, str(e.test_image_name))
+            for e in environments])
+
+
+def encode_job(job: JudgeJob) -> bytes:
+    return msgpack.packb([
+        JOB_VERSION, job.contest_id, job.problem_id,
+        [list(x) for x in job.submissions],
+        None,  # 以前は問題の制限を含めていた欄。読み込み時は無視する
+        [list(x) for x in job.environments],
+    ], use_bin_type=True)
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    # 移行前に積まれた(contest_id, problem_id, submission_id)のタプル用。
+    # クラスや関数を参照するデータは読み込まない
+    def find_class(self, module: str, name: str) -> Any:
+        raise pickle.UnpicklingError('global is not allowed')
+
+
+def decode_job(body: bytes) -> JudgeJob:
+    """メッセージを読み込む。不正な形式の場合はValueError"""
+    try:
+        obj = msgpack.unpackb(body, raw=False)
+    except Exception:
+        obj = None
+    if isinstance(obj, list) and obj and obj[0] == JOB_VERSION:
+        try:
+            _, contest_id, problem_id, submissions, _, envs = obj
+            return JudgeJob(
+                contest_id=str(contest_id), problem_id=str(problem_id),
+                submissions=[(int(i), None if u is None else int(u))
+                             for i, u in submissions],
+                environments=[(int(i), None if c is None else str(c), str(t))
+                              for i, c, t in envs])
+        except (TypeError, ValueError) as e:
+            raise ValueError('invalid job: {}'.format(e))
+    try:
+        contest_id, problem_id, submission_id = _LegacyUnpickler(
+            BytesIO(body)).load()
+    except Exception:
+        raise ValueError('unknown message format')
+    return JudgeJob(contest_id=contest_id, problem_id=problem_id,
+                    submissions=[(int(submission_id), None)])
@@ -14,8 +14,12 @@ from penguin_judge.models import JudgeStatus
 @dataclass
 class JudgeTestInfo(object):
     id: str
-    input: bytes
-    output: bytes
+    # 子プロセスではキャッシュファイルをマップしたmemoryviewの場合がある
+    input: Union[bytes, memoryview] = b''
+    output: Union[bytes, memoryview] = b''
+    # ハッシュ値が設定されている場合はワーカーのキャッシュからデータを読み込む
+    input_hash: Optional[str] = None
+    output_hash: Optional[str] = None
 
 
 @dataclass
@@ -31,6 +35,11 @@ class JudgeTask(object):
     memory_limit: int
     tests: List[JudgeTestInfo]
     compile_time: Optional[timedelta] = None
+    parallelism: int = 1  # テストケースを同時に実行する数
+    max_failures: Optional[int] = None  # 打ち切りまでの不正解数
+    # ワーカーのプールから払い出された起動済みコンテナ
+    compile_container: Optional[str] = None
+    test_container: Optional[str] = None
 
 
 class AgentCompilationResult(NamedTuple):
@@ -49,7 +58,7 @@ class AgentError(NamedTuple):
 
 
 T = TypeVar('T')
-TStartTestCallback = Callable[[str], None]
+TStartTestCallback = Callable[[str], bool]  # Falseの場合は以降のテストを中止
 TJudgeCallback = Callable[
     [JudgeTestInfo, Union[AgentTestResult, AgentError]], None]
 CompileResult = AgentCompilationResult
@@ -67,6 +76,8 @@ class JudgeDriver(metaclass=ABCMeta):
     def tests(self, task: JudgeTask,
               start_test_callback: TStartTestCallback,
               judge_complete_callback: TJudgeCallback) -> None:
+        # task.parallelismが2以上の場合、コールバックは複数のスレッドから
+        # 呼び出されることがある
         raise NotImplementedError
 
     def __enter__(self) -> 'JudgeDriver':
@@ -87,13 +98,7 @@ class JudgeDriver(metaclass=ABCMeta):
 
     def __recv_agent_resp(
             self, strm: BufferedIOBase, cls: Type[T]) -> Union[T, AgentError]:
-        o = self.__recv(strm)
-        if not isinstance(o, dict) or 'type' not in o:
-            raise ValueError('invalid agent response')
-        if o['type'] == 'Error':
-            return AgentError(kind=o['kind'])
-        args = [o[n] for n in cls._fields]  # type: ignore
-        return cls(*args)
+        return _parse_agent_resp(self.__recv(strm), cls)
 
     def _recv_compile_result(self, strm: BufferedIOBase) -> Union[
             AgentCompilationResult, AgentError]:
@@ -102,3 +107,59 @@ class JudgeDriver(metaclass=ABCMeta):
     def _recv_test_result(self, strm: BufferedIOBase) -> Union[
             AgentTestResult, AgentError]:
         return self.__recv_agent_resp(strm, AgentTestResult)
+
+
+class AsyncStream(metaclass=ABCMeta):
+    """エージェントとの入出力に使う非同期ストリーム"""
+
+    @abstractmethod
+    async def readexactly(self, n: int) -> Union[bytes, bytearray]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def write(self, *data: Union[bytes, memoryview]) -> None:
+        raise NotImplementedError
+
+
+class AsyncJudgeDriver(metaclass=ABCMeta):
+    """JudgeDriverのイベントループ版。コールバックはループ上で呼び出される"""
+
+    async def prepare(self, task: JudgeTask) -> None:
+        pass
+
+    @abstractmethod
+    async def compile(self, task: JudgeTask
+                      ) -> Union[JudgeStatus, CompileResult]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def tests(self, task: JudgeTask,
+                    start_test_callback: TStartTestCallback,
+                    judge_complete_callback: TJudgeCallback) -> None:
+        raise NotImplementedError
+
+    async def __aenter__(self) -> 'AsyncJudgeDriver':
+        return self
+
+    async def __aexit__(self, exc_type: Any, exc_value: Any,
+                        traceback: Any) -> None:
+        pass
+
+    async def _send(self, strm: AsyncStream, obj: Any) -> None:
+        b = msgpack.packb(obj, use_bin_type=True)
+        await strm.write(struct.pack('<I', len(b)), b)
+
+    async def _recv(self, strm: AsyncStream, cls: Type[T]
+                    ) -> Union[T, AgentError]:
+        sz = struct.unpack('<I', await strm.readexactly(4))[0]
+        o = msgpack.unpackb(await strm.readexactly(sz), raw=False)
+        return _parse_agent_resp(o, cls)
+
+
+def _parse_agent_resp(o: Any, cls: Type[T]) -> Union[T, AgentError]:
+    if not isinstance(o, dict) or 'type' not in o:
+        raise ValueError('invalid agent response')
+    if o['type'] == 'Error':
+        return AgentError(kind=o['kind'])
+    args = [o[n] for n in cls._fields]  # type: ignore
+    return cls(*args)
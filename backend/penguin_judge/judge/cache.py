@@ -0,0 +1,144 @@
+from collections import OrderedDict
+from contextlib import ExitStack
+import mmap
+import os
+from tempfile import NamedTemporaryFile
+from threading import Lock
+import time
+from typing import Optional, Union
+
+_STALE_TEMP_SECONDS = 3600
+
+
+class DiskCache(object):
+    """ハッシュ値をキーとしてデータをローカルディスクに保持するLRUキャッシュ
+
+    削除は親プロセス(ワーカー)のみが行う。子プロセスはload()で読み込み、
+    store()で書き込んだファイルは親プロセスのscan()で管理対象に加える"""
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self._dir = directory
+        self._max_bytes = max_bytes
+        self._lock = Lock()
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()
+        self._total = 0
+        os.makedirs(directory, exist_ok=True)
+        self.scan()
+
+    def scan(self) -> None:
+        """ディレクトリ内のファイルを最終アクセス順に取り込み直す
+
+        他のプロセスがstore()で書き込んだファイルも管理対象にする"""
+        files = []
+        now = time.time()
+        for name in os.listdir(self._dir):
+            path = os.path.join(self._dir, name)
+            try:
+                st = os.stat(path)
+                if name.startswith('.'):
+                    # 書き込み途中で終了した一時ファイル
+                    if now - st.st_mtime > _STALE_TEMP_SECONDS:
+                        os.unlink(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, name, st.st_size))
+        with self._lock:
+            self._entries.clear()
+            self._total = 0
+            for _, name, size in sorted(files):
+                self._entries[name] = size
+                self._total += size
+        self._evict()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self._dir, key)
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._entries.move_to_end(key)
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            self._discard(key)
+            return False
+        return True
+
+    def get(self, key: str) -> Optional[bytes]:
+        if not self.contains(key):
+            return None
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            self._discard(key)
+            return None
+
+    def put(self, key: str, data: bytes) -> None:
+        store(self._dir, key, data)
+        with self._lock:
+            if key in self._entries:
+                self._total -= self._entries[key]
+            self._entries[key] = len(data)
+            self._total += len(data)
+        self._evict()
+
+    def _discard(self, key: str) -> None:
+        with self._lock:
+            self._total -= self._entries.pop(key, 0)
+
+    def _evict(self) -> None:
+        while True:
+            with self._lock:
+                if self._total <= self._max_bytes or not self._entries:
+                    return
+                key, size = self._entries.popitem(last=False)
+                self._total -= size
+            try:
+                os.unlink(self.path(key))
+            except FileNotFoundError:
+                pass
+
+
+def load(directory: str, key: str, stack: Optional[ExitStack] = None
+         ) -> Optional[Union[bytes, memoryview]]:
+    """子プロセスからの読み込み用。親プロセスが削除済みの場合はNoneを返す
+
+    stackを指定した場合はファイルをメモリマップして返す(コピーしない)。
+    マップはstackの終了時に解放される"""
+    try:
+        with open(os.path.join(directory, key), 'rb') as f:
+            if stack is None:
+                data = f.read()
+                _touch(directory, key)
+                return data
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''  # 空ファイルはmmapできない
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+    _touch(directory, key)
+    view = memoryview(m)
+    # 親プロセスがLRUで削除(unlink)してもマップ済みの領域は読み続けられる
+    stack.callback(m.close)
+    stack.callback(view.release)
+    return view
+
+
+def _touch(directory: str, key: str) -> None:
+    # 親プロセスのscan()が最終アクセス順に並べられるようにmtimeを更新する
+    try:
+        os.utime(os.path.join(directory, key))
+    except FileNotFoundError:
+        pass
+
+
+def store(directory: str, key: str, data: bytes) -> None:
+    # 読み込み中のプロセスが書きかけのデータを読まないように
+    # 一時ファイルに書き込んでから置き換える
+    os.makedirs(directory, exist_ok=True)
+    with NamedTemporaryFile(dir=directory, prefix='.', delete=False) as f:
+        f.write(data)
+    os.replace(f.name, os.path.join(directory, key))
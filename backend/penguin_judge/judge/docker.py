@@ -1,69 +1,205 @@
+import asyncio
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
 from io import RawIOBase, BufferedReader, BufferedWriter
-from typing import Any, Union, MutableSequence
+from queue import Queue, Empty
+from tempfile import gettempdir
+from threading import Condition, Thread
+from time import monotonic
+from typing import (
+    Any, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple, Union,
+    MutableSequence)
+import ssl
 import struct
 from logging import getLogger
+from urllib.parse import urlparse
 
 import docker  # type: ignore
 
 from penguin_judge.models import JudgeStatus
 from penguin_judge.judge import (
-    JudgeDriver, JudgeTask, TStartTestCallback, TJudgeCallback,
-    AgentCompilationResult, CompileResult)
+    AsyncJudgeDriver, AsyncStream, JudgeDriver, JudgeTask,
+    TStartTestCallback, TJudgeCallback, AgentCompilationResult,
+    AgentTestResult, CompileResult)
 
 LOGGER = getLogger(__name__)
+TPoolKey = Tuple[str, bool]  # (イメージ名, コンパイル用か否か)
+_config: Dict[str, Any] = {
+    'cpu_pinning': False,
+    'cpu_lock_dir': os.path.join(gettempdir(), 'penguin_judge', 'cpus'),
+}
+
+
+def configure(**kwargs: Any) -> None:
+    _config.update(kwargs)
+
+
+COMPILE_MEMORY_LIMIT = 2**30  # TODO(*): 1GB上限
+
+
+def create_container(client: docker.APIClient, image: str, mem_limit: int,
+                     pids_limit: Optional[int] = None,
+                     cpuset_cpus: Optional[str] = None) -> str:
+    host_cfg: Dict[str, Any] = dict(
+        auto_remove=True,
+        cap_drop=['ALL'],
+        mem_limit=mem_limit,
+        memswap_limit=mem_limit)
+    if pids_limit:
+        host_cfg['pids_limit'] = pids_limit
+    if cpuset_cpus:
+        host_cfg['cpuset_cpus'] = cpuset_cpus
+    container = client.create_container(
+        image,
+        host_config=client.create_host_config(**host_cfg),
+        stdin_open=True,
+        network_disabled=True)
+    client.start(container['Id'])
+    return container['Id']
+
+
+def create_test_container(client: docker.APIClient, image: str,
+                          mem_limit: int,
+                          cpuset_cpus: Optional[str] = None) -> str:
+    # pids_limit:
+    #    go-langは7, nodejsは8, jdk14は17程度, それ以外は3が最低限。
+    #    余裕を見て20を指定しておく
+    return create_container(
+        client, image, mem_limit, pids_limit=20, cpuset_cpus=cpuset_cpus)
+
+
+class CPULocks(object):
+    """ホスト内のジャッジプロセス間でCPUを排他的に割り当てる
+
+    テスト用コンテナを割り当てたCPUに固定することで、
+    並列実行時にも実行時間が他のジャッジの影響を受けないようにする"""
+
+    def __init__(self, directory: str) -> None:
+        self._dir = directory
+        self._fds: Dict[int, int] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def cpus(self) -> List[int]:
+        return sorted(self._fds.keys())
+
+    def acquire(self, n: int, hint: int = 0) -> List[int]:
+        # 空いているCPUを最大n個確保する。
+        # 1つも空いていない場合はhintで選んだCPUが空くまで待つ
+        candidates = sorted(os.sched_getaffinity(0))
+        for cpu in candidates:
+            if len(self._fds) >= n:
+                break
+            self._lock(cpu, blocking=False)
+        if not self._fds:
+            self._lock(candidates[hint % len(candidates)], blocking=True)
+        return self.cpus
+
+    def release(self) -> None:
+        for fd in self._fds.values():
+            os.close(fd)  # ロックも解放される
+        self._fds.clear()
+
+    def _lock(self, cpu: int, blocking: bool) -> None:
+        fd = os.open(os.path.join(self._dir, str(cpu)),
+                     os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return
+        self._fds[cpu] = fd
+
+
+def kill_container(client: docker.APIClient, container: str) -> None:
+    try:
+        client.kill(container)
+    except Exception:
+        pass
+
+
+def _compilation_message(task: JudgeTask) -> dict:
+    return {
+        'type': 'Compilation',
+        'code': task.code,
+        'time_limit': 60,  # TODO(*): コンパイル時間の上限をえいやで1分に
+        'memory_limit': 1024,  # TODO(*): 1GB上限(docker側の制限とあわせる)
+    }
+
+
+def _preparation_message(task: JudgeTask) -> dict:
+    return {
+        'type': 'Preparation',
+        'code': task.code,
+        'time_limit': task.time_limit,
+        'memory_limit': task.memory_limit,
+        'output_limit': 16,  # TODO(*): ハードコードじゃなく制御できるようにする
+    }
 
 
 class DockerJudgeDriver(JudgeDriver):
-    def __init__(self) -> None:
-        self.client = docker.APIClient()
-        self.compile_container = None
-        self.test_container = None
+    def __init__(self, client: Optional[docker.APIClient] = None) -> None:
+        # clientを省略した場合はジャッジごとに接続する
+        self.client = client or docker.APIClient()
+        self.compile_container: Optional[str] = None
+        self.test_containers: List[str] = []
+        self.cpu_locks: Optional[CPULocks] = None
 
     def prepare(self, task: JudgeTask) -> None:
         mem_limit = task.memory_limit * (2**20)
-        common_host_cfg = dict(
-            auto_remove=True,
-            cap_drop=['ALL'])
-        common_cfg = dict(
-            stdin_open=True,
-            network_disabled=True,
-        )
         if task.compile_image_name:
-            compile_cfg = dict(
-                host_config=self.client.create_host_config(**dict(
-                    mem_limit=2**30,  # TODO(*): 1GB上限
-                    memswap_limit=2**30,  # TODO(*): 1GB上限
-                    **common_host_cfg)),
-                **common_cfg,
-            )
-            self.compile_container = self.client.create_container(
-                task.compile_image_name, **compile_cfg)
-            self.client.start(self.compile_container)
-
-        # pids_limit:
-        #    go-langは7, nodejsは8, jdk14は17程度, それ以外は3が最低限。
-        #    余裕を見て20を指定しておく
-        test_cfg = dict(
-            host_config=self.client.create_host_config(**dict(
-                mem_limit=mem_limit,
-                memswap_limit=mem_limit,
-                pids_limit=20,
-                **common_host_cfg)),
-            **common_cfg,
-        )
-        self.test_container = self.client.create_container(
-            task.test_image_name, **test_cfg)
-        self.client.start(self.test_container)
+            self.compile_container = self._checkout(
+                task.compile_container, COMPILE_MEMORY_LIMIT)
+            if not self.compile_container:
+                self.compile_container = create_container(
+                    self.client, task.compile_image_name,
+                    COMPILE_MEMORY_LIMIT)
 
-    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
-        for c in (self.compile_container, self.test_container):
+        # 並列実行時はテストケースごとにコンテナを分ける。
+        # CPU固定が有効な場合は確保できたCPUの数だけ並列に実行する
+        parallelism = max(1, min(task.parallelism, len(task.tests)))
+        cpusets: List[Optional[str]] = [None] * parallelism
+        if _config['cpu_pinning']:
+            self.cpu_locks = CPULocks(_config['cpu_lock_dir'])
+            cpusets = [str(cpu) for cpu in self.cpu_locks.acquire(
+                parallelism, hint=task.id)]
+        for i, cpuset in enumerate(cpusets):
+            c = None
+            if i == 0:
+                c = self._checkout(task.test_container, mem_limit, cpuset)
             if not c:
-                continue
-            try:
-                self.client.kill(c)
-            except Exception:
-                pass
+                c = create_test_container(
+                    self.client, task.test_image_name, mem_limit, cpuset)
+            self.test_containers.append(c)
+
+    def _checkout(self, container: Optional[str], mem_limit: int,
+                  cpuset_cpus: Optional[str] = None) -> Optional[str]:
+        # ワーカーのプールから払い出された起動済みコンテナに
+        # メモリ制限を設定して使う。使えない場合は新規に作成させる
+        if not container:
+            return None
+        try:
+            params: Dict[str, Any] = dict(
+                mem_limit=mem_limit, memswap_limit=mem_limit)
+            if cpuset_cpus:
+                params['cpuset_cpus'] = cpuset_cpus
+            self.client.update_container(container, **params)
+            if self.client.inspect_container(container)['State']['Running']:
+                return container
+        except Exception:
+            LOGGER.warning('pooled container is unavailable', exc_info=True)
+        kill_container(self.client, container)
+        return None
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        # コンテナは使い捨てにする
+        for c in [self.compile_container, *self.test_containers]:
+            if c:
+                kill_container(self.client, c)
+        if self.cpu_locks:
+            self.cpu_locks.release()
 
     def compile(self, task: JudgeTask) -> Union[JudgeStatus, CompileResult]:
         s = self.client.attach_socket(
@@ -71,12 +207,7 @@ class DockerJudgeDriver(JudgeDriver):
             params={'stdin': 1, 'stdout': 1, 'stream': 1})
         reader = BufferedReader(DockerStdoutReader(s))
         writer = BufferedWriter(DockerStdinWriter(s))
-        self._send(writer, {
-            'type': 'Compilation',
-            'code': task.code,
-            'time_limit': 60,  # TODO(*): コンパイル時間の上限をえいやで1分に
-            'memory_limit': 1024,  # TODO(*): 1GB上限(docker側の制限とあわせる)
-        })
+        self._send(writer, _compilation_message(task))
         resp = self._recv_compile_result(reader)
         if isinstance(resp, AgentCompilationResult):
             return resp
@@ -85,32 +216,43 @@ class DockerJudgeDriver(JudgeDriver):
     def tests(self, task: JudgeTask,
               start_test_callback: TStartTestCallback,
               judge_complete_callback: TJudgeCallback) -> None:
-        s = self.client.attach_socket(
-            self.test_container,
-            params={'stdin': 1, 'stdout': 1, 'stream': 1})
-        reader = BufferedReader(DockerStdoutReader(s))
-        writer = BufferedWriter(DockerStdinWriter(s))
-        self._send(writer, {
-            'type': 'Preparation',
-            'code': task.code,
-            'time_limit': task.time_limit,
-            'memory_limit': task.memory_limit,
-            'output_limit': 16,  # TODO(*): ハードコードじゃなく制御できるようにする
-        })
+        queue: Queue = Queue()
         for test in task.tests:
-            start_test_callback(test.id)
-            self._send(writer, {
-                'type': 'Test',
-                'input': test.input
-            })
-            resp = self._recv_test_result(reader)
-            judge_complete_callback(test, resp)
+            queue.put(test)
+
+        def _run(container: str) -> None:
+            s = self.client.attach_socket(
+                container, params={'stdin': 1, 'stdout': 1, 'stream': 1})
+            reader = BufferedReader(DockerStdoutReader(s))
+            writer = BufferedWriter(DockerStdinWriter(s))
+            self._send(writer, _preparation_message(task))
+            while True:
+                try:
+                    test = queue.get_nowait()
+                except Empty:
+                    return
+                if not start_test_callback(test.id):
+                    return
+                self._send(writer, {
+                    'type': 'Test',
+                    'input': test.input
+                })
+                resp = self._recv_test_result(reader)
+                judge_complete_callback(test, resp)
+
+        if len(self.test_containers) == 1:
+            _run(self.test_containers[0])
+            return
+        with ThreadPoolExecutor(len(self.test_containers)) as executor:
+            futures = [executor.submit(_run, c) for c in self.test_containers]
+        for f in futures:
+            f.result()
 
 
 class DockerStdoutReader(RawIOBase):
     def __init__(self, raw: RawIOBase) -> None:
         self._raw = BufferedReader(raw)
-        self._cur = b''
+        self._cur = memoryview(b'')  # スライスしてもコピーされない
         self._eos = False
 
     def readable(self) -> bool:
@@ -137,7 +279,7 @@ class DockerStdoutReader(RawIOBase):
             sz = struct.unpack('>I', header[4:])[0]
             body = self._raw.read(sz)
             if header[0] == 0x01:
-                self._cur = body
+                self._cur = memoryview(body)
                 return
 
 
@@ -150,3 +292,369 @@ class DockerStdinWriter(RawIOBase):
 
     def write(self, b: bytes) -> int:
         return os.write(self._fd, b)
+
+
+class ContainerPool(object):
+    """ワーカー単位で起動済みのコンテナをイメージごとに保持するプール
+
+    コンテナは使い捨てで、払い出した分はバックグラウンドで補充する。
+    イメージごとの保持数は払い出し時に不足すると増やし(max_size上限)、
+    ヘルスチェックの間に払い出しが無ければmin_sizeまで減らす"""
+
+    def __init__(self, min_size: int, max_size: int,
+                 health_interval: float,
+                 client_factory: Callable[[], Any] = docker.APIClient
+                 ) -> None:
+        self._min_size, self._max_size = min_size, max(min_size, max_size)
+        self._health_interval = health_interval
+        self._client_factory = client_factory
+        self._cond = Condition()
+        self._idle: Dict[TPoolKey, Deque[str]] = {}
+        self._target: Dict[TPoolKey, int] = {}
+        self._used: Set[TPoolKey] = set()
+        self._backoff: Dict[TPoolKey, float] = {}
+        self._discards: List[str] = []
+        self._closed = False
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def checkout(self, image: str, compile: bool = False) -> Optional[str]:
+        key = (image, compile)
+        with self._cond:
+            idle = self._idle.setdefault(key, deque())
+            self._target.setdefault(key, self._min_size)
+            self._used.add(key)
+            container = idle.popleft() if idle else None
+            if not container:
+                self._target[key] = min(self._target[key] + 1,
+                                        self._max_size)
+            self._cond.notify()
+        return container
+
+    def reserve(self, image: str, count: int, compile: bool = False) -> None:
+        """次の払い出しに備えて保持数をcount(max_size上限)以上に増やす"""
+        key = (image, compile)
+        with self._cond:
+            self._idle.setdefault(key, deque())
+            self._target[key] = max(
+                self._target.get(key, self._min_size),
+                min(count, self._max_size))
+            self._used.add(key)
+            self._cond.notify()
+
+    def release(self, containers: Iterable[Optional[str]]) -> None:
+        # ジャッジプロセスが異常終了した場合に備えて使用済みコンテナを確実に削除する
+        with self._cond:
+            self._discards.extend(c for c in containers if c)
+            self._cond.notify()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _shortage(self) -> Optional[TPoolKey]:
+        now = monotonic()
+        for key, idle in self._idle.items():
+            if (len(idle) < self._target[key] and
+                    self._backoff.get(key, 0) <= now):
+                return key
+        return None
+
+    def _run(self) -> None:
+        client = self._client_factory()
+        next_check = monotonic() + self._health_interval
+        while True:
+            with self._cond:
+                while not (self._closed or self._discards or
+                           self._shortage() or monotonic() >= next_check):
+                    self._cond.wait(
+                        timeout=min(1.0, next_check - monotonic()))
+                if self._closed:
+                    break
+                discards, self._discards = self._discards, []
+                key = self._shortage()
+            for c in discards:
+                kill_container(client, c)
+            if key:
+                self._fill(client, key)
+            if monotonic() >= next_check:
+                self._health_check(client)
+                next_check = monotonic() + self._health_interval
+        with self._cond:
+            containers = [c for idle in self._idle.values() for c in idle]
+            containers += self._discards
+            self._idle.clear()
+        for c in containers:
+            kill_container(client, c)
+
+    def _fill(self, client: Any, key: TPoolKey) -> None:
+        image, compile = key
+        try:
+            if compile:
+                c = create_container(client, image, COMPILE_MEMORY_LIMIT)
+            else:
+                # メモリ制限は払い出し先で問題ごとの値に変更する
+                c = create_test_container(client, image, COMPILE_MEMORY_LIMIT)
+        except Exception:
+            LOGGER.warning('cannot create container ({})'.format(image),
+                           exc_info=True)
+            with self._cond:
+                self._backoff[key] = monotonic() + self._health_interval
+            return
+        with self._cond:
+            self._idle[key].append(c)
+
+    def _health_check(self, client: Any) -> None:
+        with self._cond:
+            for key in self._target:
+                if key not in self._used:
+                    self._target[key] = max(
+                        self._target[key] - 1, self._min_size)
+            self._used.clear()
+            snapshot = [(key, list(idle)) for key, idle in self._idle.items()]
+        dead = set()
+        for _, containers in snapshot:
+            for c in containers:
+                try:
+                    if client.inspect_container(c)['State']['Running']:
+                        continue
+                except Exception:
+                    pass
+                dead.add(c)
+        excess = []
+        with self._cond:
+            for key, idle in self._idle.items():
+                alive = [c for c in idle if c not in dead]
+                excess += alive[self._target[key]:]
+                idle.clear()
+                idle.extend(alive[:self._target[key]])
+        for c in list(dead) + excess:
+            kill_container(client, c)
+
+
+_ATTACH_BUFFER_SIZE = 2**16
+
+
+class _AttachProtocol(asyncio.BufferedProtocol, AsyncStream):
+    """Dockerのattach APIのストリームを非同期に読み書きする
+
+    受信データは再利用するバッファに直接書き込ませ、
+    多重化されたフレームからstdoutの部分だけを取り出す"""
+
+    def __init__(self) -> None:
+        self._buf = bytearray(_ATTACH_BUFFER_SIZE)
+        self._start = self._end = 0
+        self._eof = False
+        self._waiter: Optional[asyncio.Future] = None
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._frame_remain = 0
+        self._transport: Optional[asyncio.Transport] = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self._transport = transport  # type: ignore
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._eof = True
+        self._writable.set()
+        self._wakeup()
+
+    def eof_received(self) -> bool:
+        self._eof = True
+        self._wakeup()
+        return False
+
+    def pause_writing(self) -> None:
+        self._writable.clear()
+
+    def resume_writing(self) -> None:
+        self._writable.set()
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        n = self._end - self._start
+        if len(self._buf) - self._end < _ATTACH_BUFFER_SIZE // 2:
+            # 未読部分を先頭に詰める。足りなければバッファを拡張する
+            with memoryview(self._buf) as view:
+                view[:n] = view[self._start:self._end]
+            self._start, self._end = 0, n
+            if len(self._buf) - n < _ATTACH_BUFFER_SIZE // 2:
+                self._buf.extend(bytes(len(self._buf)))
+        return memoryview(self._buf)[self._end:]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self._end += nbytes
+        self._wakeup()
+
+    def _wakeup(self) -> None:
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def _wait(self) -> None:
+        if self._eof:
+            raise EOFError
+        self._waiter = asyncio.get_event_loop().create_future()
+        await self._waiter
+        self._waiter = None
+
+    async def handshake(self, container: str) -> None:
+        await self.write((
+            'POST /containers/{}/attach?stdin=1&stdout=1&stream=1 HTTP/1.1\r\n'
+            'Host: docker\r\nConnection: Upgrade\r\nUpgrade: tcp\r\n'
+            'Content-Length: 0\r\n\r\n').format(container).encode('ascii'))
+        while True:
+            idx = self._buf.find(b'\r\n\r\n', self._start, self._end)
+            if idx >= 0:
+                break
+            await self._wait()
+        status_line = bytes(self._buf[self._start:self._buf.find(
+            b'\r\n', self._start, self._end)])
+        self._start = idx + 4
+        if status_line.split()[1] not in (b'101', b'200'):
+            raise IOError('attach failed: {!r}'.format(status_line))
+
+    async def readexactly(self, n: int) -> bytearray:
+        out = bytearray(n)
+        pos = 0
+        with memoryview(out) as dst:
+            while pos < n:
+                if self._frame_remain == 0:
+                    while self._end - self._start < 8:
+                        await self._wait()
+                    kind, sz = struct.unpack_from(
+                        '>BxxxI', self._buf, self._start)
+                    self._start += 8
+                    self._frame_remain = sz if kind == 0x01 else -sz
+                    continue
+                while self._start == self._end:
+                    await self._wait()
+                avail = self._end - self._start
+                if self._frame_remain < 0:
+                    # stdout以外のフレームは読み捨てる
+                    k = min(avail, -self._frame_remain)
+                    self._start += k
+                    self._frame_remain += k
+                    continue
+                k = min(avail, self._frame_remain, n - pos)
+                with memoryview(self._buf) as src:
+                    dst[pos:pos + k] = src[self._start:self._start + k]
+                self._start += k
+                self._frame_remain -= k
+                pos += k
+        return out
+
+    async def write(self, *data: Union[bytes, memoryview]) -> None:
+        if self._eof or not self._transport:
+            raise EOFError
+        self._transport.writelines(list(data))
+        await self._writable.wait()
+
+    def close(self) -> None:
+        if self._transport:
+            self._transport.close()
+
+
+def _attach_params(client: docker.APIClient) -> Dict[str, Any]:
+    """clientと同じデーモンに同じTLS設定で接続するための
+    create_unix_connection/create_connectionの引数を返す"""
+    socket_path = getattr(
+        getattr(client, '_custom_adapter', None), 'socket_path', None)
+    if socket_path:
+        return dict(path=socket_path)
+    url = urlparse(client.base_url)
+    if url.scheme not in ('http', 'https'):
+        raise ValueError('async attach does not support {}'.format(
+            client.base_url))
+    params: Dict[str, Any] = dict(
+        host=url.hostname or 'localhost',
+        port=url.port or (2376 if url.scheme == 'https' else 2375))
+    if url.scheme == 'https':
+        # docker.tls.TLSConfigはverifyにCA証明書のパスを、certに
+        # (クライアント証明書, 鍵)を設定する
+        verify, cert = client.verify, client.cert
+        ctx = ssl.create_default_context(
+            cafile=verify if isinstance(verify, str) else None)
+        if verify is False:
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+        if isinstance(cert, str):
+            ctx.load_cert_chain(cert)
+        elif cert:
+            ctx.load_cert_chain(*cert)
+        params.update(ssl=ctx, server_hostname=params['host'])
+    return params
+
+
+async def _attach(params: Dict[str, Any], container: str) -> _AttachProtocol:
+    loop = asyncio.get_event_loop()
+    if 'path' in params:
+        _, proto = await loop.create_unix_connection(
+            _AttachProtocol, **params)
+    else:
+        _, proto = await loop.create_connection(_AttachProtocol, **params)
+    try:
+        await proto.handshake(container)
+    except BaseException:
+        proto.close()
+        raise
+    return proto
+
+
+class AsyncDockerJudgeDriver(AsyncJudgeDriver):
+    """DockerJudgeDriverのイベントループ版
+
+    コンテナの作成・削除はDockerJudgeDriverの処理をスレッドで実行し、
+    エージェントとの通信はattach APIのソケットを直接非同期に読み書きする"""
+
+    def __init__(self) -> None:
+        self._driver = DockerJudgeDriver()
+        # 作成/削除と同じデーモンのattach APIに接続する
+        self._attach_params = _attach_params(self._driver.client)
+
+    async def prepare(self, task: JudgeTask) -> None:
+        await asyncio.get_event_loop().run_in_executor(
+            None, self._driver.prepare, task)
+
+    async def __aexit__(self, exc_type: Any, exc_value: Any,
+                        traceback: Any) -> None:
+        await asyncio.get_event_loop().run_in_executor(
+            None, self._driver.__exit__, exc_type, exc_value, traceback)
+
+    async def compile(self, task: JudgeTask
+                      ) -> Union[JudgeStatus, CompileResult]:
+        assert self._driver.compile_container
+        strm = await _attach(
+            self._attach_params, self._driver.compile_container)
+        try:
+            await self._send(strm, _compilation_message(task))
+            resp = await self._recv(strm, AgentCompilationResult)
+        finally:
+            strm.close()
+        if isinstance(resp, AgentCompilationResult):
+            return resp
+        return JudgeStatus.CompilationError
+
+    async def tests(self, task: JudgeTask,
+                    start_test_callback: TStartTestCallback,
+                    judge_complete_callback: TJudgeCallback) -> None:
+        tests = iter(task.tests)
+
+        async def _run(container: str) -> None:
+            strm = await _attach(self._attach_params, container)
+            try:
+                await self._send(strm, _preparation_message(task))
+                for test in tests:
+                    if not start_test_callback(test.id):
+                        return
+                    await self._send(strm, {
+                        'type': 'Test',
+                        'input': test.input
+                    })
+                    resp = await self._recv(strm, AgentTestResult)
+                    judge_complete_callback(test, resp)
+            finally:
+                strm.close()
+
+        await asyncio.gather(
+            *[_run(c) for c in self._driver.test_containers])
@@ -1,16 +1,44 @@
+import asyncio
+from contextlib import ExitStack
 from datetime import timedelta
 from logging import getLogger
-from typing import Callable, Union, List, Tuple, Optional
+import struct
+from threading import Lock
+from time import monotonic
+from typing import (
+    Any, Callable, Dict, Union, List, Set, Tuple, Optional)
 
-from zstandard import ZstdDecompressor  # type: ignore
+from sqlalchemy import case, literal
+from sqlalchemy.dialects.postgresql import insert
+from zstandard import ZstdCompressor, ZstdDecompressor  # type: ignore
 
 from penguin_judge.check_result import equal_binary
+from penguin_judge.dataset import load_test_data
 from penguin_judge.models import (
-    JudgeStatus, Submission, JudgeResult, transaction, scoped_session)
+    JudgeStatus, Submission, JudgeResult, TestCase, CompileCache,
+    transaction, scoped_session)
+from penguin_judge.judge.cache import load as load_cache, store as store_cache
+from penguin_judge.ranking import update as update_standings
 from penguin_judge.judge import (
-    T, JudgeDriver, JudgeTask, JudgeTestInfo, AgentTestResult, AgentError)
+    T, AsyncJudgeDriver, JudgeDriver, JudgeTask, JudgeTestInfo,
+    AgentTestResult, AgentError, CompileResult)
+from penguin_judge.utils import content_hash
 
 LOGGER = getLogger(__name__)
+_config: Dict[str, Any] = {
+    'result_flush_tests': 10,
+    'result_flush_interval': 1000,  # ms
+    'test_cache_dir': None,
+    'test_data_mmap': True,
+    'compile_cache_dir': None,
+    'compile_cache_db': False,
+}
+_COMPILE_CACHE_HEADER = struct.Struct('<d')  # コンパイル時間(秒)
+TResult = Tuple[JudgeStatus, Optional[timedelta], Optional[int]]
+
+
+def configure(**kwargs: Any) -> None:
+    _config.update(kwargs)
 
 
 def run(judge_class: Callable[[], JudgeDriver],
@@ -18,17 +46,29 @@ def run(judge_class: Callable[[], JudgeDriver],
     LOGGER.info('judge start (contest_id: {}, problem_id: {}, '
                 'submission_id: {}, user_id: {}'.format(
                     task.contest_id, task.problem_id, task.id, task.user_id))
+    # キャッシュのマップはジャッジ完了まで保持する
+    with ExitStack() as stack:
+        ret = _run(judge_class, task, stack)
+    LOGGER.info('judge finished (submission_id={}): {}'.format(task.id, ret))
+    return ret
+
+
+def _run(judge_class: Callable[[], JudgeDriver], task: JudgeTask,
+         stack: ExitStack) -> JudgeStatus:
     zctx = ZstdDecompressor()
     try:
         task.code = zctx.decompress(task.code)
-        for test in task.tests:
-            test.input = zctx.decompress(test.input)
-            test.output = zctx.decompress(test.output)
+        _load_tests(task, zctx, stack)
     except Exception:
         LOGGER.warning('decompress failed', exc_info=True)
-        with transaction() as s:
-            return _update_submission_status(s, task,
-                                             JudgeStatus.InternalError)
+        return _internal_error(task)
+    compile_cache_key = None
+    if task.compile_image_name:
+        compile_cache_key = content_hash(
+            task.compile_image_name.encode('utf8') + b'\0' + task.code)
+        if _load_compiled(task, compile_cache_key):
+            # コンパイル済みのためコンパイル用コンテナを起動しない
+            task.compile_image_name = None
     with judge_class() as judge:
         ret = _prepare(judge, task)
         if ret:
@@ -37,20 +77,166 @@ def run(judge_class: Callable[[], JudgeDriver],
             ret = _compile(judge, task)
             if ret:
                 return ret
-        ret = _tests(judge, task)
+            assert compile_cache_key and task.compile_time
+            _store_compiled(compile_cache_key, task.code, task.compile_time)
+        return _tests(judge, task)
+
+
+def _load_compiled(task: JudgeTask, key: str) -> bool:
+    # ワーカーのキャッシュ、DBの順にコンパイル済みバイナリを探す
+    cache_dir = _config['compile_cache_dir']
+    try:
+        data = cache_dir and load_cache(cache_dir, key)
+        if not data and _config['compile_cache_db']:
+            with transaction() as s:
+                row = s.query(
+                    CompileCache.binary, CompileCache.compile_time
+                ).filter(CompileCache.key == key).first()
+            if row:
+                data = _COMPILE_CACHE_HEADER.pack(
+                    row.compile_time.total_seconds()
+                ) + ZstdDecompressor().decompress(row.binary)
+                if cache_dir:
+                    store_cache(cache_dir, key, data)
+    except Exception:
+        LOGGER.warning('cannot load compile cache', exc_info=True)
+        return False
+    if not data:
+        return False
+    # 提出のコンパイル時間には最初にコンパイルした時の値を記録する
+    task.compile_time = timedelta(
+        seconds=_COMPILE_CACHE_HEADER.unpack_from(data)[0])
+    task.code = bytes(data[_COMPILE_CACHE_HEADER.size:])
+    return True
+
+
+def _store_compiled(key: str, binary: bytes, compile_time: timedelta) -> None:
+    cache_dir = _config['compile_cache_dir']
+    try:
+        if cache_dir:
+            store_cache(cache_dir, key, _COMPILE_CACHE_HEADER.pack(
+                compile_time.total_seconds()) + binary)
+        if _config['compile_cache_db']:
+            with transaction() as s:
+                s.execute(insert(CompileCache.__table__).values(
+                    key=key, binary=ZstdCompressor().compress(binary),
+                    compile_time=compile_time,
+                ).on_conflict_do_nothing(index_elements=['key']))
+    except Exception:
+        LOGGER.warning('cannot store compile cache', exc_info=True)
+
+
+async def run_async(judge_class: Callable[[], AsyncJudgeDriver],
+                    task: JudgeTask) -> JudgeStatus:
+    """run()と同じ処理をイベントループ上で行う
+
+    ドライバーの入出力はイベントループで処理し、DBへのアクセスや
+    データの読み込みはスレッドで実行するため、1プロセスで複数の提出を
+    並行してジャッジできる"""
+    LOGGER.info('judge start (contest_id: {}, problem_id: {}, '
+                'submission_id: {}, user_id: {}'.format(
+                    task.contest_id, task.problem_id, task.id, task.user_id))
+    with ExitStack() as stack:
+        ret = await _run_async(judge_class, task, stack)
     LOGGER.info('judge finished (submission_id={}): {}'.format(task.id, ret))
     return ret
 
 
+async def _run_async(judge_class: Callable[[], AsyncJudgeDriver],
+                     task: JudgeTask, stack: ExitStack) -> JudgeStatus:
+    loop = asyncio.get_event_loop()
+
+    def _load() -> Optional[str]:
+        zctx = ZstdDecompressor()
+        task.code = zctx.decompress(task.code)
+        _load_tests(task, zctx, stack)
+        if not task.compile_image_name:
+            return None
+        key = content_hash(
+            task.compile_image_name.encode('utf8') + b'\0' + task.code)
+        if _load_compiled(task, key):
+            task.compile_image_name = None
+        return key
+
+    try:
+        compile_cache_key = await loop.run_in_executor(None, _load)
+    except Exception:
+        LOGGER.warning('decompress failed', exc_info=True)
+        return await loop.run_in_executor(None, _internal_error, task)
+    async with judge_class() as judge:
+        try:
+            await judge.prepare(task)
+        except Exception:
+            LOGGER.warning('prepare failed', exc_info=True)
+            return await loop.run_in_executor(None, _internal_error, task)
+        if task.compile_image_name:
+            try:
+                compiled = await judge.compile(task)
+            except Exception:
+                LOGGER.warning('compile failed', exc_info=True)
+                compiled = JudgeStatus.InternalError
+            ret = await loop.run_in_executor(
+                None, _compile_done, task, compiled)
+            if ret:
+                return ret
+            assert compile_cache_key and task.compile_time
+            await loop.run_in_executor(
+                None, _store_compiled, compile_cache_key, task.code,
+                task.compile_time)
+        results = _TestResults(task, loop=loop)
+        try:
+            await judge.tests(task, results.start, results.complete)
+        except Exception:
+            results.failed()
+        await results.writer.wait()
+        return await loop.run_in_executor(None, results.finish)
+
+
+def _load_tests(task: JudgeTask, zctx: ZstdDecompressor,
+                stack: ExitStack) -> None:
+    # ワーカーのキャッシュに展開済みのデータを読み込む。
+    # キャッシュから削除されていた場合はDB(またはblobストア)から取得する
+    cache_dir = _config['test_cache_dir']
+    map_stack = stack if _config['test_data_mmap'] else None
+    missing = []
+    for test in task.tests:
+        if test.input or test.output:  # 圧縮済みデータが直接渡された場合
+            test.input = zctx.decompress(test.input)
+            test.output = zctx.decompress(test.output)
+            continue
+        in_data = out_data = None
+        if cache_dir and test.input_hash and test.output_hash:
+            in_data = load_cache(cache_dir, test.input_hash, map_stack)
+            out_data = load_cache(cache_dir, test.output_hash, map_stack)
+        if in_data is None or out_data is None:
+            missing.append(test)
+            continue
+        test.input, test.output = in_data, out_data
+    if not missing:
+        return
+    tests = {test.id: test for test in missing}
+    with transaction() as s:
+        rows = s.query(
+            TestCase.id, TestCase.input, TestCase.input_hash,
+            TestCase.output, TestCase.output_hash).filter(
+                TestCase.contest_id == task.contest_id,
+                TestCase.problem_id == task.problem_id,
+                TestCase.id.in_(list(tests.keys()))).all()
+    for test_id, in_data, in_hash, out_data, out_hash in rows:
+        test = tests.pop(test_id)
+        test.input = load_test_data(in_data, in_hash)
+        test.output = load_test_data(out_data, out_hash)
+    if tests:
+        raise RuntimeError('test data not found: {}'.format(list(tests)))
+
+
 def _prepare(judge: JudgeDriver, task: JudgeTask) -> Union[JudgeStatus, None]:
     try:
         judge.prepare(task)
         return None
     except Exception:
         LOGGER.warning('prepare failed', exc_info=True)
-        with transaction() as s:
-            return _update_submission_status(
-                s, task, JudgeStatus.InternalError)
+        return _internal_error(task)
 
 
 def _compile(judge: JudgeDriver, task: JudgeTask) -> Union[JudgeStatus, None]:
@@ -59,6 +245,11 @@ def _compile(judge: JudgeDriver, task: JudgeTask) -> Union[JudgeStatus, None]:
     except Exception:
         LOGGER.warning('compile failed', exc_info=True)
         ret = JudgeStatus.InternalError
+    return _compile_done(task, ret)
+
+
+def _compile_done(task: JudgeTask, ret: Union[JudgeStatus, CompileResult]
+                  ) -> Union[JudgeStatus, None]:
     if isinstance(ret, JudgeStatus):
         with transaction() as s:
             _update_submission_status(s, task, ret)
@@ -75,14 +266,122 @@ def _compile(judge: JudgeDriver, task: JudgeTask) -> Union[JudgeStatus, None]:
     return None
 
 
-def _tests(judge: JudgeDriver, task: JudgeTask) -> JudgeStatus:
-    judge_results: List[
-        Tuple[JudgeStatus, Optional[timedelta], Optional[int]]] = []
+def _internal_error(task: JudgeTask) -> JudgeStatus:
+    with transaction() as s:
+        return _update_submission_status(s, task, JudgeStatus.InternalError)
+
+
+class _ResultWriter(object):
+    """テストケースの状態更新をバッファリングし、
+    一定件数または一定時間ごとに1回のUPDATEでJudgeResultに書き込む"""
+
+    def __init__(self, task: JudgeTask, flush_tests: int,
+                 flush_interval: float,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self._task = task
+        self._flush_tests = flush_tests
+        self._flush_interval = flush_interval
+        self._pending: Dict[str, TResult] = {}
+        self._last_flush = monotonic()
+        # イベントループを指定した場合はループを止めないように
+        # 書き込みをスレッドで順番に実行する
+        self._loop = loop
+        self._last_write: Optional[asyncio.Future] = None
+
+    def put(self, test_id: str, status: JudgeStatus,
+            time: Optional[timedelta] = None,
+            memory_kb: Optional[int] = None) -> None:
+        """書き込みを予約せずにバッファに追加する(次のflush()で書き込む)"""
+        # 同じテストケースの未書き込みの状態(Running等)は上書きする
+        self._pending[test_id] = (status, time, memory_kb)
+
+    def set(self, test_id: str, status: JudgeStatus,
+            time: Optional[timedelta] = None,
+            memory_kb: Optional[int] = None) -> None:
+        # イベントループを指定した場合はループのスレッドから呼ぶこと
+        self.put(test_id, status, time, memory_kb)
+        if (len(self._pending) < self._flush_tests and
+                monotonic() - self._last_flush < self._flush_interval):
+            return
+        if not self._loop:
+            with transaction() as s:
+                self.flush(s)
+            return
+        self._last_flush = monotonic()
+        pending, self._pending = self._pending, {}
+        self._last_write = asyncio.ensure_future(
+            self._write_after(self._last_write, pending), loop=self._loop)
+
+    async def _write_after(self, prev: Optional[asyncio.Future],
+                           pending: Dict[str, TResult]) -> None:
+        if prev:
+            await prev
+        await self._loop.run_in_executor(  # type: ignore
+            None, self._write_in_transaction, pending)
+
+    def _write_in_transaction(self, pending: Dict[str, TResult]) -> None:
+        with transaction() as s:
+            self._write(s, pending)
+
+    async def wait(self) -> None:
+        # flush()の前にバックグラウンドの書き込みの完了を待つ
+        if self._last_write:
+            await self._last_write
+
+    def flush(self, s: scoped_session) -> None:
+        self._last_flush = monotonic()
+        pending, self._pending = self._pending, {}
+        self._write(s, pending)
 
-    def judge_test_cmpl(
-            test: JudgeTestInfo,
-            resp: Union[AgentTestResult, AgentError]
-    ) -> None:
+    def _write(self, s: scoped_session, pending: Dict[str, TResult]) -> None:
+        if not pending:
+            return
+
+        def _case(idx: int, column: Any) -> Any:
+            return case({
+                test_id: literal(v[idx], column.type)
+                for test_id, v in pending.items()
+            }, value=JudgeResult.test_id, else_=column)
+        s.query(JudgeResult).filter(
+            JudgeResult.contest_id == self._task.contest_id,
+            JudgeResult.problem_id == self._task.problem_id,
+            JudgeResult.submission_id == self._task.id,
+            JudgeResult.test_id.in_(list(pending.keys())),
+        ).update({
+            JudgeResult.status: _case(0, JudgeResult.status),
+            JudgeResult.time: _case(1, JudgeResult.time),
+            JudgeResult.memory: _case(2, JudgeResult.memory),
+        }, synchronize_session=False)
+
+
+class _TestResults(object):
+    """ドライバーからのコールバックを受けてテスト結果を集計する"""
+
+    def __init__(self, task: JudgeTask,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.task = task
+        self.results: List[TResult] = []
+        self.writer = _ResultWriter(
+            task, _config['result_flush_tests'],
+            _config['result_flush_interval'] / 1000, loop=loop)
+        self._started: Set[str] = set()
+        self._failed = False
+        # 並列実行時はコールバックが複数スレッドから呼ばれる
+        self._lock = Lock()
+
+    def start(self, test_id: str) -> bool:
+        with self._lock:
+            max_failures = self.task.max_failures
+            n_failures = sum(
+                1 for x, _, _ in self.results if x != JudgeStatus.Accepted)
+            if max_failures and n_failures >= max_failures:
+                return False
+            self._started.add(test_id)
+            self.writer.set(test_id, JudgeStatus.Running)
+            return True
+
+    def complete(self, test: JudgeTestInfo,
+                 resp: Union[AgentTestResult, AgentError]) -> None:
         time: Optional[timedelta] = None
         memory_kb: Optional[int] = None
         if isinstance(resp, AgentTestResult):
@@ -96,74 +395,79 @@ def _tests(judge: JudgeDriver, task: JudgeTask) -> JudgeStatus:
                 status = JudgeStatus.WrongAnswer
         else:
             status = JudgeStatus.from_str(resp.kind)
-        judge_results.append((status, time, memory_kb))
-        with transaction() as s:
-            s.query(JudgeResult).filter(
-                JudgeResult.contest_id == task.contest_id,
-                JudgeResult.problem_id == task.problem_id,
-                JudgeResult.submission_id == task.id,
-                JudgeResult.test_id == test.id,
-            ).update({
-                JudgeResult.status: status,
-                JudgeResult.time: time,
-                JudgeResult.memory: memory_kb,
-            }, synchronize_session=False)
+        with self._lock:
+            self.results.append((status, time, memory_kb))
+            self.writer.set(test.id, status, time, memory_kb)
+
+    def failed(self) -> None:
+        LOGGER.warning('test failed (submission_id={})'.format(
+            self.task.id), exc_info=True)
+        self.results.append((JudgeStatus.InternalError, None, None))
+        self._failed = True
+
+    def finish(self) -> JudgeStatus:
+        task, judge_results = self.task, self.results
+        if not self._failed:
+            # 打ち切ったテストは実行しなかったことを記録する。
+            # 非同期モードではループ外のスレッドで呼ばれるため、書き込みを
+            # 予約せずに最後のflush()でまとめて書き込む
+            for test in task.tests:
+                if test.id not in self._started:
+                    self.writer.put(test.id, JudgeStatus.Skipped)
+
+        def get_submission_status() -> JudgeStatus:
+            judge_status = set([s for s, _, _ in judge_results])
+            if len(judge_status) == 1:
+                return list(judge_status)[0]
+            for x in (JudgeStatus.InternalError, JudgeStatus.RuntimeError,
+                      JudgeStatus.WrongAnswer,
+                      JudgeStatus.MemoryLimitExceeded,
+                      JudgeStatus.TimeLimitExceeded,
+                      JudgeStatus.OutputLimitExceeded):
+                if x in judge_status:
+                    return x
+            return JudgeStatus.InternalError  # pragma: no cover
+
+        def max_value(lst: List[T]) -> Optional[T]:
+            ret = None
+            for x in lst:
+                if x is None:
+                    continue
+                if ret is None or ret < x:
+                    ret = x
+            return ret
+
+        submission_status = get_submission_status()
+        max_time = max_value([t for _, t, _ in judge_results])
+        max_memory = max_value([m for _, _, m in judge_results])
 
-    def start_test_func(test_id: str) -> None:
         with transaction() as s:
-            s.query(JudgeResult).filter(
-                JudgeResult.contest_id == task.contest_id,
-                JudgeResult.problem_id == task.problem_id,
-                JudgeResult.submission_id == task.id,
-                JudgeResult.test_id == test_id,
+            self.writer.flush(s)
+            s.query(Submission).filter(
+                Submission.contest_id == task.contest_id,
+                Submission.problem_id == task.problem_id,
+                Submission.id == task.id
             ).update({
-                JudgeResult.status: JudgeStatus.Running
+                Submission.status: submission_status,
+                Submission.lease_hostname: None,
+                Submission.lease_pid: None,
+                Submission.lease_expires: None,
+                Submission.compile_time: task.compile_time,
+                Submission.max_time: max_time,
+                Submission.max_memory: max_memory,
             }, synchronize_session=False)
+            update_standings(
+                s, task.contest_id, task.problem_id, [task.user_id])
+        return submission_status
+
 
+def _tests(judge: JudgeDriver, task: JudgeTask) -> JudgeStatus:
+    results = _TestResults(task)
     try:
-        judge.tests(task, start_test_func, judge_test_cmpl)
+        judge.tests(task, results.start, results.complete)
     except Exception:
-        LOGGER.warning(
-            'test failed (submission_id={})'.format(task.id), exc_info=True)
-        judge_results.append((JudgeStatus.InternalError, None, None))
-
-    def get_submission_status() -> JudgeStatus:
-        judge_status = set([s for s, _, _ in judge_results])
-        if len(judge_status) == 1:
-            return list(judge_status)[0]
-        for x in (JudgeStatus.InternalError, JudgeStatus.RuntimeError,
-                  JudgeStatus.WrongAnswer, JudgeStatus.MemoryLimitExceeded,
-                  JudgeStatus.TimeLimitExceeded,
-                  JudgeStatus.OutputLimitExceeded):
-            if x in judge_status:
-                return x
-        return JudgeStatus.InternalError  # pragma: no cover
-
-    def max_value(lst: List[T]) -> Optional[T]:
-        ret = None
-        for x in lst:
-            if x is None:
-                continue
-            if ret is None or ret < x:
-                ret = x
-        return ret
-
-    submission_status = get_submission_status()
-    max_time = max_value([t for _, t, _ in judge_results])
-    max_memory = max_value([m for _, _, m in judge_results])
-
-    with transaction() as s:
-        s.query(Submission).filter(
-            Submission.contest_id == task.contest_id,
-            Submission.problem_id == task.problem_id,
-            Submission.id == task.id
-        ).update({
-            Submission.status: submission_status,
-            Submission.compile_time: task.compile_time,
-            Submission.max_time: max_time,
-            Submission.max_memory: max_memory,
-        }, synchronize_session=False)
-    return submission_status
+        results.failed()
+    return results.finish()
 
 
 def _update_submission_status(
@@ -173,5 +477,9 @@ def _update_submission_status(
         Submission.contest_id == task.contest_id,
         Submission.problem_id == task.problem_id,
         Submission.id == task.id,
-    ).update({Submission.status: status}, synchronize_session=False)
+    ).update({
+        Submission.status: status, Submission.lease_hostname: None,
+        Submission.lease_pid: None, Submission.lease_expires: None,
+    }, synchronize_session=False)
+    update_standings(s, task.contest_id, task.problem_id, [task.user_id])
     return status
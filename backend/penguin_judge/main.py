@@ -1,8 +1,12 @@
 from argparse import ArgumentParser, Namespace
 from configparser import ConfigParser
+import os
 from os import sched_getaffinity
-from typing import Any, Callable, List, Mapping, Tuple
+from tempfile import gettempdir
+from typing import Any, Callable, Dict, List, Mapping, Tuple
 
+from penguin_judge.blob import (
+    configure as configure_blob, get_config as get_blob_config)
 from penguin_judge.models import configure, get_db_config
 from penguin_judge.mq import configure as configure_mq
 
@@ -28,26 +32,71 @@ def _load_config(args: Namespace, name: str,
     return ret
 
 
+def _bool_parser(s: str) -> bool:
+    return s.lower() == 'true'
+
+
 def _configure_app(config: Mapping[str, str]) -> None:
     from penguin_judge.api import app
 
-    def bool_parser(s: str) -> bool:
-        return s.lower() == 'true'
-
     defines: List[Tuple[str, str, Callable[[str], Any]]] = [
         ('user_judge_queue_limit', '10', int),
-        ('auth_required', 'False', bool_parser),
+        ('rejudge_batch_size', '100', int),  # 1メッセージにまとめる提出数
+        ('auth_required', 'False', _bool_parser),
+        ('token_cache_ttl', '0', float),  # sec
+        ('token_cache_size', '10000', int),
+        ('response_cache_ttl', '0', float),  # sec
+        ('response_cache_size', '1000', int),
+        ('count_cache_ttl', '0', float),  # sec
+        ('count_cache_size', '1000', int),
     ]
     for name, default_value, parser in defines:
         app.config[name] = parser(config.get(name, default_value))
 
 
+def _worker_options(config: Mapping[str, str]) -> Dict[str, Any]:
+    defines: List[Tuple[str, str, Callable[[str], Any]]] = [
+        ('result_flush_tests', '10', int),
+        ('result_flush_interval', '1000', int),  # ms
+        ('test_cache_dir',
+         os.path.join(gettempdir(), 'penguin_judge', 'tests'), str),
+        ('test_cache_size', '1024', int),  # MiB
+        ('test_data_mmap', 'True', _bool_parser),
+        ('container_pool_min', '0', int),
+        ('container_pool_max', '0', int),
+        ('container_pool_health_interval', '30', float),  # sec
+        ('test_parallelism', '1', int),
+        ('cpu_pinning', 'False', _bool_parser),
+        ('cpu_lock_dir',
+         os.path.join(gettempdir(), 'penguin_judge', 'cpus'), str),
+        ('compile_cache_dir',
+         os.path.join(gettempdir(), 'penguin_judge', 'compiled'), str),
+        ('compile_cache_size', '1024', int),  # MiB
+        ('compile_cache_db', 'False', _bool_parser),
+        ('compile_cache_db_ttl', '7', float),  # days
+        ('judge_mode', 'process', str),  # process/thread/async
+        # 優先度クラスごとのキューから取り出す比率
+        ('judge_queue_weights', 'submission:8,manual:4,rejudge:1', str),
+        ('judge_prefetch', 'True', _bool_parser),
+        ('lease_timeout', '300', float),  # sec
+        ('judge_prefetch_size', '256', int),  # MiB
+        ('adaptive_concurrency', 'False', _bool_parser),
+        ('adaptive_interval', '10', float),  # sec
+        ('min_processes', '1', int),
+        ('target_load', '1.0', float),  # CPUあたりのロードアベレージ
+        ('min_free_memory', '512', int),  # MiB
+    ]
+    return {name: parser(config.get(name, default_value))
+            for name, default_value, parser in defines}
+
+
 def start_api(args: Namespace) -> None:
     from gunicorn.app.base import BaseApplication  # type: ignore
     from penguin_judge.api import app
 
     config = _load_config(args, 'api')
     configure_mq(**config)
+    configure_blob(**config)
     _configure_app(config)
 
     class App(BaseApplication):
@@ -66,13 +115,44 @@ def start_api(args: Namespace) -> None:
 
 def start_worker(args: Namespace) -> None:
     from penguin_judge.worker import main as worker_main
-    config = _load_config(args, 'worker')
-    configure(**config)
-    configure_mq(**config)
+    config = dict(_load_config(args, 'worker'))
     max_processes = int(config.get('max_processes', 0))
     if max_processes <= 0:
         max_processes = len(sched_getaffinity(0))
-    worker_main(get_db_config(), max_processes)
+    if config.get('judge_mode') == 'thread':
+        # 全てのジャッジスレッドが同時にDBに接続できるようにする
+        config.setdefault('sqlalchemy.pool_size', str(max_processes))
+    configure(**config)
+    configure_mq(**config)
+    configure_blob(**config)
+    # blobストアの設定はジャッジプロセスにも渡す
+    options = _worker_options(config)
+    options.update(get_blob_config())
+    worker_main(get_db_config(), max_processes, options)
+
+
+def blob_command(args: Namespace) -> None:
+    from penguin_judge.blob import get_store
+    from penguin_judge.dataset import collect_garbage, migrate_to_store
+    config = _load_config(args, 'blob')
+    configure(**config)
+    configure_blob(**config)
+    store = get_store()
+    if store is None:
+        raise RuntimeError('config error: blob.backend must be file or s3')
+    if args.command == 'migrate':
+        print('migrated {} tests'.format(migrate_to_store(store)))
+    else:
+        print('removed {} blobs'.format(
+            collect_garbage(store, args.min_age)))
+
+
+def db_command(args: Namespace) -> None:
+    from penguin_judge.models import upgrade_indexes
+    configure(**_load_config(args, 'db'))
+    created = upgrade_indexes()
+    print('created {} indexes{}'.format(
+        len(created), ''.join(' ' + x for x in created)))
 
 
 def main() -> None:
@@ -92,6 +172,24 @@ def main() -> None:
         'worker', help='Judge Worker'))
     worker_parser.set_defaults(start=start_worker)
 
+    blob_parser = add_common_args(subparsers.add_parser(
+        'blob', help='Test data blob store maintenance'))
+    blob_parser.add_argument(
+        'command', choices=('migrate', 'gc'),
+        help='migrate: move test data in DB to the blob store, '
+        'gc: remove unreferenced blobs')
+    blob_parser.add_argument(
+        '--min-age', type=float, default=3600,
+        help='gc: keep blobs modified within this many seconds')
+    blob_parser.set_defaults(start=blob_command)
+
+    db_parser = add_common_args(subparsers.add_parser(
+        'db', help='Database maintenance'))
+    db_parser.add_argument(
+        'command', choices=('upgrade',),
+        help='upgrade: build missing or invalid indexes concurrently')
+    db_parser.set_defaults(start=db_command)
+
     args = parser.parse_args()
     if hasattr(args, 'start'):
         args.start(args)
@@ -1,11 +1,13 @@
 from contextlib import contextmanager
 import datetime
 import enum
-from typing import Dict, Iterator, Optional, List
+from operator import attrgetter
+from typing import Any, Callable, Dict, Iterator, Optional, List, Tuple
 
 from sqlalchemy import (
-    Boolean, Column, DateTime, Integer, String, LargeBinary, Interval, Enum,
-    func, ForeignKeyConstraint, Index)
+    BigInteger, Boolean, Column, DateTime, Integer, String, LargeBinary,
+    Interval, Enum, func, ForeignKeyConstraint, Index, inspect)
+from sqlalchemy.engine import Engine
 from sqlalchemy.exc import IntegrityError, ProgrammingError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
@@ -14,10 +16,48 @@ Base = declarative_base()
 Session = scoped_session(sessionmaker())
 _config: Dict[str, str] = {}
 
+# create_allは既存テーブルへのカラム追加等を行わないため、
+# 既存環境の移行用に冪等なDDLをここに列挙する
+_UPGRADE_STATEMENTS = [
+    'ALTER TABLE tests ADD COLUMN IF NOT EXISTS input_hash VARCHAR',
+    'ALTER TABLE tests ADD COLUMN IF NOT EXISTS output_hash VARCHAR',
+    'ALTER TABLE tests ADD COLUMN IF NOT EXISTS input_size BIGINT',
+    'ALTER TABLE tests ADD COLUMN IF NOT EXISTS output_size BIGINT',
+    'ALTER TABLE tests ALTER COLUMN input DROP NOT NULL',
+    'ALTER TABLE tests ALTER COLUMN output DROP NOT NULL',
+    'ALTER TABLE problems ADD COLUMN IF NOT EXISTS parallelism INTEGER',
+    'ALTER TABLE workers ADD COLUMN IF NOT EXISTS concurrency INTEGER',
+    'ALTER TABLE workers ADD COLUMN IF NOT EXISTS running INTEGER',
+    'ALTER TABLE workers ADD COLUMN IF NOT EXISTS queued INTEGER',
+    'ALTER TABLE problems ADD COLUMN IF NOT EXISTS max_failures INTEGER',
+    "ALTER TYPE judgestatus ADD VALUE IF NOT EXISTS 'Skipped'",
+    'ALTER TABLE submissions ADD COLUMN IF NOT EXISTS lease_hostname VARCHAR',
+    'ALTER TABLE submissions ADD COLUMN IF NOT EXISTS lease_pid INTEGER',
+    'ALTER TABLE submissions ADD COLUMN IF NOT EXISTS '
+    'lease_expires TIMESTAMP WITH TIME ZONE',
+    'ALTER TABLE submissions ADD COLUMN IF NOT EXISTS lease_priority VARCHAR',
+]
+
+# 既存環境に追加するインデックス(名前, 定義)。稼働中の環境で書き込みを
+# 止めないようにCONCURRENTLYで作成するため、各プロセスのconfigure()では
+# 実行せず`penguin_judge db -c config.ini upgrade`で実行する(upgrade_indexes)
+_UPGRADE_INDEXES = [
+    ('submissions_contest_created_idx',
+     'ON submissions (contest_id, created, id)'),
+    ('submissions_contest_user_created_idx',
+     'ON submissions (contest_id, user_id, created, id)'),
+    ('submissions_pending_user_idx',
+     "ON submissions (user_id) WHERE status IN ('Waiting', 'Running')"),
+    ('judge_results_submission_idx', 'ON judge_results (submission_id)'),
+    ('submissions_lease_idx',
+     'ON submissions (lease_expires) WHERE lease_expires IS NOT NULL'),
+]
+
 
 class JudgeStatus(enum.Enum):
     Waiting = 0x00
     Running = 0x01
+    Skipped = 0x02  # 打ち切りにより実行しなかったテスト
     Accepted = 0x10
     CompilationError = 0x20
     RuntimeError = 0x21
@@ -42,15 +82,39 @@ class _Exportable(object):
         datetime.datetime, datetime.timedelta, enum.Enum)
 
     def to_dict(self, *, keys: Optional[List[str]] = None) -> dict:
-        if not keys:
-            keys = [k for k in dir(self) if not k.startswith('_')]
-        return {
-            k: getattr(self, k) for k in keys
-            if isinstance(getattr(self, k), self.VALID_TYPES)}
+        cache_key = (type(self), tuple(keys) if keys else None)
+        f = _exporters.get(cache_key)
+        if f is None:
+            f = _exporters[cache_key] = self._compile_exporter(cache_key[1])
+        return f(self)
 
     def to_summary_dict(self) -> dict:
         return self.to_dict(keys=getattr(self, '__summary_keys__', None))
 
+    @classmethod
+    def _compile_exporter(cls, keys: Optional[Tuple[str, ...]]
+                          ) -> Callable[[Any], dict]:
+        # 行ごとにdir()で属性を列挙しないように、カラム定義からキーを求めて
+        # 全ての値を1回のattrgetterで取り出す関数を生成する。
+        # キーの順序は従来のdir()と同じ名前順にする
+        if keys is None:
+            keys = tuple(sorted(
+                attr.key for attr in inspect(cls).column_attrs))
+        valid_types = cls.VALID_TYPES
+        getter = attrgetter(*keys)
+        if len(keys) == 1:
+            key = keys[0]
+            return lambda obj: {
+                k: v for k, v in ((key, getter(obj)),)
+                if isinstance(v, valid_types)}
+        return lambda obj: {
+            k: v for k, v in zip(keys, getter(obj))  # type: ignore
+            if isinstance(v, valid_types)}
+
+
+_exporters: Dict[Tuple[type, Optional[Tuple[str, ...]]],
+                 Callable[[Any], dict]] = {}
+
 
 class User(Base, _Exportable):
     __tablename__ = 'users'
@@ -118,7 +182,8 @@ class Contest(Base, _Exportable):
 class Problem(Base, _Exportable):
     __tablename__ = 'problems'
     __updatable_keys__ = [
-        'title', 'description', 'time_limit', 'memory_limit', 'score']
+        'title', 'description', 'time_limit', 'memory_limit', 'score',
+        'parallelism', 'max_failures']
     contest_id = Column(String, primary_key=True)
     id = Column(String, primary_key=True)
     title = Column(String, nullable=False)
@@ -126,6 +191,9 @@ class Problem(Base, _Exportable):
     memory_limit = Column(Integer, nullable=False)  # MiB
     description = Column(String, nullable=False)
     score = Column(Integer, nullable=False)
+    parallelism = Column(Integer, nullable=True)  # 未指定時はワーカーの設定値
+    # 不正解のテストがこの数に達したら残りのテストを打ち切る(未指定時は全て実行)
+    max_failures = Column(Integer, nullable=True)
     __table_args__ = (
         ForeignKeyConstraint([contest_id], [Contest.id]),  # type: ignore
     )
@@ -136,8 +204,14 @@ class TestCase(Base, _Exportable):
     contest_id = Column(String, primary_key=True)
     problem_id = Column(String, primary_key=True)
     id = Column(String, primary_key=True)
-    input = Column(LargeBinary, nullable=False)
-    output = Column(LargeBinary, nullable=False)
+    # zstdで圧縮したデータ。blobストアに保存した場合はNULLとなり、
+    # ハッシュ値をキーとしてストアから読み込む
+    input = Column(LargeBinary, nullable=True)
+    output = Column(LargeBinary, nullable=True)
+    input_hash = Column(String, nullable=True)  # 展開後のデータのSHA-256
+    output_hash = Column(String, nullable=True)
+    input_size = Column(BigInteger, nullable=True)  # 展開後のサイズ
+    output_size = Column(BigInteger, nullable=True)
     __table_args__ = (
         ForeignKeyConstraint([contest_id, problem_id],  # type: ignore
                              [Problem.contest_id, Problem.id]),
@@ -164,6 +238,13 @@ class Submission(Base, _Exportable):
     max_memory = Column(Integer, nullable=True)  # KiB
     created = Column(
         DateTime(timezone=True), server_default=func.now(), nullable=False)
+    # ジャッジ中のワーカー(workersテーブルのキー)とリースの期限。
+    # 期限切れのリースはワーカーが再度キューに積む
+    lease_hostname = Column(String, nullable=True)
+    lease_pid = Column(Integer, nullable=True)
+    lease_expires = Column(DateTime(timezone=True), nullable=True)
+    # 取り出したキューの優先度クラス。回収時に同じキューへ積み直す
+    lease_priority = Column(String, nullable=True)
     __table_args__ = (
         ForeignKeyConstraint(
             [contest_id, problem_id],  # type: ignore
@@ -173,6 +254,16 @@ class Submission(Base, _Exportable):
         ForeignKeyConstraint(
             [environment_id], [Environment.id]),  # type: ignore
         Index('submissions_contest_problem_idx', contest_id, problem_id),
+        # 提出一覧のキーセットによるページング用(既定の並び順は作成日時順)
+        Index('submissions_contest_created_idx', contest_id, created, id),
+        Index('submissions_contest_user_created_idx',
+              contest_id, user_id, created, id),
+        # 投稿時のジャッジ待ち件数の確認用(待ちの提出はごく一部なので部分索引)
+        Index('submissions_pending_user_idx', user_id,
+              postgresql_where=status.in_([
+                  JudgeStatus.Waiting, JudgeStatus.Running])),
+        Index('submissions_lease_idx', lease_expires,
+              postgresql_where=lease_expires.isnot(None)),
     )
 
     def is_accessible(self, contest: Contest,
@@ -200,9 +291,51 @@ class JudgeResult(Base, _Exportable):
         ForeignKeyConstraint(
             [contest_id, problem_id, test_id],  # type: ignore
             [TestCase.contest_id, TestCase.problem_id, TestCase.id]),
+        # 主キーの先頭はcontest_idなので提出IDのみでの参照用に別途作成する
+        Index('judge_results_submission_idx', submission_id),
     )
 
 
+class Standing(Base, _Exportable):
+    # 順位表のセル(ユーザ×問題)をコンテスト期間内の提出から集計した結果
+    __tablename__ = 'standings'
+    contest_id = Column(String, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    problem_id = Column(String, primary_key=True)
+    first_submission_id = Column(Integer, nullable=False)
+    penalties = Column(Integer, nullable=False)
+    pending = Column(Boolean, nullable=False)
+    accepted = Column(DateTime(timezone=True), nullable=True)
+    __table_args__ = (
+        ForeignKeyConstraint(
+            [contest_id, problem_id],  # type: ignore
+            [Problem.contest_id, Problem.id]),
+        ForeignKeyConstraint(
+            [user_id], [User.id]),  # type: ignore
+    )
+
+
+class StandingsState(Base, _Exportable):
+    # standingsを構築したときのコンテスト期間
+    # (期間が変更された場合は再構築が必要)
+    __tablename__ = 'standings_states'
+    contest_id = Column(String, primary_key=True)
+    start_time = Column(DateTime(timezone=True), nullable=False)
+    end_time = Column(DateTime(timezone=True), nullable=False)
+    __table_args__ = (
+        ForeignKeyConstraint([contest_id], [Contest.id]),  # type: ignore
+    )
+
+
+class CompileCache(Base, _Exportable):
+    __tablename__ = 'compile_cache'
+    key = Column(String, primary_key=True)  # コードとコンパイル用イメージ名のハッシュ
+    binary = Column(LargeBinary, nullable=False)  # zstd圧縮済み
+    compile_time = Column(Interval, nullable=False)
+    created = Column(DateTime(timezone=True), server_default=func.now(),
+                     nullable=False)
+
+
 class Worker(Base, _Exportable):
     __tablename__ = 'workers'
     hostname = Column(String, primary_key=True)
@@ -212,6 +345,9 @@ class Worker(Base, _Exportable):
     last_contact = Column(DateTime(timezone=True), nullable=False)
     processed = Column(Integer, nullable=False)
     errors = Column(Integer, nullable=False)
+    concurrency = Column(Integer, nullable=True)  # 現在の同時実行数の上限
+    running = Column(Integer, nullable=True)
+    queued = Column(Integer, nullable=True)  # 受信済み(先読み)で未処理の数
 
 
 def configure(**kwargs: str) -> None:
@@ -225,6 +361,7 @@ def configure(**kwargs: str) -> None:
     while True:
         try:
             Base.metadata.create_all(engine)
+            _upgrade_schema(engine)
             break
         except (IntegrityError, ProgrammingError):
             # 同時起動した別プロセスがテーブル作成中なのでリトライ
@@ -235,6 +372,45 @@ def configure(**kwargs: str) -> None:
     _insert_initial_data()
 
 
+def _upgrade_schema(engine: Engine) -> None:
+    # ALTER TYPE ... ADD VALUEはトランザクション内で実行できないため
+    # 1文ずつ自動コミットで実行する
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        for stmt in _UPGRADE_STATEMENTS:
+            conn.execute(stmt)
+
+
+def upgrade_indexes() -> List[str]:
+    """_UPGRADE_INDEXESのうち存在しないインデックスを作成し、作成した名前を返す
+
+    作成が中断されて無効(indisvalid = false)のまま残ったインデックスは
+    IF NOT EXISTSでは作り直されないため、削除してから作成する"""
+    engine = Session.get_bind()
+    created = []
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        # 同時に実行された場合に同じインデックスを並行して作成しない
+        conn.execute(
+            "SELECT pg_advisory_lock(hashtext('penguin_judge.upgrade'))")
+        try:
+            for name, definition in _UPGRADE_INDEXES:
+                valid = conn.execute(
+                    'SELECT indisvalid FROM pg_index '
+                    'WHERE indexrelid = to_regclass(%s)', (name,)).scalar()
+                if valid:
+                    continue
+                if valid is not None:
+                    conn.execute('DROP INDEX CONCURRENTLY {}'.format(name))
+                conn.execute('CREATE INDEX CONCURRENTLY {} {}'.format(
+                    name, definition))
+                created.append(name)
+        finally:
+            conn.execute(
+                "SELECT pg_advisory_unlock(hashtext('penguin_judge.upgrade'))")
+    return created
+
+
 def get_db_config() -> Dict[str, str]:
     return _config
 
@@ -1,14 +1,185 @@
-from typing import Optional
+from contextlib import contextmanager
+import os
+from queue import LifoQueue, Empty, Full
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, Optional, Set
 
-from pika import URLParameters  # type: ignore
+import pika  # type: ignore
+from pika import BasicProperties, URLParameters  # type: ignore
+from pika.adapters.blocking_connection import BlockingChannel  # type: ignore
+from pika.exceptions import AMQPError  # type: ignore
+
+JUDGE_QUEUE = 'judge_queue'
+# ジャッジキューの優先度クラス。クラスごとに別のキューを使い、
+# ワーカーが重み付きで取り出す(penguin_judge.scheduler)
+PRIORITY_SUBMISSION = 'submission'  # コンテスト中の提出
+PRIORITY_MANUAL = 'manual'  # tools/mq_enqueue.py等による手動投入
+PRIORITY_REJUDGE = 'rejudge'
+PRIORITY_CLASSES = (PRIORITY_SUBMISSION, PRIORITY_MANUAL, PRIORITY_REJUDGE)
 
 _mq_url: Optional[str] = None
+_pool_size = 4
+_confirm = False
+_publisher: Optional['Publisher'] = None
+_publisher_lock = Lock()
 
 
 def configure(**kwargs: str) -> None:
-    global _mq_url
+    global _mq_url, _pool_size, _confirm
     _mq_url = kwargs['mq.url']
+    _pool_size = int(kwargs.get('mq.publisher_pool_size', _pool_size))
+    _confirm = kwargs.get('mq.publisher_confirms', 'False').lower() == 'true'
 
 
 def get_mq_conn_params() -> URLParameters:
     return URLParameters(_mq_url)
+
+
+def judge_queue_name(priority: str) -> str:
+    # 提出用は既存の環境との互換性のため従来のキュー名を使う
+    if priority == PRIORITY_SUBMISSION:
+        return JUDGE_QUEUE
+    return '{}.{}'.format(JUDGE_QUEUE, priority)
+
+
+def priority_of_queue(queue: str) -> str:
+    for priority in PRIORITY_CLASSES:
+        if judge_queue_name(priority) == queue:
+            return priority
+    return PRIORITY_SUBMISSION
+
+
+class _PooledChannel(object):
+    def __init__(self, confirm: bool) -> None:
+        self.conn = pika.BlockingConnection(get_mq_conn_params())
+        self.ch = self.conn.channel()
+        if confirm:
+            # publisher confirmsの代わりにトランザクションを使う。
+            # バッチ全体をtx_commitの1往復でブローカーに確定させられる
+            self.ch.tx_select()
+        self.declared: Set[str] = set()
+
+    def declare(self, queue: str) -> None:
+        if queue not in self.declared:
+            self.ch.queue_declare(queue=queue)
+            self.declared.add(queue)
+
+    def close(self) -> None:
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+class Publisher(object):
+    """APIプロセス内で使い回すRabbitMQへの接続プール
+
+    BlockingConnectionはスレッドセーフではないため、
+    1接続1チャネルを単位として貸し出す"""
+
+    def __init__(self, pool_size: int = 4, confirm: bool = False) -> None:
+        self._pool: LifoQueue = LifoQueue(maxsize=pool_size)
+        self._confirm = confirm
+        self.pid = os.getpid()
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except Empty:
+                return
+
+    def _checkout(self) -> _PooledChannel:
+        while True:
+            try:
+                c = self._pool.get_nowait()
+            except Empty:
+                return _PooledChannel(self._confirm)
+            try:
+                # 放置中に溜まったハートビートやクローズ通知を処理して
+                # 切断済みの接続を検出する
+                c.conn.process_data_events(0)
+                if c.conn.is_open and c.ch.is_open:
+                    return c
+            except Exception:
+                pass
+            c.close()
+
+    def _checkin(self, c: _PooledChannel) -> None:
+        try:
+            self._pool.put_nowait(c)
+        except Full:
+            c.close()
+
+    @contextmanager
+    def channel(self) -> Iterator[BlockingChannel]:
+        c = self._checkout()
+        try:
+            yield c.ch
+        except BaseException:
+            c.close()
+            raise
+        self._checkin(c)
+
+    def publish(self, body: bytes, routing_key: str = JUDGE_QUEUE,
+                headers: Optional[dict] = None) -> None:
+        self.publish_batch(
+            [body], routing_key=routing_key,
+            headers=None if headers is None else [headers])
+
+    def publish_batch(self, bodies: Iterable[bytes],
+                      routing_key: str = JUDGE_QUEUE,
+                      headers: Optional[Iterable[dict]] = None) -> None:
+        """headersを指定する場合はbodiesと同じ順序で各メッセージの
+        ヘッダを指定する"""
+        bodies = list(bodies)
+        if not bodies:
+            return
+        properties: List[Optional[BasicProperties]] = [None] * len(bodies)
+        if headers is not None:
+            properties = [BasicProperties(headers=h) for h in headers]
+        retry = True
+        while True:
+            c = self._checkout()
+            published = 0
+            try:
+                c.declare(routing_key)
+                for body, props in zip(bodies, properties):
+                    c.ch.basic_publish(
+                        exchange='', routing_key=routing_key, body=body,
+                        properties=props)
+                    published += 1
+                if self._confirm:
+                    c.ch.tx_commit()
+            except AMQPError:
+                c.close()
+                # トランザクション未使用時に一部を送信済みの場合は
+                # 重複を避けるため再送しない
+                if not retry or (published and not self._confirm):
+                    raise
+                retry = False
+                continue
+            except BaseException:
+                c.close()
+                raise
+            self._checkin(c)
+            return
+
+
+def get_publisher() -> Publisher:
+    # gunicornのfork後に親プロセスの接続を共有しないようにPIDで区別する
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None or _publisher.pid != os.getpid():
+            _publisher = Publisher(pool_size=_pool_size, confirm=_confirm)
+        return _publisher
+
+
+def queue_depths() -> Dict[str, int]:
+    """優先度クラスごとのジャッジキューに積まれているメッセージ数を返す"""
+    ret = {}
+    with get_publisher().channel() as ch:
+        for priority in PRIORITY_CLASSES:
+            queue = ch.queue_declare(queue=judge_queue_name(priority))
+            ret[priority] = queue.method.message_count
+    return ret
@@ -0,0 +1,158 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import datetime
+import json
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, bindparam, false, or_, text, tuple_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Query
+
+from penguin_judge.cache import TTLCache
+from penguin_judge.models import scoped_session
+
+TOrder = List[Tuple[Any, bool]]  # (カラム, 降順かどうか)
+
+# EXPLAINの推定行数を取得するため、パラメータを:name形式で埋め込む
+_NAMED_DIALECT = postgresql.dialect(paramstyle='named')
+
+
+def encode_cursor(order: TOrder, values: List[Any], backward: bool) -> str:
+    """ページの先頭/末尾の行のソートキーを不透明なカーソル文字列にする"""
+    def _encode(v: Any) -> Any:
+        if isinstance(v, datetime.datetime):
+            return v.isoformat()
+        if isinstance(v, datetime.timedelta):
+            return v.total_seconds()
+        return v
+    return urlsafe_b64encode(json.dumps([
+        'p' if backward else 'n', _signature(order),
+        [_encode(v) for v in values]], separators=(',', ':')).encode(
+            'utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(order: TOrder, cursor: str) -> Tuple[List[Any], bool]:
+    """(ソートキーの値, 前のページかどうか)を返す。不正な場合はValueError"""
+    try:
+        direction, signature, raw = json.loads(urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError('invalid cursor')
+    if (direction not in ('n', 'p') or signature != _signature(order) or
+            not isinstance(raw, list) or len(raw) != len(order)):
+        raise ValueError('cursor does not match the sort order')
+    values: List[Any] = []
+    for (col, _), v in zip(order, raw):
+        if v is None:
+            values.append(None)
+            continue
+        t = col.type.python_type
+        if t is datetime.datetime:
+            v = datetime.datetime.fromisoformat(v)
+        elif t is datetime.timedelta:
+            v = datetime.timedelta(seconds=v)
+        elif not isinstance(v, t):
+            raise ValueError('invalid cursor')
+        values.append(v)
+    return values, direction == 'p'
+
+
+def _signature(order: TOrder) -> List[str]:
+    return [('-' if desc else '') + col.key for col, desc in order]
+
+
+def _after(col: Any, desc: bool, v: Any) -> Any:
+    # PostgreSQLの既定(ASCはNULLが最後, DESCはNULLが最初)の順序で
+    # vより後ろに来る行の条件
+    nullable = col.expression.nullable
+    if desc:
+        if v is None:
+            return col.isnot(None)
+        return col < v
+    if v is None:
+        return false()
+    return or_(col > v, col.is_(None)) if nullable else col > v
+
+
+def _keyset_filter(order: TOrder, values: List[Any]) -> Any:
+    if len(set(desc for _, desc in order)) == 1 and not any(
+            col.expression.nullable for col, _ in order):
+        # 全て同じ向きでNULLを含まない場合は行値の比較にして
+        # 複合インデックスの範囲スキャンにする
+        cols, vals = tuple_(*[c for c, _ in order]), tuple_(*values)
+        return cols < vals if order[0][1] else cols > vals
+    clauses = []
+    for i, (col, desc) in enumerate(order):
+        eqs = [c.is_(None) if v is None else c == v
+               for (c, _), v in zip(order[:i], values[:i])]
+        clauses.append(and_(*eqs, _after(col, desc, values[i])))
+    return or_(*clauses)
+
+
+def _order_by(order: TOrder) -> List[Any]:
+    return [col.desc() if desc else col for col, desc in order]
+
+
+def count(s: scoped_session, q: Query, mode: str,
+          cache: Optional[TTLCache] = None) -> Optional[int]:
+    """modeが'exact'の場合はCOUNT(cacheがあればキャッシュする)、
+    'estimate'の場合はプランナの推定行数、'none'の場合はNoneを返す"""
+    if mode == 'none':
+        return None
+    q = q.order_by(None)
+    compiled = q.statement.compile(dialect=_NAMED_DIALECT)
+    if mode == 'estimate':
+        stmt = text('EXPLAIN (FORMAT JSON) ' + compiled.string).bindparams(*[
+            bindparam(k, v, type_=compiled.binds[k].type)
+            for k, v in compiled.params.items()])
+        plan = s.execute(stmt).scalar()
+        return int(plan[0]['Plan']['Plan Rows'])
+    key = (compiled.string, tuple(sorted(compiled.params.items())))
+    ret: Optional[int] = cache.get(key) if cache else None
+    if ret is None:
+        ret = q.count()
+        if cache:
+            cache.put(key, ret)
+    return ret
+
+
+def paginate(q: Query, order: TOrder, per_page: int, *,
+             page: Optional[int] = None, cursor: Optional[str] = None,
+             entity: Callable[[Any], Any] = lambda x: x
+             ) -> Tuple[List[Any], Dict[str, str]]:
+    """ページ番号(OFFSET)またはカーソル(キーセット)で1ページ分の行を取得し、
+    (行, 前後のページのカーソルのヘッダ)を返す
+
+    orderの最後は一意なキー(id等)にすること。
+    entityには行からソートキーを持つモデルを取り出す関数を指定する"""
+    backward = False
+    if cursor is not None:
+        values, backward = decode_cursor(order, cursor)
+        # 前のページは逆順に取得してから並べ直す
+        fetch_order = [(c, d != backward) for c, d in order]
+        q = q.filter(_keyset_filter(fetch_order, values))
+    else:
+        fetch_order = order
+    q = q.order_by(*_order_by(fetch_order))
+    if cursor is None and page is not None and page > 1:
+        q = q.offset((page - 1) * per_page)
+    rows = q.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backward:
+        rows.reverse()
+    has_next = has_more if not backward else True
+    has_prev = (has_more if backward else
+                cursor is not None or (page is not None and page > 1))
+
+    def _values(row: Any) -> List[Any]:
+        obj = entity(row)
+        return [getattr(obj, col.key) for col, _ in order]
+
+    headers = {}
+    if rows and has_next:
+        headers['X-Next-Cursor'] = encode_cursor(
+            order, _values(rows[-1]), False)
+    if rows and has_prev:
+        headers['X-Prev-Cursor'] = encode_cursor(
+            order, _values(rows[0]), True)
+    return rows, headers
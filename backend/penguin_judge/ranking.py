@@ -0,0 +1,181 @@
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from sqlalchemy import exists
+from sqlalchemy.dialects.postgresql import insert
+
+from penguin_judge.models import (
+    scoped_session, Contest, JudgeStatus, Problem, Standing, StandingsState,
+    Submission, User)
+
+TSubmission = Tuple[int, datetime, JudgeStatus]  # (id, created, status)
+TCell = Tuple[int, int, bool, Optional[datetime]]
+
+
+def _summarize(submissions: List[TSubmission]) -> TCell:
+    # 1問分の提出(作成日時順)から
+    # (最初の提出ID, ペナルティ数, ジャッジ待ちの有無, 最初のACの提出日時)を求める
+    n_penalties = 0
+    has_pending = False
+    accepted: Optional[datetime] = None
+    for (_, submit_time, submit_status) in submissions:
+        if submit_status == JudgeStatus.Accepted:
+            accepted = submit_time
+            break
+        elif submit_status in (JudgeStatus.Waiting, JudgeStatus.Running):
+            has_pending = True
+        elif submit_status not in (
+                JudgeStatus.CompilationError, JudgeStatus.InternalError):
+            n_penalties += 1
+    first_id = min(x[0] for x in submissions)
+    return first_id, n_penalties, has_pending, accepted
+
+
+def _query_cells(
+        s: scoped_session, contest_id: str, start_time: datetime,
+        end_time: datetime, problem_id: Optional[str] = None,
+        user_ids: Optional[List[int]] = None
+) -> Dict[Tuple[int, str], TCell]:
+    q = s.query(
+        Submission.user_id, Submission.problem_id, Submission.id,
+        Submission.created, Submission.status,
+    ).filter(
+        Submission.contest_id == contest_id,
+        Submission.created >= start_time,
+        Submission.created < end_time,
+    )
+    if problem_id is not None:
+        q = q.filter(Submission.problem_id == problem_id)
+    if user_ids is not None:
+        q = q.filter(Submission.user_id.in_(user_ids))
+    rows = sorted(q, key=lambda x: (x[0], x[1], x[3], x[2]))
+    return {
+        key: _summarize([(sid, t, st) for _, _, sid, t, st in items])
+        for key, items in groupby(rows, key=lambda x: (x[0], x[1]))}
+
+
+def _upsert_cells(s: scoped_session, contest_id: str,
+                  cells: Dict[Tuple[int, str], TCell]) -> None:
+    if not cells:
+        return
+    stmt = insert(Standing.__table__).values([dict(
+        contest_id=contest_id, user_id=uid, problem_id=pid,
+        first_submission_id=first_id, penalties=penalties, pending=pending,
+        accepted=accepted,
+    ) for (uid, pid), (first_id, penalties, pending, accepted)
+        in cells.items()])
+    s.execute(stmt.on_conflict_do_update(
+        index_elements=['contest_id', 'user_id', 'problem_id'],
+        set_=dict(
+            first_submission_id=stmt.excluded.first_submission_id,
+            penalties=stmt.excluded.penalties,
+            pending=stmt.excluded.pending,
+            accepted=stmt.excluded.accepted)))
+
+
+def update(s: scoped_session, contest_id: str, problem_id: str,
+           user_ids: Optional[Iterable[int]] = None) -> None:
+    """Submission.statusを変更したトランザクション内で呼び出し、
+    該当するユーザ(省略時は全ユーザ)×問題のセルを再集計する"""
+    # 順位表の構築と競合しないように共有ロックを取得する。
+    # 未構築の場合は次回の参照時に構築されるので何もしない
+    state = s.query(StandingsState).with_for_update(read=True).filter(
+        StandingsState.contest_id == contest_id).first()
+    if not state:
+        return
+    uids = None if user_ids is None else list(set(user_ids))
+    cells = _query_cells(
+        s, contest_id, state.start_time, state.end_time,
+        problem_id=problem_id, user_ids=uids)
+    q = s.query(Standing).filter(
+        Standing.contest_id == contest_id,
+        Standing.problem_id == problem_id)
+    if uids is not None:
+        q = q.filter(Standing.user_id.in_(uids))
+    stale = [uid for (uid,) in q.with_entities(Standing.user_id)
+             if (uid, problem_id) not in cells]
+    if stale:
+        q.filter(Standing.user_id.in_(stale)).delete(
+            synchronize_session=False)
+    _upsert_cells(s, contest_id, cells)
+
+
+def _build(s: scoped_session, contest: Contest) -> None:
+    inserted = s.execute(insert(StandingsState.__table__).values(
+        contest_id=contest.id, start_time=contest.start_time,
+        end_time=contest.end_time,
+    ).on_conflict_do_nothing(index_elements=['contest_id'])).rowcount
+    state = s.query(StandingsState).with_for_update().filter(
+        StandingsState.contest_id == contest.id).one()
+    if not inserted and (state.start_time, state.end_time) == (
+            contest.start_time, contest.end_time):
+        return  # ロック待ちの間に別のプロセスが構築済み
+    state.start_time = contest.start_time
+    state.end_time = contest.end_time
+    s.query(Standing).filter(Standing.contest_id == contest.id).delete(
+        synchronize_session=False)
+    _upsert_cells(s, contest.id, _query_cells(
+        s, contest.id, contest.start_time, contest.end_time))
+    s.flush()
+
+
+def get_rankings(s: scoped_session, contest: Contest) -> List[dict]:
+    state = s.query(StandingsState).filter(
+        StandingsState.contest_id == contest.id).first()
+    if not state or (state.start_time, state.end_time) != (
+            contest.start_time, contest.end_time):
+        _build(s, contest)
+
+    contest_penalty = contest.penalty
+    contest_start_time = contest.start_time
+
+    problems = {p.id: p.score for p in s.query(
+        Problem.id, Problem.score).filter(Problem.contest_id == contest.id)}
+
+    users: Dict[int, dict] = {}
+    q = s.query(Standing, User.name).filter(
+        Standing.contest_id == contest.id,
+        Standing.user_id == User.id,
+    ).order_by(Standing.user_id)
+    for uid, items in groupby(q, key=lambda x: x[0].user_id):
+        cells = sorted(items, key=lambda x: x[0].problem_id)
+        max_time = contest_start_time
+        total_score = 0
+        total_penalties = 0
+        ret: dict = dict(user_id=uid, user_name=cells[0][1], problems={})
+        for cell, _ in cells:
+            tmp: Dict[str, Union[float, int, timedelta, bool]] = {}
+            if cell.accepted is not None:
+                tmp['time'] = cell.accepted - contest_start_time
+                score = tmp['score'] = problems[cell.problem_id]
+                max_time = max(max_time, cell.accepted)
+                total_score += score
+                total_penalties += cell.penalties
+            tmp['penalties'] = cell.penalties
+            tmp['pending'] = cell.pending
+            ret['problems'][cell.problem_id] = tmp
+        total_time = max_time - contest_start_time
+        ret.update(dict(
+            time=total_time, score=total_score, penalties=total_penalties,
+            adjusted_time=total_time + total_penalties * contest_penalty))
+        users[min(c.first_submission_id for c, _ in cells)] = ret
+
+    # 提出順(最初の提出ID順)に並べてから安定ソートする
+    results = [users[k] for k in sorted(users.keys())]
+    results.sort(key=lambda x: (-x['score'], x['adjusted_time']))
+    ranking = 0
+    for i, r in enumerate(results):
+        if i == 0 or results[i - 1]['score'] != 0:  # 0点の人は同じ順位とする
+            ranking += 1
+        r['ranking'] = ranking
+
+    # 一度も提出していない人をランキング末尾に同じ順位で追加
+    ranking += 1
+    for (uid,) in s.query(User.id).filter(
+            User.admin.is_(False),
+            ~exists().where(Standing.contest_id == contest.id).where(
+                Standing.user_id == User.id)
+    ).order_by(User.id):
+        results.append(dict(ranking=ranking, user_id=uid, problems={}))
+    return results
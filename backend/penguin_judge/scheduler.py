@@ -0,0 +1,98 @@
+from collections import OrderedDict, deque
+from typing import (
+    Any, Deque, Dict, Generic, Iterable, List, Optional, TypeVar)
+
+T = TypeVar('T')
+
+
+def parse_weights(s: str) -> Dict[str, int]:
+    """'submission:8,rejudge:1'形式の重みの指定を読み込む"""
+    ret = {}
+    for item in s.split(','):
+        if not item.strip():
+            continue
+        name, weight = item.split(':')
+        if int(weight) <= 0:
+            raise ValueError('weight must be positive: {}'.format(item))
+        ret[name.strip()] = int(weight)
+    return ret
+
+
+class _Class(Generic[T]):
+    def __init__(self, weight: int) -> None:
+        self.weight = weight
+        self.current = 0
+        self.size = 0
+        # ユーザごとの待ち行列。先頭のユーザから1件ずつ取り出して末尾に回す
+        self.users: 'OrderedDict[Any, Deque[T]]' = OrderedDict()
+
+
+class FairScheduler(Generic[T]):
+    """優先度クラス間は重み付きラウンドロビン(smooth weighted round-robin)、
+    クラス内はユーザ間のラウンドロビンで次に実行するタスクを選ぶ
+
+    重みの小さいクラス(リジャッジ等)も止まることはなく、
+    1人のユーザが大量に提出しても他のユーザのタスクが先に実行される"""
+
+    def __init__(self, weights: Dict[str, int]) -> None:
+        self._classes: Dict[str, _Class[T]] = {
+            k: _Class(v) for k, v in weights.items()}
+
+    def __len__(self) -> int:
+        return sum(c.size for c in self._classes.values())
+
+    def depth(self) -> Dict[str, int]:
+        return {k: c.size for k, c in self._classes.items()}
+
+    def push(self, priority: str, user_id: Any, item: T) -> None:
+        c = self._classes.get(priority)
+        if c is None:  # 未知のクラスは重み1として扱う
+            c = self._classes[priority] = _Class(1)
+        c.users.setdefault(user_id, deque()).append(item)
+        c.size += 1
+
+    def pop(self) -> Optional[T]:
+        return _pop(self._classes.values())
+
+    def peek(self, n: int) -> List[T]:
+        """次にpopで取り出されるn件を取り出さずに返す"""
+        classes = []
+        for c in self._classes.values():
+            copied: _Class[T] = _Class(c.weight)
+            copied.current, copied.size = c.current, c.size
+            copied.users = OrderedDict(
+                (k, deque(v)) for k, v in c.users.items())
+            classes.append(copied)
+        ret: List[T] = []
+        while len(ret) < n:
+            item = _pop(classes)
+            if item is None:
+                break
+            ret.append(item)
+        return ret
+
+    def clear(self) -> None:
+        for c in self._classes.values():
+            c.current = c.size = 0
+            c.users.clear()
+
+
+def _pop(classes: Iterable[_Class[T]]) -> Optional[T]:
+    candidates = [c for c in classes if c.size]
+    if not candidates:
+        return None
+    total = 0
+    for c in candidates:
+        c.current += c.weight
+        total += c.weight
+    selected = max(candidates, key=lambda c: c.current)
+    selected.current -= total
+
+    user_id, items = next(iter(selected.users.items()))
+    item = items.popleft()
+    if items:
+        selected.users.move_to_end(user_id)
+    else:
+        del selected.users[user_id]
+    selected.size -= 1
+    return item
@@ -1,9 +1,15 @@
 from base64 import b64encode
 import datetime
 from enum import Enum
-from typing import Any, Union
+from hashlib import sha256
+from typing import Any, Callable, Dict, Optional, Union
 import json
 
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None  # type: ignore
+
 
 class _JsonEncoder(json.JSONEncoder):
     def default(self, o: Any) -> Union[str, float]:
@@ -18,16 +24,59 @@ class _JsonEncoder(json.JSONEncoder):
         return super().default(o)
 
 
-def json_dumps(o: Union[dict, list]) -> str:
+# orjsonはEnumを値で出力し、datetimeをタイムゾーンを変換せずに出力するため
+# _JsonEncoderと同じ出力になるように事前に変換する
+_NATIVE_TYPES = {str, int, float, bool, type(None)}
+_CONVERTERS: Dict[type, Callable[[Any], Any]] = {
+    datetime.datetime: lambda o: o.astimezone(tz=datetime.timezone.utc),
+    datetime.timedelta: lambda o: o.total_seconds(),
+    bytes: lambda o: b64encode(o).decode('ascii'),
+}
+
+
+def _to_orjson_native(o: Any) -> Any:
+    t = type(o)
+    if t is dict:
+        return {k: v if type(v) in _NATIVE_TYPES else _to_orjson_native(v)
+                for k, v in o.items()}
+    if t is list:
+        return [v if type(v) in _NATIVE_TYPES else _to_orjson_native(v)
+                for v in o]
+    f = _CONVERTERS.get(t)
+    if f is None:
+        if isinstance(o, Enum):
+            f = _CONVERTERS[t] = lambda o: o.name
+        elif isinstance(o, datetime.datetime):  # psycopg2等のサブクラス
+            f = _CONVERTERS[datetime.datetime]
+        else:
+            return o
+    return f(o)
+
+
+def json_dumps(o: Union[dict, list]) -> bytes:
+    # orjsonがインストールされている場合はorjsonを使う
+    # (非ASCII文字をエスケープしない以外は同じ出力となる)
     if isinstance(o, dict):
         o = {k: v for k, v in o.items() if not k.startswith('_')}
-    return json.dumps(o, cls=_JsonEncoder, separators=(',', ':'))
+    if orjson is not None:
+        return orjson.dumps(
+            _to_orjson_native(o), option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        o, cls=_JsonEncoder, separators=(',', ':')).encode('utf-8')
+
+
+def pagination_header(count: Optional[int], page: Optional[int],
+                      per_page: int) -> dict:
+    # 件数を求めなかった場合(count=None)やカーソルによるページングの場合
+    # (page=None)は該当するヘッダを省略する
+    ret: Dict[str, Any] = {'X-Per-Page': per_page}
+    if page is not None:
+        ret['X-Page'] = page
+    if count is not None:
+        ret['X-Total'] = count
+        ret['X-Total-Pages'] = (count + (per_page - 1)) // per_page
+    return ret
 
 
-def pagination_header(count: int, page: int, per_page: int) -> dict:
-    return {
-        'X-Page': page,
-        'X-Per-Page': per_page,
-        'X-Total': count,
-        'X-Total-Pages': (count + (per_page - 1)) // per_page,
-    }
+def content_hash(data: bytes) -> str:
+    return sha256(data).hexdigest()
@@ -1,60 +1,178 @@
 import asyncio
-from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures import (
+    Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor)
 from datetime import timedelta
 import multiprocessing as mp
 from functools import partial
-from typing import Any, Optional
-import pickle
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 from random import shuffle, uniform
 from socket import gethostname
+from time import monotonic
 import os
 from logging import getLogger
 
+import docker  # type: ignore
 import pika  # type: ignore
 from pika.channel import Channel  # type: ignore
 from pika.exceptions import AMQPError  # type: ignore
 from pika.adapters.asyncio_connection import AsyncioConnection  # type: ignore
-from sqlalchemy import func
+from sqlalchemy import and_, func
+from sqlalchemy.dialects.postgresql import insert
+from zstandard import ZstdDecompressor  # type: ignore
 
+from penguin_judge.dataset import load_test_data
+from penguin_judge.autoscale import (
+    available_memory, host_load, next_concurrency)
 from penguin_judge.models import (
     Environment, Problem, Submission, JudgeStatus, JudgeResult, TestCase,
-    Worker as WorkerTable, transaction)
-from penguin_judge.mq import get_mq_conn_params
-from penguin_judge.judge import JudgeTask, JudgeTestInfo
-from penguin_judge.judge.docker import DockerJudgeDriver
-from penguin_judge.judge.main import run
+    CompileCache, Worker as WorkerTable, transaction, scoped_session)
+from penguin_judge.mq import (
+    PRIORITY_CLASSES, PRIORITY_SUBMISSION, Publisher, get_mq_conn_params,
+    judge_queue_name, priority_of_queue)
+from penguin_judge.ranking import update as update_standings
+from penguin_judge.scheduler import FairScheduler, parse_weights
+from penguin_judge.job import JudgeJob, decode_job, encode_job, make_job
+from penguin_judge.judge import JudgeDriver, JudgeTask, JudgeTestInfo
+from penguin_judge.judge.cache import DiskCache
+from penguin_judge.judge.docker import (
+    AsyncDockerJudgeDriver, ContainerPool, DockerJudgeDriver)
+from penguin_judge.judge.main import run, run_async
+from penguin_judge.utils import content_hash
 
 LOGGER = getLogger(__name__)
+# 1回のメンテナンスでキューに積み直す期限切れのリースの最大数
+REAP_BATCH_SIZE = 100
+TFuture = Union[Future, asyncio.Future]
+
+
+class _Delivery(object):
+    """受信した1つのメッセージ。含まれる全ての提出の処理が終わったらackする"""
+
+    def __init__(self, ch: Channel, delivery_tag: int, count: int,
+                 priority: str = PRIORITY_SUBMISSION) -> None:
+        self._ch = ch
+        self.priority = priority
+        self._delivery_tag = delivery_tag
+        self._remaining = count
+        if count == 0:
+            self._ack()
+
+    def done(self) -> None:
+        self._remaining -= 1
+        if self._remaining == 0:
+            self._ack()
+
+    def _ack(self) -> None:
+        self._ch.basic_ack(delivery_tag=self._delivery_tag)
+
+
+TMessage = Tuple[_Delivery, JudgeJob, int]  # (メッセージ, ジョブ, 提出ID)
 
 
 class Worker(object):
-    def __init__(self, db_config: dict, max_processes: int) -> None:
+    def __init__(self, db_config: dict, max_processes: int,
+                 options: dict) -> None:
         self._max_processes = max_processes
-        self._executor = ProcessPoolExecutor(
-            max_workers=max_processes,
-            mp_context=mp.get_context('spawn'),
-            initializer=partial(_initializer, db_config))
-        self._queue_name = 'judge_queue'
+        self._executor: Optional[Executor] = None
+        self._async_mode = options['judge_mode'] == 'async'
+        self._judge_class: Callable[[], JudgeDriver] = DockerJudgeDriver
+        self._docker_client: Any = None
+        if self._async_mode:
+            # ジャッジもこのプロセスのイベントループ上で実行する
+            _configure_judge(options)
+        elif options['judge_mode'] == 'thread':
+            # ジャッジの大半はDocker/DBの待ちなので、子プロセスを使わずに
+            # スレッドで実行してDBの接続プールとDockerクライアントを共有する
+            _configure_judge(options)
+            # 各ジャッジはテストを並列に実行するため、その分と
+            # コンテナプール/先読みが使う接続を確保する
+            self._docker_client = docker.APIClient(
+                max_pool_size=max_processes * options['test_parallelism'] + 2)
+            self._judge_class = partial(
+                DockerJudgeDriver, self._docker_client)
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_processes, thread_name_prefix='judge')
+        else:
+            self._executor = ProcessPoolExecutor(
+                max_workers=max_processes,
+                mp_context=mp.get_context('spawn'),
+                initializer=partial(_initializer, db_config, options))
+        self._queue_names = [judge_queue_name(p) for p in PRIORITY_CLASSES]
+        # 受信したメッセージは優先度クラスとユーザごとに振り分けて保持し、
+        # 空きができたときに重み付きで選んだものから処理する
+        self._scheduler: FairScheduler[TMessage] = FairScheduler(
+            parse_weights(options['judge_queue_weights']))
+        self._running = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # 同時に処理する数。adaptive_concurrencyが有効な場合は
+        # [min_processes, max_processes]の範囲で負荷に応じて増減する。
+        # プロセスプールはmax_processesで作成し、投入する数のみを制限する
+        self._concurrency = max_processes
+        self._prefetch = 0
+        self._consumer_tags: List[str] = []
+        self._queue_depths: Dict[str, int] = {}
         self._conn: AsyncioConnection = None
         self._ch: Channel = None
         self._hostname: Optional[str] = None
         self._pid = os.getpid()
         self._task_processed, self._task_errors = 0, 0
         self._maint_interval = timedelta(seconds=60)
+        self._options = options
+        self._test_cache = DiskCache(
+            options['test_cache_dir'], options['test_cache_size'] * 2**20)
+        # コンパイル済みバイナリはジャッジプロセスが書き込み、
+        # 親プロセスが定期的に取り込んで上限サイズを超えた分を削除する
+        self._compile_cache = DiskCache(
+            options['compile_cache_dir'],
+            options['compile_cache_size'] * 2**20)
+        # 次に処理する提出のテストデータの展開とコンテナの作成を
+        # バックグラウンドで先に行う。値は先読みしたデータのバイト数
+        self._prefetcher: Optional[ThreadPoolExecutor] = None
+        if options['judge_prefetch']:
+            self._prefetcher = ThreadPoolExecutor(max_workers=1)
+        self._prefetched: Dict[int, int] = {}
+        # 提出の更新(行ロック)とテストデータの展開を行うスレッド
+        self._hydrator = ThreadPoolExecutor(
+            max_workers=min(max_processes, 4), thread_name_prefix='hydrate')
+        # このワーカーがリースを持つ(ジャッジ中の)提出ID
+        self._leased: Set[int] = set()
+        # 期限切れの提出の積み直し用。ブローカーが受け付けたことを確認
+        # してから提出の状態をコミットするためトランザクションを使う
+        self._requeue_publisher = Publisher(pool_size=1, confirm=True)
+        self._container_pool: Optional[ContainerPool] = None
+        if options['container_pool_max'] > 0:
+            client = self._docker_client
+            self._container_pool = ContainerPool(
+                options['container_pool_min'], options['container_pool_max'],
+                options['container_pool_health_interval'],
+                client_factory=(lambda: client) if client
+                else docker.APIClient)
 
     def __enter__(self) -> 'Worker':
         return self
 
     def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
-        self._executor.shutdown(wait=False)
+        if self._executor:
+            self._executor.shutdown(wait=False)
+        if self._prefetcher:
+            self._prefetcher.shutdown(wait=False)
+        self._hydrator.shutdown(wait=False)
+        if self._container_pool:
+            self._container_pool.close()
+        self._requeue_publisher.close()
+        if self._docker_client:
+            self._docker_client.close()
         if self._ch:
             self._ch.close()
         if self._conn:
             self._conn.close()
 
     def start(self) -> None:
+        self._loop = asyncio.get_event_loop()
         self._connect()
         asyncio.get_event_loop().call_soon_threadsafe(self._update_status)
+        if self._options['adaptive_concurrency']:
+            self._schedule_adjust_concurrency()
         asyncio.get_event_loop().run_forever()
 
     def _connect(self) -> None:
@@ -76,6 +194,9 @@ class Worker(object):
             last_contact=func.now(),
             processed=self._task_processed,
             errors=self._task_errors,
+            concurrency=self._concurrency,
+            running=self._running,
+            queued=len(self._scheduler),
         )
         try:
             hostname = self._hostname or gethostname()
@@ -96,11 +217,88 @@ class Worker(object):
                     s.query(WorkerTable).filter(
                         func.now() - WorkerTable.last_contact > threshold
                     ).delete(synchronize_session=False)
+                    if self._options['compile_cache_db']:
+                        ttl = timedelta(
+                            days=self._options['compile_cache_db_ttl'])
+                        s.query(CompileCache).filter(
+                            func.now() - CompileCache.created > ttl
+                        ).delete(synchronize_session=False)
             self._hostname = hostname
         except Exception:
             pass
+        try:
+            self._maintain_leases()
+        except Exception:
+            LOGGER.warning('cannot maintain leases', exc_info=True)
+        try:
+            self._compile_cache.scan()
+        except Exception:
+            LOGGER.warning('cannot scan compile cache', exc_info=True)
         self._schedule_update_status()
 
+    def _maintain_leases(self) -> None:
+        # ジャッジ中の提出のリースを延長し、期限切れのリースの提出
+        # (ジャッジ中のワーカーの停止)をキューに積み直す
+        lease = timedelta(seconds=self._options['lease_timeout'])
+        requeue: Dict[Tuple[str, str, str],
+                      List[Tuple[int, Optional[int]]]] = {}
+        with transaction() as s:
+            if self._leased:
+                s.query(Submission).filter(
+                    Submission.id.in_(list(self._leased)),
+                    Submission.lease_hostname == self._hostname,
+                    Submission.lease_pid == self._pid,
+                    Submission.status == JudgeStatus.Running,
+                ).update({Submission.lease_expires: func.now() + lease},
+                         synchronize_session=False)
+            if not (self._ch and self._ch.is_open):
+                return
+            # 他のワーカーが同時に回収している行は飛ばす
+            expired = s.query(
+                Submission.id, Submission.contest_id, Submission.problem_id,
+                Submission.user_id, Submission.lease_priority,
+            ).filter(
+                Submission.lease_expires < func.now(),
+                Submission.status == JudgeStatus.Running,
+            ).order_by(Submission.lease_expires).limit(
+                REAP_BATCH_SIZE).with_for_update(skip_locked=True).all()
+            if not expired:
+                return
+            # 待ちの間はリースを持たせない。キューが長く滞留しても
+            # 同じ提出を重複して積み直さないように、取り出されて
+            # Runningになった提出のみを回収の対象とする
+            s.query(Submission).filter(
+                Submission.id.in_([x[0] for x in expired])
+            ).update({
+                Submission.status: JudgeStatus.Waiting,
+                Submission.lease_hostname: None,
+                Submission.lease_pid: None,
+                Submission.lease_expires: None,
+                Submission.lease_priority: None,
+            }, synchronize_session=False)
+            # リジャッジ等が提出より優先されないよう元のキューに積み直す
+            for (submission_id, contest_id, problem_id, user_id,
+                 priority) in expired:
+                if priority not in PRIORITY_CLASSES:
+                    priority = PRIORITY_SUBMISSION
+                requeue.setdefault(
+                    (priority, contest_id, problem_id), []).append(
+                        (submission_id, user_id))
+            for (_, contest_id, problem_id), submissions in requeue.items():
+                update_standings(s, contest_id, problem_id, [
+                    u for _, u in submissions if u is not None])
+            # コミット前にブローカーへ確定させる。送信に失敗した場合は
+            # ロールバックされ、Runningのまま次回の回収対象になる。
+            # 送信後にコミットできなかった場合の重複はhydrate_taskが除く
+            for priority in PRIORITY_CLASSES:
+                self._requeue_publisher.publish_batch(
+                    [encode_job(make_job(contest_id, problem_id, submissions))
+                     for (p, contest_id, problem_id), submissions
+                     in requeue.items() if p == priority],
+                    routing_key=judge_queue_name(priority))
+        LOGGER.warning('requeued {} submissions with expired lease'.format(
+            sum(len(x) for x in requeue.values())))
+
     def _conn_on_open(self, _: AsyncioConnection) -> None:
         self._conn.channel(on_open_callback=self._ch_on_open)
 
@@ -118,8 +316,19 @@ class Worker(object):
     def _ch_on_open(self, ch: Channel) -> None:
         self._ch = ch
         ch.add_on_close_callback(self._ch_on_close)
-        ch.queue_declare(
-            queue=self._queue_name, callback=self._on_queue_declared)
+        # 切断前に受信したメッセージはブローカーによって再配送される
+        self._scheduler.clear()
+        self._prefetched.clear()
+        self._consumer_tags = []
+        self._declare_queues(self._queue_names)
+
+    def _declare_queues(self, names: List[str]) -> None:
+        if not names:
+            self._on_queue_declared()
+            return
+        self._ch.queue_declare(
+            queue=names[0],
+            callback=lambda _: self._declare_queues(names[1:]))
 
     def _ch_on_close(self, ch: Channel, reason: AMQPError) -> None:
         LOGGER.warning('RabbitMQ channel closed ({})'.format(reason))
@@ -128,33 +337,224 @@ class Worker(object):
         except Exception:
             pass
 
-    def _on_queue_declared(self, method: pika.frame.Method) -> None:
+    def _on_queue_declared(self) -> None:
+        self._set_prefetch()
+
+    def _set_prefetch(self) -> None:
+        # 先読み数はキュー(コンシューマ)ごとに適用されるため、
+        # 優先度の低いキューのメッセージで先読みが埋まることはない。
+        # 変更は以降に開始したコンシューマにのみ反映されるため作り直す
+        prefetch = self._concurrency
         self._ch.basic_qos(
-            prefetch_count=self._max_processes, callback=self._on_basic_qos_ok)
+            prefetch_count=prefetch, global_qos=False,
+            callback=lambda _: self._on_basic_qos_ok(prefetch))
+
+    def _on_basic_qos_ok(self, prefetch: int) -> None:
+        for tag in self._consumer_tags:
+            self._ch.basic_cancel(tag)
+        self._consumer_tags = [
+            self._ch.basic_consume(
+                name, on_message_callback=self._recv_message)
+            for name in self._queue_names]
+        self._prefetch = prefetch
+        LOGGER.info('Worker started (prefetch={})'.format(prefetch))
+
+    def _schedule_adjust_concurrency(self) -> None:
+        asyncio.get_event_loop().call_later(
+            self._options['adaptive_interval'], self._adjust_concurrency)
+
+    def _adjust_concurrency(self) -> None:
+        try:
+            backlog = len(self._scheduler) + sum(self._queue_depths.values())
+            concurrency = next_concurrency(
+                self._concurrency, min(self._options['min_processes'],
+                                       self._max_processes),
+                self._max_processes, backlog=backlog, running=self._running,
+                load=host_load(), free_memory=available_memory(),
+                target_load=self._options['target_load'],
+                min_free_memory=self._options['min_free_memory'] * 2**20)
+            if concurrency != self._concurrency:
+                LOGGER.info('concurrency: {} -> {} (backlog={})'.format(
+                    self._concurrency, concurrency, backlog))
+                self._concurrency = concurrency
+                self._dispatch()
+            if self._ch and self._ch.is_open:
+                if self._consumer_tags and self._prefetch != concurrency:
+                    self._set_prefetch()
+                # 次回の判断に使うブローカー上の待ち件数を取得する
+                for name in self._queue_names:
+                    self._ch.queue_declare(
+                        queue=name, passive=True,
+                        callback=partial(self._on_queue_depth, name))
+        except Exception:
+            LOGGER.warning('cannot adjust concurrency', exc_info=True)
+        self._schedule_adjust_concurrency()
 
-    def _on_basic_qos_ok(self, method: pika.frame.Method) -> None:
-        self._ch.basic_consume(
-            self._queue_name, on_message_callback=self._recv_message)
-        LOGGER.info('Worker started')
+    def _on_queue_depth(self, name: str, method: pika.frame.Method) -> None:
+        self._queue_depths[name] = method.method.message_count
 
     def _recv_message(
             self,
             ch: Channel,
             method: pika.spec.Basic.Return,
-            _: pika.spec.BasicProperties,
+            props: pika.spec.BasicProperties,
             body: bytes) -> None:
         try:
-            self._process(ch, method, body)
-        except Exception:
-            LOGGER.warning('', exc_info=True)
+            job = decode_job(body)
+        except ValueError:
+            LOGGER.warning('Received invalid message. ignored.', exc_info=True)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        # まとめて送られた提出も1件ずつスケジューラに積む
+        priority = priority_of_queue(method.routing_key)
+        delivery = _Delivery(
+            ch, method.delivery_tag, len(job.submissions), priority)
+        header_user_id = (props.headers or {}).get('user_id')
+        for submission_id, user_id in job.submissions:
+            self._scheduler.push(
+                priority, header_user_id if user_id is None else user_id,
+                (delivery, job, submission_id))
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self._running < self._concurrency:
+            msg = self._scheduler.pop()
+            if msg is None:
+                break
+            self._prefetched.pop(msg[2], None)
+            self._running += 1
+            release = self._releaser()
+            try:
+                self._process(*msg, release)
+            except Exception:
+                LOGGER.warning('', exc_info=True)
+                release()
+        self._prefetch_upcoming()
+
+    def _prefetch_upcoming(self) -> None:
+        # 空き枠ができたときにすぐ実行できるように、次に処理する
+        # prefetch_count件のテストデータを展開してキャッシュに入れ、
+        # コンテナを作成しておく(提出の状態は変更しない)
+        if not self._prefetcher or not self._loop:
+            return
+        upcoming = [
+            (job, submission_id) for _, job, submission_id
+            in self._scheduler.peek(self._prefetch)]
+        pending = [x for x in upcoming if x[1] not in self._prefetched]
+        if not pending:
+            return
+        free_memory = available_memory()
+        if (free_memory is not None and
+                free_memory < self._options['min_free_memory'] * 2**20):
+            return
+        budget = (self._options['judge_prefetch_size'] * 2**20 -
+                  sum(self._prefetched.values()))
+        for _, submission_id in pending:
+            self._prefetched[submission_id] = 0
+        future = self._loop.run_in_executor(
+            self._prefetcher, self._warm, upcoming, pending, budget)
+        future.add_done_callback(self._on_warmed)
+
+    def _on_warmed(self, future: 'asyncio.Future[Dict[int, int]]') -> None:
+        if future.exception() is not None:
+            LOGGER.warning('prefetch failed', exc_info=future.exception())
+            return
+        for submission_id, size in future.result().items():
+            if submission_id not in self._prefetched:
+                continue  # 先読み中に処理が始まった
+            if size < 0:
+                # 上限を超えるため先読みしなかった。次の機会に再度試みる
+                del self._prefetched[submission_id]
+            else:
+                self._prefetched[submission_id] = size
+
+    def _warm(self, upcoming: List[Tuple[JudgeJob, int]],
+              pending: List[Tuple[JudgeJob, int]],
+              budget: int) -> Dict[int, int]:
+        """先読みスレッドで実行する。提出IDごとに新たにキャッシュに入れた
+        データのバイト数(budgetを超えるため先読みしなかった場合は-1)を返す"""
+        timer = _Timer()
+        ret: Dict[int, int] = {}
+        with transaction() as s:
+            for job, submission_id in pending:
+                tests = [
+                    JudgeTestInfo(id=test_id, input_hash=input_hash,
+                                  output_hash=output_hash)
+                    for test_id, input_hash, output_hash in s.query(
+                        TestCase.id, TestCase.input_hash,
+                        TestCase.output_hash,
+                    ).filter(TestCase.contest_id == job.contest_id,
+                             TestCase.problem_id == job.problem_id)]
+                size = self._fill_test_cache(
+                    s, job.contest_id, job.problem_id, tests, budget)
+                ret[submission_id] = size
+                if size >= 0:
+                    budget -= size
+            timer.lap('tests')
+            if self._container_pool:
+                self._reserve_containers(s, upcoming)
+                timer.lap('containers')
+        LOGGER.info('prefetched {} submissions ({})'.format(
+            len(pending), timer))
+        return ret
+
+    def _reserve_containers(
+            self, s: scoped_session,
+            upcoming: List[Tuple[JudgeJob, int]]) -> None:
+        # 実行予定の提出が使うイメージのコンテナをその件数分用意させる
+        assert self._container_pool
+        env_ids = dict(s.query(
+            Submission.id, Submission.environment_id
+        ).filter(Submission.id.in_([x[1] for x in upcoming])))
+        counts: Dict[Tuple[str, bool], int] = {}
+        for job, submission_id in upcoming:
+            env_id = env_ids.get(submission_id)
+            if env_id is None:
+                continue
+            images = job.environment(env_id) or s.query(
+                Environment.compile_image_name, Environment.test_image_name
+            ).filter(Environment.id == env_id).first()
+            if images is None:
+                continue
+            compile_image_name, test_image_name = images
+            if compile_image_name:
+                key = (compile_image_name, True)
+                counts[key] = counts.get(key, 0) + 1
+            key = (test_image_name, False)
+            counts[key] = counts.get(key, 0) + 1
+        for (image, compile), count in counts.items():
+            self._container_pool.reserve(image, count, compile=compile)
+
+    def _releaser(self) -> Callable[[], None]:
+        # ジャッジの完了時(別スレッドの場合もある)に1回だけ枠を返す
+        released = False
+
+        def _release() -> None:
+            nonlocal released
+            if released:
+                return
+            released = True
+            assert self._loop
+            self._loop.call_soon_threadsafe(self._on_release)
+        return _release
+
+    def _on_release(self) -> None:
+        self._running -= 1
+        self._dispatch()
 
     def _process(
             self,
-            ch: Channel,
-            method: pika.spec.Basic.Return,
-            body: bytes) -> None:
-        def _done(fut: Optional[Future]) -> None:
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            delivery: _Delivery,
+            job: JudgeJob,
+            submission_id: int,
+            release: Callable[[], None]) -> None:
+        def _done(fut: Optional[TFuture]) -> None:
+            # ジャッジの完了時は別スレッドから呼ばれる場合がある
+            assert self._loop
+            self._loop.call_soon_threadsafe(delivery.done)
+            self._loop.call_soon_threadsafe(
+                self._leased.discard, submission_id)
+            release()
             if fut is None:
                 return
             self._task_processed += 1
@@ -163,85 +563,288 @@ class Worker(object):
             elif fut.result() == JudgeStatus.InternalError:
                 self._task_errors += 1
 
-        try:
-            contest_id, problem_id, submission_id = pickle.loads(body)
-        except Exception:
-            LOGGER.warning('Received invalid message. ignored.', exc_info=True)
-            _done(None)
-            return
+        pool = self._container_pool
 
-        with transaction() as s:
-            submission = s.query(Submission).with_for_update().filter(
-                Submission.contest_id == contest_id,
-                Submission.problem_id == problem_id,
-                Submission.id == submission_id).first()
-            if not submission:
-                LOGGER.warning(
-                    'Submission.id "{}" is not found'.format(submission_id))
-                _done(None)
-            if submission.status not in (
-                    JudgeStatus.Waiting, JudgeStatus.Running,
-                    JudgeStatus.InternalError):
+        def _hydrate() -> Optional[JudgeTask]:
+            timer = _Timer()
+            with transaction() as s:
+                task = hydrate_task(
+                    s, job, submission_id, self._options['test_parallelism'],
+                    timer, owner=(self._hostname or gethostname(), self._pid),
+                    lease_timeout=self._options['lease_timeout'],
+                    priority=delivery.priority)
+            timer.lap('commit')
+            if task is None:
+                return None
+            assert self._loop
+            self._loop.call_soon_threadsafe(self._leased.add, submission_id)
+            # テストデータの取得/展開は提出の行ロックを解放してから行う
+            with transaction() as s:
+                self._fill_test_cache(
+                    s, task.contest_id, task.problem_id, task.tests)
+            timer.lap('cache')
+            LOGGER.info('hydrated submission.id={} ({})'.format(
+                submission_id, timer))
+
+            if task.max_failures:
+                # 打ち切る場合は結果が再現するようにテストID順で実行する
+                task.tests.sort(key=lambda t: t.id)
+            else:
+                # テストの実行順序をシャッフルする
+                shuffle(task.tests)
+
+            if pool:
+                if task.compile_image_name and not self._is_compiled(task):
+                    task.compile_container = pool.checkout(
+                        task.compile_image_name, compile=True)
+                task.test_container = pool.checkout(task.test_image_name)
+            return task
+
+        def _release(task: JudgeTask, _: TFuture) -> None:
+            if pool:
+                pool.release([task.compile_container, task.test_container])
+
+        def _submit(hydrated: 'asyncio.Future[Optional[JudgeTask]]') -> None:
+            if hydrated.exception() is not None:
+                LOGGER.warning('cannot hydrate submission.id={}'.format(
+                    submission_id), exc_info=hydrated.exception())
+                self._leased.discard(submission_id)
+                release()
+                return
+            task = hydrated.result()
+            if task is None:
                 _done(None)
-            env = s.query(Environment).filter(
-                Environment.id == submission.environment_id).first()
-            problem = s.query(Problem).filter(
-                Problem.contest_id == contest_id,
-                Problem.id == problem_id).first()
-            assert env and problem  # env/problemは外部キー制約によって常に取得可能
-
-            # ワーカーダウン等ですべてのテストのジャッジが完了していない場合は
-            # ジャッジ済みのテストは結果を流用する
-            existed_results = {
-                jr.test_id: jr
-                for jr in s.query(JudgeResult).filter(
-                        JudgeResult.contest_id == contest_id,
-                        JudgeResult.problem_id == problem_id,
-                        JudgeResult.submission_id == submission_id)}
-
-            task = JudgeTask(
-                id=submission_id,
-                contest_id=contest_id,
-                problem_id=problem_id,
-                user_id=submission.user_id,
-                code=submission.code,
-                compile_image_name=env.compile_image_name,
-                test_image_name=env.test_image_name,
-                time_limit=problem.time_limit,
-                memory_limit=problem.memory_limit,
-                tests=[])
-            submission.status = JudgeStatus.Running
-            testcases = s.query(TestCase).filter(
-                TestCase.contest_id == contest_id,
-                TestCase.problem_id == problem_id).all()
-            for test in testcases:
-                jr = existed_results.get(test.id, None)
-                if not jr:
-                    s.add(JudgeResult(
-                        contest_id=contest_id, problem_id=problem_id,
-                        submission_id=submission_id, test_id=test.id))
-                if not jr or jr.status in (
-                        JudgeStatus.Waiting, JudgeStatus.Running,
-                        JudgeStatus.InternalError):
-                    task.tests.append(JudgeTestInfo(
-                        id=test.id, input=test.input, output=test.output))
-
-        # テストの実行順序をシャッフルする
-        shuffle(task.tests)
-
-        def _submit() -> None:
-            LOGGER.info('submit to child process (submission.id={})'.format(
-                submission_id))
-            future = self._executor.submit(run, DockerJudgeDriver, task)
+                return
+            future: TFuture
+            if self._executor:
+                LOGGER.info('submit to {} (submission.id={})'.format(
+                    self._options['judge_mode'], submission_id))
+                future = self._executor.submit(run, self._judge_class, task)
+            else:
+                future = asyncio.ensure_future(
+                    run_async(AsyncDockerJudgeDriver, task))
             future.add_done_callback(_done)
-        asyncio.get_event_loop().call_soon_threadsafe(_submit)
+            future.add_done_callback(partial(_release, task))
 
+        # 行ロックを持つ提出の更新とテストデータの展開の間にイベントループ
+        # (メッセージの受信/ack, asyncモードのジャッジ)を止めないように
+        # 専用のスレッドで行い、完了後にイベントループ上でジャッジを開始する
+        assert self._loop
+        self._loop.run_in_executor(self._hydrator, _hydrate).add_done_callback(
+            _submit)
 
-def _initializer(db_config: dict) -> None:
+    def _is_compiled(self, task: JudgeTask) -> bool:
+        # ジャッジプロセスと同じキーでコンパイル済みバイナリを探す。
+        # 子プロセスが書き込んだ直後はscan()前のためファイルの有無で判定する
+        assert task.compile_image_name
+        try:
+            code = ZstdDecompressor().decompress(task.code)
+        except Exception:
+            return False
+        key = content_hash(
+            task.compile_image_name.encode('utf8') + b'\0' + code)
+        return os.path.exists(self._compile_cache.path(key))
+
+    def _fill_test_cache(self, s: scoped_session, contest_id: str,
+                         problem_id: str, tests: List[JudgeTestInfo],
+                         limit: Optional[int] = None) -> int:
+        """キャッシュに存在しないテストデータのみDBから取得して展開する
+
+        展開したデータのバイト数を返す。limitを指定した場合、展開後の
+        サイズの合計が超えるときは何もせずに-1を返す"""
+        # アップロードでデータが差し替えられるとハッシュ値が変わるため、
+        # 古いデータは参照されなくなりLRUで削除される
+        def _cached(h: Optional[str]) -> bool:
+            return h is not None and self._test_cache.contains(h)
+        missing = {
+            t.id: t for t in tests
+            if not (_cached(t.input_hash) and _cached(t.output_hash))}
+        if not missing:
+            return 0
+        q = s.query(TestCase).filter(
+            TestCase.contest_id == contest_id,
+            TestCase.problem_id == problem_id,
+            TestCase.id.in_(list(missing.keys())))
+        if limit is not None:
+            # サイズ不明(blob移行前)のデータは展開してみるまで分からない
+            size = q.with_entities(func.sum(
+                func.coalesce(TestCase.input_size, 0) +
+                func.coalesce(TestCase.output_size, 0))).scalar() or 0
+            if size > limit:
+                return -1
+        total = 0
+        for tc in q:
+            test = missing[tc.id]
+            for name in ('input', 'output'):
+                try:
+                    data = load_test_data(
+                        getattr(tc, name), getattr(tc, name + '_hash'))
+                except Exception:
+                    # 壊れたデータは子プロセスでInternalErrorとして扱う
+                    setattr(test, name + '_hash', None)
+                    continue
+                h = content_hash(data)
+                self._test_cache.put(h, data)
+                total += len(data)
+                setattr(test, name + '_hash', h)
+                if getattr(tc, name + '_hash') != h:
+                    # ハッシュ値導入前に登録されたデータを補完する
+                    setattr(tc, name + '_hash', h)
+        return total
+
+
+class _Timer(object):
+    """処理の段階ごとの所要時間を記録する"""
+
+    def __init__(self) -> None:
+        self._last = monotonic()
+        self.laps: List[Tuple[str, float]] = []
+
+    def lap(self, name: str) -> None:
+        now = monotonic()
+        self.laps.append((name, now - self._last))
+        self._last = now
+
+    def __str__(self) -> str:
+        return ' '.join(
+            '{}={:.1f}ms'.format(k, v * 1000) for k, v in self.laps)
+
+
+_PENDING_STATUSES = (
+    JudgeStatus.Waiting, JudgeStatus.Running, JudgeStatus.InternalError)
+
+
+def hydrate_task(s: scoped_session, job: JudgeJob, submission_id: int,
+                 default_parallelism: int,
+                 timer: Optional[_Timer] = None, *,
+                 owner: Optional[Tuple[str, int]] = None,
+                 lease_timeout: float = 300,
+                 priority: str = PRIORITY_SUBMISSION) -> Optional[JudgeTask]:
+    """提出をRunningにしてジャッジタスクを組み立てる。ジャッジ不要の場合はNone
+
+    ownerに(ホスト名, PID)を指定した場合はlease_timeout秒のリースを設定する。
+    リースには回収時に積み直すキューとしてpriorityを記録する。
+    他のワーカーが有効なリースを持つ(ジャッジ中の)提出はジャッジしない
+
+    提出(行ロック)・環境・問題は結合した1回のクエリで取得し(環境が
+    メッセージに含まれている場合は結合しない)、テストケースと既存の結果も
+    1回のクエリで取得する。未作成の結果はまとめてINSERTする"""
+    timer = timer or _Timer()
+    contest_id, problem_id = job.contest_id, job.problem_id
+    join_env = not job.environments
+    # 問題の制限はリジャッジ前に変更される場合があるため常にDBから取得する
+    columns = [Submission.user_id, Submission.code, Submission.environment_id,
+               Submission.status, Submission.lease_expires > func.now(),
+               Problem.time_limit, Problem.memory_limit,
+               Problem.parallelism, Problem.max_failures]
+    if join_env:
+        columns += [Environment.compile_image_name,
+                    Environment.test_image_name]
+    q = s.query(*columns).join(Problem, and_(
+        Problem.contest_id == Submission.contest_id,
+        Problem.id == Submission.problem_id,
+    )).filter(
+        Submission.contest_id == contest_id,
+        Submission.problem_id == problem_id,
+        Submission.id == submission_id)
+    if join_env:
+        q = q.join(Environment, Environment.id == Submission.environment_id)
+    row = q.with_for_update(of=Submission).first()
+    timer.lap('fetch')
+    if row is None:
+        LOGGER.warning('Submission.id "{}" is not found'.format(submission_id))
+        return None
+    (user_id, code, env_id, status, leased, time_limit, memory_limit,
+     parallelism, max_failures) = row[:9]
+    if status not in _PENDING_STATUSES:
+        return None
+    if status == JudgeStatus.Running and leased:
+        # ワーカーの切断による再配送。ジャッジ中のワーカーが停止していれば
+        # リースの期限切れ後に再度キューに積まれる
+        LOGGER.info('submission.id={} is leased by another worker'.format(
+            submission_id))
+        return None
+    if join_env:
+        compile_image_name, test_image_name = row[9:]
+    else:
+        images = job.environment(env_id)
+        if images is None:  # メッセージに含まれていない環境
+            images = s.query(
+                Environment.compile_image_name, Environment.test_image_name
+            ).filter(Environment.id == env_id).one()
+        compile_image_name, test_image_name = images
+
+    # ワーカーダウン等ですべてのテストのジャッジが完了していない場合は
+    # ジャッジ済みのテストは結果を流用する。
+    # テストデータ本体は取得せず、ハッシュ値のみを子プロセスに渡す
+    testcases = s.query(
+        TestCase.id, TestCase.input_hash, TestCase.output_hash,
+        JudgeResult.status,
+    ).outerjoin(JudgeResult, and_(
+        JudgeResult.contest_id == TestCase.contest_id,
+        JudgeResult.problem_id == TestCase.problem_id,
+        JudgeResult.test_id == TestCase.id,
+        JudgeResult.submission_id == submission_id,
+    )).filter(
+        TestCase.contest_id == contest_id,
+        TestCase.problem_id == problem_id).all()
+    timer.lap('tests')
+
+    updates: Dict[Any, Any] = {Submission.status: JudgeStatus.Running}
+    if owner:
+        updates.update({
+            Submission.lease_hostname: owner[0],
+            Submission.lease_pid: owner[1],
+            Submission.lease_expires: func.now() + timedelta(
+                seconds=lease_timeout),
+            Submission.lease_priority: priority})
+    s.query(Submission).filter(Submission.id == submission_id).update(
+        updates, synchronize_session=False)
+    update_standings(s, contest_id, problem_id, [user_id])
+    new_results = [
+        dict(contest_id=contest_id, problem_id=problem_id,
+             submission_id=submission_id, test_id=test_id)
+        for test_id, _, _, result_status in testcases
+        if result_status is None]
+    if new_results:
+        s.execute(insert(JudgeResult.__table__).values(
+            new_results).on_conflict_do_nothing())
+    timer.lap('write')
+
+    return JudgeTask(
+        id=submission_id,
+        contest_id=contest_id,
+        problem_id=problem_id,
+        user_id=user_id,
+        code=code,
+        compile_image_name=compile_image_name,
+        test_image_name=test_image_name,
+        time_limit=time_limit,
+        memory_limit=memory_limit,
+        tests=[
+            JudgeTestInfo(
+                id=test_id, input_hash=input_hash, output_hash=output_hash)
+            for test_id, input_hash, output_hash, result_status in testcases
+            if result_status is None or result_status in _PENDING_STATUSES],
+        parallelism=parallelism or default_parallelism,
+        max_failures=max_failures)
+
+
+def _initializer(db_config: dict, options: dict) -> None:
     from penguin_judge.models import configure
     configure(**db_config)
+    _configure_judge(options)
+
+
+def _configure_judge(options: dict) -> None:
+    from penguin_judge.judge.main import configure as configure_judge
+    from penguin_judge.judge.docker import configure as configure_docker
+    from penguin_judge.blob import configure as configure_blob
+    configure_judge(**options)
+    configure_blob(**options)
+    configure_docker(**options)
 
 
-def main(db_config: dict, max_processes: int) -> None:
-    with Worker(db_config, max_processes) as worker:
+def main(db_config: dict, max_processes: int, options: dict) -> None:
+    with Worker(db_config, max_processes, options) as worker:
         worker.start()
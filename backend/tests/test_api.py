@@ -4,17 +4,33 @@ from datetime import datetime, timezone, timedelta
 import unittest
 import unittest.mock
 from functools import partial
+from io import BytesIO
+import json
+from tempfile import TemporaryDirectory
+from zipfile import ZipFile
 from webtest import TestApp
-from zstandard import ZstdCompressor  # type: ignore
+from zstandard import ZstdCompressor, ZstdDecompressor  # type: ignore
 from penguin_judge.api import app as _app, _kdf
+from penguin_judge.blob import configure as configure_blob, get_store
 from penguin_judge.models import (
     User, Environment, Contest, Problem, TestCase, Submission, JudgeResult,
-    Token, JudgeStatus, configure, transaction)
+    Token, JudgeStatus, Standing, StandingsState, Worker, configure,
+    transaction)
+from penguin_judge.ranking import update as update_standings
+from penguin_judge.utils import content_hash
 from . import TEST_DB_URL
 
 app = TestApp(_app, cookiejar=CookieJar())
 
 
+def _zip(files):
+    f = BytesIO()
+    with ZipFile(f, 'w') as z:
+        for name, data in files.items():
+            z.writestr(name, data)
+    return f.getvalue()
+
+
 class TestAPI(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -25,8 +41,8 @@ class TestAPI(unittest.TestCase):
         app.reset()
         _configure_app({})
         tables = (
-            JudgeResult, Submission, TestCase, Problem, Contest, Environment,
-            Token, User)
+            Standing, StandingsState, JudgeResult, Submission, TestCase,
+            Problem, Contest, Environment, Token, User)
         admin_token = bytes([i for i in range(32)])
         salt = b'penguin'
         passwd = _kdf('penguinpenguin', salt)
@@ -45,6 +61,66 @@ class TestAPI(unittest.TestCase):
         self.admin_token = b64encode(admin_token).decode('ascii')
         self.admin_headers = {'X-Auth-Token': self.admin_token}
 
+    def test_token_cache(self):
+        _app.config['token_cache_ttl'] = 60
+        uid, pw = 'penguin', 'password'
+        u = app.post_json(
+            '/users', {'login_id': uid, 'name': 'ABC', 'password': pw},
+            headers=self.admin_headers).json
+        token = app.post_json(
+            '/auth', {'login_id': uid, 'password': pw}).json['token']
+        app.reset()
+        headers = {'X-Auth-Token': token}
+        self.assertEqual(u, app.get('/user', headers=headers).json)
+
+        # キャッシュされているのでDBから削除しても有効なまま
+        with transaction() as s:
+            s.query(Token).filter(Token.user_id == u['id']).update({
+                'user_id': self.admin_id})
+        self.assertEqual(u, app.get('/user', headers=headers).json)
+        with transaction() as s:
+            s.query(Token).filter(Token.user_id == self.admin_id).update({
+                'user_id': u['id']})
+
+        # ユーザ情報の更新は反映される
+        app.patch_json('/users/{}'.format(u['id']), {'name': 'XYZ'},
+                       headers=headers)
+        self.assertEqual(
+            'XYZ', app.get('/user', headers=headers).json['name'])
+
+        # ログアウトしたトークンは即座に無効になる
+        app.delete('/auth', headers=headers, status=204)
+        app.get('/user', headers=headers, status=401)
+
+    def test_response_cache(self):
+        _app.config['response_cache_ttl'] = 60
+        url = '/contests/abc000'
+        now = datetime.now(tz=timezone.utc)
+        app.get(url, status=404)
+        app.post_json('/contests', {
+            'id': 'abc000', 'title': 'ABC000', 'description': '',
+            'start_time': (now + timedelta(hours=1)).isoformat(),
+            'end_time': (now + timedelta(hours=2)).isoformat(),
+            'published': True}, headers=self.admin_headers)
+        resp = app.get(url)
+        app.get(url, headers={'If-None-Match': resp.etag}, status=304)
+        app.get(url + '/problems', status=403)
+
+        # キャッシュされているのでDBを直接変更しても反映されない
+        with transaction() as s:
+            s.query(Contest).update({'title': 'XYZ'})
+        self.assertEqual(app.get(url).json['title'], 'ABC000')
+        self.assertEqual(app.get(
+            url, headers=self.admin_headers).json['title'], 'XYZ')
+
+        # APIによる更新は即座に反映される
+        app.patch_json(url, {'start_time': now.isoformat()},
+                       headers=self.admin_headers)
+        resp2 = app.get(url, headers={'If-None-Match': resp.etag})
+        self.assertEqual(resp2.json['title'], 'XYZ')
+        self.assertNotEqual(resp.etag, resp2.etag)
+        self.assertEqual(app.get(url + '/problems').json, [])
+
     def test_create_user(self):
         def _invalid(body, setup_token=True, status=400):
             headers = self.admin_headers if setup_token else {}
@@ -245,6 +321,10 @@ class TestAPI(unittest.TestCase):
         ret = _patch(contest_id, p0['id'], {'title': 'AAAA'}).json
         p0['title'] = 'AAAA'
         self.assertEqual(ret, p0)
+        _invalid_patch(contest_id, p0['id'], {'parallelism': 0})
+        ret = _patch(contest_id, p0['id'], {'parallelism': 4}).json
+        p0['parallelism'] = 4
+        self.assertEqual(ret, p0)
 
         app.delete('/contests/{}/problems/{}'.format(contest_id, p1['id']),
                    headers=self.admin_headers)
@@ -274,8 +354,163 @@ class TestAPI(unittest.TestCase):
         app.get('/contests/{}/problems'.format(contest_id), status=404)
         app.get('/contests/{}/problems/A'.format(contest_id), status=404)
 
+    def test_upload_test_dataset(self):
+        now = datetime.now(tz=timezone.utc)
+        app.post_json('/contests', {
+            'id': 'abc000', 'title': 'ABC000', 'description': '',
+            'start_time': now.isoformat(),
+            'end_time': (now + timedelta(hours=1)).isoformat(),
+        }, headers=self.admin_headers)
+        app.post_json('/contests/abc000/problems', {
+            'id': 'A', 'title': 'A', 'description': '', 'time_limit': 1,
+            'score': 100}, headers=self.admin_headers)
+        url = '/contests/abc000/problems/A/tests'
+        big = b'0123456789' * 300000
+        body = _zip({'x/1.in': big, 'x/1.out': b'1', '2.in': b'2',
+                     '2.out': b'', '3.in': b'3'})
+        app.put(url, body, status=401)
+        app.put(url, b'invalid', headers=self.admin_headers, status=400)
+        self.assertEqual(
+            ['1', '2'], app.put(url, body, headers=self.admin_headers).json)
+        self.assertEqual(big, app.get(
+            url + '/1/in', headers=self.admin_headers).body)
+        self.assertEqual(b'', app.get(
+            url + '/2/out', headers=self.admin_headers).body)
+        with transaction() as s:
+            self.assertEqual(content_hash(big), s.query(
+                TestCase.input_hash).filter(TestCase.id == '1').scalar())
+
+        resp = app.put(url + '?progress=true', _zip({
+            '2.in': b'22', '2.out': b'4', '4.in': b'', '4.out': b''}),
+            headers=self.admin_headers)
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        lines = [json.loads(x) for x in resp.body.splitlines()]
+        self.assertEqual(lines, [
+            {'id': '2', 'input_bytes': 2, 'output_bytes': 1},
+            {'id': '4', 'input_bytes': 0, 'output_bytes': 0},
+            {'tests': ['2', '4']}])
+        self.assertEqual(['2', '4'], sorted(app.get(
+            url, headers=self.admin_headers).json))
+        self.assertEqual(b'22', app.get(
+            url + '/2/in', headers=self.admin_headers).body)
+
+    def test_download_test_dataset(self):
+        now = datetime.now(tz=timezone.utc)
+        app.post_json('/contests', {
+            'id': 'abc000', 'title': 'ABC000', 'description': '',
+            'start_time': now.isoformat(),
+            'end_time': (now + timedelta(hours=1)).isoformat(),
+        }, headers=self.admin_headers)
+        app.post_json('/contests/abc000/problems', {
+            'id': 'A', 'title': 'A', 'description': '', 'time_limit': 1,
+            'score': 100}, headers=self.admin_headers)
+        url = '/contests/abc000/problems/A/tests'
+        big = bytes(range(256)) * 20000
+        app.put(url, _zip({'1.in': big, '1.out': b'1', '2.in': b'',
+                           '2.out': b'2'}), headers=self.admin_headers)
+
+        resp = app.get(url + '/1/in', headers=self.admin_headers)
+        self.assertEqual(big, resp.body)
+        self.assertEqual(str(len(big)), resp.headers['Content-Length'])
+        self.assertIn('1.in', resp.headers['Content-Disposition'])
+        resp = app.get(url + '/1/in', headers=dict(
+            Range='bytes=1000000-2000009', **self.admin_headers), status=206)
+        self.assertEqual(big[1000000:2000010], resp.body)
+        self.assertEqual('bytes 1000000-2000009/{}'.format(len(big)),
+                         resp.headers['Content-Range'])
+        resp = app.get(url + '/1/in', headers=dict(
+            Range='bytes=-5', **self.admin_headers), status=206)
+        self.assertEqual(big[-5:], resp.body)
+        app.get(url + '/1/in', headers=dict(
+            Range='bytes={}-'.format(len(big)), **self.admin_headers),
+            status=416)
+        # webtestはzstdを展開できないためFlaskのクライアントを使う
+        resp = _app.test_client().get(url + '/1/in', headers=dict(
+            {'Accept-Encoding': 'gzip, zstd'}, **self.admin_headers))
+        self.assertEqual('zstd', resp.headers['Content-Encoding'])
+        self.assertEqual(big, ZstdDecompressor().decompress(resp.data))
+        app.get(url + '/3/in', headers=self.admin_headers, status=404)
+
+        app.get(url + '/archive', status=401)
+        app.get('/contests/abc000/problems/B/tests/archive',
+                headers=self.admin_headers, status=404)
+        resp = app.get(url + '/archive', headers=self.admin_headers)
+        self.assertEqual(resp.content_type, 'application/zip')
+        with ZipFile(BytesIO(resp.body)) as z:
+            self.assertEqual(['1.in', '1.out', '2.in', '2.out'], z.namelist())
+            self.assertEqual(big, z.read('1.in'))
+            self.assertEqual(b'', z.read('2.in'))
+            self.assertEqual(b'2', z.read('2.out'))
+
+    @unittest.mock.patch('penguin_judge.api.queue_depths', return_value={
+        'submission': 3, 'manual': 0, 'rejudge': 5})
+    def test_status(self, _):
+        now = datetime.now(tz=timezone.utc)
+        with transaction() as s:
+            s.query(Worker).delete(synchronize_session=False)
+            s.add(Worker(
+                hostname='host', pid=1, max_processes=2, startup_time=now,
+                last_contact=now, processed=0, errors=0, concurrency=2,
+                running=2, queued=4))
+        app.get('/status', status=401)
+        ret = app.get('/status', headers=self.admin_headers).json
+        self.assertEqual(8, ret['queued'])
+        self.assertEqual(5, ret['queues']['rejudge'])
+        self.assertEqual(2, ret['workers'][0]['concurrency'])
+        self.assertEqual(
+            {'current_workers': 1, 'desired_workers': 7}, ret['scaling'])
+
+    def test_test_dataset_blob_store(self):
+        now = datetime.now(tz=timezone.utc)
+        app.post_json('/contests', {
+            'id': 'abc000', 'title': 'ABC000', 'description': '',
+            'start_time': now.isoformat(),
+            'end_time': (now + timedelta(hours=1)).isoformat(),
+        }, headers=self.admin_headers)
+        app.post_json('/contests/abc000/problems', {
+            'id': 'A', 'title': 'A', 'description': '', 'time_limit': 1,
+            'score': 100}, headers=self.admin_headers)
+        url = '/contests/abc000/problems/A/tests'
+        big = b'0123456789' * 300000
+        with TemporaryDirectory() as tmpdir:
+            configure_blob(**{'blob.backend': 'file', 'blob.dir': tmpdir})
+            try:
+                app.put(url, _zip({'1.in': big, '1.out': b'1', '2.in': b'1',
+                                   '2.out': b'1'}), headers=self.admin_headers)
+                with transaction() as s:
+                    for tc in s.query(TestCase):
+                        self.assertIsNone(tc.input)
+                        self.assertIsNone(tc.output)
+                    self.assertEqual(len(big), s.query(
+                        TestCase.input_size).filter(
+                            TestCase.id == '1').scalar())
+                # 同じ内容のデータは1つだけ保存される
+                store = get_store()
+                self.assertEqual(
+                    {content_hash(big), content_hash(b'1')},
+                    {k for k, _ in store.list()})
+                self.assertEqual(big, app.get(
+                    url + '/1/in', headers=self.admin_headers).body)
+                self.assertEqual(big[10:20], app.get(
+                    url + '/1/in', headers=dict(
+                        Range='bytes=10-19', **self.admin_headers),
+                    status=206).body)
+                resp = _app.test_client().get(url + '/1/in', headers=dict(
+                    {'Accept-Encoding': 'zstd'}, **self.admin_headers))
+                self.assertEqual(
+                    big, ZstdDecompressor().decompress(resp.data))
+                archive = app.get(url + '/archive', headers=self.admin_headers)
+                with ZipFile(BytesIO(archive.body)) as z:
+                    self.assertEqual(big, z.read('1.in'))
+                    self.assertEqual(b'1', z.read('2.out'))
+                store.delete(content_hash(b'1'))
+                app.get(url + '/2/in', headers=self.admin_headers,
+                        status=404)
+            finally:
+                configure_blob()
+
     @unittest.mock.patch('pika.BlockingConnection')
-    @unittest.mock.patch('penguin_judge.api.get_mq_conn_params')
+    @unittest.mock.patch('penguin_judge.mq.get_mq_conn_params')
     def test_submission(self, mock_conn, mock_get_params):
         # TODO(kazuki): API経由に書き換える
         env = dict(name='Python 3.7', test_image_name='docker-image')
@@ -354,6 +589,22 @@ class TestAPI(unittest.TestCase):
             '/contests/{}/submissions/{}'.format(contest_id2, resp['id']),
             status=404)
 
+        # リジャッジ時はジャッジ中だった提出のリースを解除する
+        with transaction() as s:
+            s.query(Submission).update({
+                Submission.status: JudgeStatus.Running,
+                Submission.lease_hostname: 'host', Submission.lease_pid: 1,
+                Submission.lease_expires: start_time,
+                Submission.lease_priority: 'submission'})
+        app.post('{}/problems/A/rejudge'.format(prefix),
+                 headers=self.admin_headers)
+        with transaction() as s:
+            submission = s.query(Submission).one()
+            self.assertEqual(JudgeStatus.Waiting, submission.status)
+            self.assertEqual((None, None, None, None), (
+                submission.lease_hostname, submission.lease_pid,
+                submission.lease_expires, submission.lease_priority))
+
         with transaction() as s:
             s.query(Contest).update({'end_time': start_time})
         app.get('{}/submissions'.format(prefix))
@@ -419,7 +670,9 @@ class TestAPI(unittest.TestCase):
             for i in range(100):
                 submission = Submission(
                     contest_id='id0', problem_id='A', user_id=self.admin_id,
-                    code=b'dummy', code_bytes=1, environment_id=env.id)
+                    code=b'dummy', code_bytes=1, environment_id=env.id,
+                    max_time=(timedelta(milliseconds=i % 5)
+                              if i % 3 else None))
                 s.add(submission)
                 s.flush()
                 test_data.append(submission.to_dict())
@@ -443,6 +696,46 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(int(resp.headers['X-Total']), 100)
         self.assertEqual(int(resp.headers['X-Total-Pages']), 4)
 
+        # カーソルで全ページを前後に辿る(NULLを含むカラムの降順+作成日時順)
+        url = '/contests/id0/submissions?sort=-max_time,created&per_page=7'
+        expected = [x['id'] for x in sorted(test_data, key=lambda x: (
+            'max_time' in x, -x.get('max_time', timedelta()),
+            x['created'], x['id']))]
+        resp = app.get(url + '&total=none', headers=self.admin_headers)
+        self.assertNotIn('X-Total', resp.headers)
+        self.assertNotIn('X-Prev-Cursor', resp.headers)
+        pages = [resp.json]
+        while 'X-Next-Cursor' in resp.headers:
+            resp = app.get(url + '&cursor=' + resp.headers['X-Next-Cursor'],
+                           headers=self.admin_headers)
+            self.assertNotIn('X-Page', resp.headers)
+            self.assertNotIn('X-Total', resp.headers)
+            pages.append(resp.json)
+        self.assertEqual(len(pages), 15)
+        self.assertEqual([x['id'] for p in pages for x in p], expected)
+        while 'X-Prev-Cursor' in resp.headers:
+            resp = app.get(url + '&cursor=' + resp.headers['X-Prev-Cursor'],
+                           headers=self.admin_headers)
+            self.assertEqual(resp.json, pages[-2])
+            pages.pop()
+        self.assertEqual(len(pages), 1)
+
+        # 既定の並び順(作成日時, ID)
+        cursor = app.get(
+            '/contests/id0/submissions?per_page=31&total=none',
+            headers=self.admin_headers).headers['X-Next-Cursor']
+        resp = app.get(
+            '/contests/id0/submissions?per_page=31&cursor=' + cursor,
+            headers=self.admin_headers)
+        self.assertEqual(
+            [x['id'] for x in resp.json],
+            [x['id'] for x in test_data[31:62]])
+
+        resp = app.get(url + '&total=estimate', headers=self.admin_headers)
+        self.assertGreater(int(resp.headers['X-Total']), 0)
+        app.get(url + '&cursor=invalid', headers=self.admin_headers,
+                status=400)
+
     def test_ranking(self):
         salt = b'penguin'
         passwd = _kdf('penguinpenguin', salt)
@@ -545,3 +838,82 @@ class TestAPI(unittest.TestCase):
             'D': {'penalties': 1, 'pending': False},
             'E': {'penalties': 1, 'pending': False},
         })
+
+    def test_ranking_incremental(self):
+        salt = b'penguin'
+        passwd = _kdf('penguinpenguin', salt)
+        start = datetime.now(tz=timezone.utc)
+        with transaction() as s:
+            env = Environment(name='Python', test_image_name='image')
+            s.add(env)
+            s.add(Contest(
+                id='abc000', title='ABC000', description='', published=True,
+                start_time=start, end_time=start + timedelta(days=1)))
+            s.flush()
+            for id in ('A', 'B'):
+                s.add(Problem(
+                    contest_id='abc000', id=id, title=id, description='',
+                    time_limit=1, memory_limit=1024, score=100))
+            u0 = User(login_id='user0', name='User0', salt=salt,
+                      password=passwd)
+            u1 = User(login_id='user1', name='User1', salt=salt,
+                      password=passwd)
+            s.add_all([u0, u1])
+            s.flush()
+            env_id, uid0, uid1 = env.id, u0.id, u1.id
+
+        def _submit(uid, problem_id, status, sec):
+            with transaction() as s:
+                submission = Submission(
+                    contest_id='abc000', problem_id=problem_id, user_id=uid,
+                    code=b'', code_bytes=0, environment_id=env_id,
+                    status=status, created=start + timedelta(seconds=sec))
+                s.add(submission)
+                s.flush()
+                update_standings(s, 'abc000', problem_id, [uid])
+                return submission.id
+
+        def _judge(submission_id, uid, problem_id, status):
+            with transaction() as s:
+                s.query(Submission).filter(
+                    Submission.id == submission_id
+                ).update({'status': status}, synchronize_session=False)
+                update_standings(s, 'abc000', problem_id, [uid])
+
+        ret = app.get('/contests/abc000/rankings').json
+        self.assertEqual(ret, [
+            {'ranking': 1, 'user_id': uid0, 'problems': {}},
+            {'ranking': 1, 'user_id': uid1, 'problems': {}}])
+
+        s0 = _submit(uid0, 'A', JudgeStatus.Waiting, 10)
+        _submit(uid1, 'B', JudgeStatus.WrongAnswer, 5)
+        ret = app.get('/contests/abc000/rankings').json
+        self.assertEqual([r['user_id'] for r in ret], [uid0, uid1])
+        self.assertEqual(ret[0]['problems'], {
+            'A': {'penalties': 0, 'pending': True}})
+        self.assertEqual(ret[1]['problems'], {
+            'B': {'penalties': 1, 'pending': False}})
+
+        _judge(s0, uid0, 'A', JudgeStatus.Accepted)
+        s1 = _submit(uid1, 'B', JudgeStatus.Running, 20)
+        _judge(s1, uid1, 'B', JudgeStatus.Accepted)
+        ret = app.get('/contests/abc000/rankings').json
+        self.assertEqual(ret[0]['user_id'], uid0)
+        self.assertEqual(ret[0]['score'], 100)
+        self.assertEqual(ret[0]['adjusted_time'], 10)
+        self.assertEqual(ret[1]['user_id'], uid1)
+        self.assertEqual(ret[1]['problems'], {
+            'B': {'time': 20, 'score': 100, 'penalties': 1,
+                  'pending': False}})
+        self.assertEqual(ret[1]['adjusted_time'], 20 + 300)
+
+        # コンテスト期間を変更すると順位表が再構築される
+        with transaction() as s:
+            s.query(Contest).update({
+                'end_time': start + timedelta(seconds=15)})
+        ret = app.get('/contests/abc000/rankings').json
+        self.assertEqual(ret[0]['user_id'], uid0)
+        self.assertEqual(ret[1]['user_id'], uid1)
+        self.assertEqual(ret[1]['score'], 0)
+        self.assertEqual(ret[1]['problems'], {
+            'B': {'penalties': 1, 'pending': False}})
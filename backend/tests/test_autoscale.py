@@ -0,0 +1,43 @@
+import unittest
+import unittest.mock
+
+from penguin_judge.autoscale import (
+    available_memory, desired_workers, next_concurrency)
+
+
+@unittest.mock.patch('penguin_judge.autoscale.cpu_count', return_value=4)
+class TestAutoscale(unittest.TestCase):
+    def _next(self, current, **kwargs):
+        args = dict(backlog=0, running=current, load=0.5,
+                    free_memory=2 << 30, target_load=1.0,
+                    min_free_memory=512 << 20)
+        args.update(kwargs)
+        return next_concurrency(current, 1, 4, **args)
+
+    def test_next_concurrency(self, _):
+        # 待ちがあり全ての枠が使用中なら増やす
+        self.assertEqual(3, self._next(2, backlog=5))
+        self.assertEqual(4, self._next(4, backlog=5))
+        # 空きがある/待ちがない/増やすと負荷が目標を超える場合は維持する
+        self.assertEqual(2, self._next(2, backlog=5, running=1))
+        self.assertEqual(2, self._next(2))
+        self.assertEqual(2, self._next(2, backlog=5, load=0.8))
+        # 高負荷やメモリ不足の場合は減らす
+        self.assertEqual(1, self._next(2, backlog=5, load=1.5))
+        self.assertEqual(1, self._next(1, load=1.5))
+        self.assertEqual(2, self._next(3, free_memory=100 << 20))
+        self.assertEqual(3, self._next(3, free_memory=None))
+
+    def test_desired_workers(self, _):
+        self.assertEqual(1, desired_workers(0, []))
+        self.assertEqual(1, desired_workers(0, [(4, 0, 0), (4, 0, None)]))
+        self.assertEqual(2, desired_workers(3, [(4, 4, 0)]))
+        self.assertEqual(
+            7, desired_workers(10, [(2, 0, 0), (None, None, None)]))
+        # ブローカーのキューが空でもワーカーが先読みした分は需要に含める
+        self.assertEqual(1, desired_workers(0, [(4, 4, 0)]))
+        self.assertEqual(4, desired_workers(0, [(4, 4, 12)]))
+
+    def test_available_memory(self, _):
+        ret = available_memory()
+        self.assertTrue(ret is None or ret > 0)
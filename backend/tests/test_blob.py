@@ -0,0 +1,151 @@
+from datetime import datetime, timezone, timedelta
+from io import BytesIO
+import os
+from tempfile import TemporaryDirectory
+import unittest
+import unittest.mock
+
+from zstandard import ZstdCompressor  # type: ignore
+
+from penguin_judge.blob import FileBlobStore, S3BlobStore
+from penguin_judge.dataset import (
+    collect_garbage, load_test_data, migrate_to_store)
+from penguin_judge.models import (
+    Contest, JudgeResult, Problem, Submission, TestCase, configure,
+    transaction)
+from penguin_judge.utils import content_hash
+from . import TEST_DB_URL
+
+
+class _NotFound(Exception):
+    response = {'Error': {'Code': '404'}}
+
+
+class FakeS3Client(object):
+    # S3BlobStoreが使うAPIのみを実装したローカルのスタンドイン
+    def __init__(self):
+        self.objects = {}
+
+    def _get(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise _NotFound()
+        return self.objects[(Bucket, Key)]
+
+    def head_object(self, Bucket, Key):
+        self._get(Bucket, Key)
+        return {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = (Body, datetime.now(tz=timezone.utc))
+
+    def get_object(self, Bucket, Key):
+        return {'Body': BytesIO(self._get(Bucket, Key)[0])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def get_paginator(self, name):
+        client = self
+
+        class _Paginator(object):
+            def paginate(self, Bucket, Prefix):
+                yield {'Contents': [
+                    {'Key': k, 'LastModified': t}
+                    for (b, k), (_, t) in client.objects.items()
+                    if b == Bucket and k.startswith(Prefix)]}
+        return _Paginator()
+
+
+class TestBlobStore(unittest.TestCase):
+    def _test_store(self, store):
+        key = content_hash(b'data')
+        self.assertFalse(store.exists(key))
+        with self.assertRaises(KeyError):
+            store.open(key)
+        store.put(key, b'compressed')
+        store.put(key, b'compressed')
+        self.assertTrue(store.exists(key))
+        f = store.open(key)
+        self.assertEqual(b'compressed', f.read())
+        f.close()
+        self.assertEqual([key], [k for k, _ in store.list()])
+        store.delete(key)
+        self.assertFalse(store.exists(key))
+        self.assertEqual([], list(store.list()))
+        with self.assertRaises(ValueError):
+            store.put('../x', b'')
+
+    def test_file(self):
+        with TemporaryDirectory() as tmpdir:
+            store = FileBlobStore(tmpdir)
+            self._test_store(store)
+            key = content_hash(b'x')
+            store.put(key, b'x')
+            self.assertTrue(os.path.exists(
+                os.path.join(tmpdir, key[:2], key)))
+
+    def test_s3(self):
+        client = FakeS3Client()
+        self._test_store(S3BlobStore('bucket', prefix='t/', client=client))
+        S3BlobStore('bucket', prefix='t/', client=client).put(
+            content_hash(b'x'), b'x')
+        self.assertEqual(
+            [('bucket', 't/' + content_hash(b'x'))], list(client.objects))
+
+
+class TestMigration(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        configure(**{'sqlalchemy.url': TEST_DB_URL}, drop_all=True)
+
+    def setUp(self):
+        now = datetime.now(tz=timezone.utc)
+        cctx = ZstdCompressor()
+        with transaction() as s:
+            for t in (JudgeResult, Submission, TestCase, Problem, Contest):
+                s.query(t).delete(synchronize_session=False)
+            s.add(Contest(
+                id='c', title='C', description='', start_time=now,
+                end_time=now + timedelta(hours=1)))
+            s.flush()
+            for pid in ('A', 'B'):
+                s.add(Problem(
+                    contest_id='c', id=pid, title=pid, description='',
+                    time_limit=1, memory_limit=256, score=100))
+            s.flush()
+            # ハッシュ値導入前のデータを含む
+            for pid in ('A', 'B'):
+                s.add(TestCase(
+                    contest_id='c', problem_id=pid, id='1',
+                    input=cctx.compress(b'in'), output=cctx.compress(b'out')))
+
+    def test_migrate_and_gc(self):
+        with TemporaryDirectory() as tmpdir:
+            store = FileBlobStore(tmpdir)
+            self.assertEqual(2, migrate_to_store(store))
+            self.assertEqual(0, migrate_to_store(store))
+            # 同じ内容のデータは1つだけ保存される
+            self.assertEqual(
+                {content_hash(b'in'), content_hash(b'out')},
+                {k for k, _ in store.list()})
+            with transaction() as s:
+                for tc in s.query(TestCase):
+                    self.assertIsNone(tc.input)
+                    self.assertEqual(2, tc.input_size)
+                    self.assertEqual(3, tc.output_size)
+            with unittest.mock.patch(
+                    'penguin_judge.dataset.get_store', return_value=store):
+                self.assertEqual(b'in', load_test_data(
+                    None, content_hash(b'in')))
+
+            orphan = content_hash(b'orphan')
+            store.put(orphan, b'')
+            with transaction() as s:
+                s.query(TestCase).filter(TestCase.problem_id == 'A').delete()
+            self.assertEqual(0, collect_garbage(store))
+            self.assertEqual(1, collect_garbage(store, min_age=-60))
+            self.assertFalse(store.exists(orphan))
+            self.assertTrue(store.exists(content_hash(b'in')))
+            with transaction() as s:
+                s.query(TestCase).delete()
+            self.assertEqual(2, collect_garbage(store, min_age=-60))
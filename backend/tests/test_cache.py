@@ -0,0 +1,49 @@
+from threading import Event
+import time
+import unittest
+import unittest.mock
+
+from penguin_judge.cache import Listener, TTLCache, notify
+from penguin_judge.models import configure, transaction
+from . import TEST_DB_URL
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_lru_and_ttl(self):
+        cache = TTLCache(2, 10)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)  # 最も参照されていないbが削除される
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+        cache.put('d', 4, ttl=0)  # 期限切れのものは保存しない
+        self.assertIsNone(cache.get('d'))
+        with unittest.mock.patch(
+                'penguin_judge.cache.monotonic',
+                return_value=time.monotonic() + 11):
+            self.assertIsNone(cache.get('a'))
+
+        cache.remove_if(lambda k, v: v == 3)
+        self.assertIsNone(cache.get('c'))
+        self.assertFalse(TTLCache(10, 0).enabled)
+
+
+class TestListener(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        configure(**{'sqlalchemy.url': TEST_DB_URL}, drop_all=True)
+
+    def test_notify(self):
+        connected, received = Event(), []
+        Listener('penguin_judge_test', received.append, connected.set)
+        self.assertTrue(connected.wait(10))
+        with transaction() as s:
+            notify(s, 'penguin_judge_test', 'hello')
+            time.sleep(0.1)
+            self.assertEqual(received, [])  # コミットまでは通知されない
+        deadline = time.monotonic() + 10
+        while not received and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(received, ['hello'])
@@ -0,0 +1,174 @@
+import asyncio
+import os
+import ssl
+import struct
+from tempfile import TemporaryDirectory
+from threading import Lock
+import time
+import unittest
+import unittest.mock
+
+import docker  # type: ignore
+
+from penguin_judge.judge.docker import (
+    CPULocks, ContainerPool, _attach, _attach_params)
+
+
+class FakeDockerClient(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.running = {}
+        self.killed = []
+        self.seq = 0
+
+    def create_host_config(self, **kwargs):
+        return kwargs
+
+    def create_container(self, image, **kwargs):
+        with self.lock:
+            self.seq += 1
+            return {'Id': '{}-{}'.format(image, self.seq)}
+
+    def start(self, container):
+        with self.lock:
+            self.running[container] = True
+
+    def inspect_container(self, container):
+        with self.lock:
+            return {'State': {'Running': self.running.get(container, False)}}
+
+    def kill(self, container):
+        with self.lock:
+            self.running.pop(container, None)
+            self.killed.append(container)
+
+
+def wait_until(cond, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            raise AssertionError('timeout')
+        time.sleep(0.01)
+
+
+class TestContainerPool(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeDockerClient()
+
+    def _idle(self, pool, image, compile=False):
+        return list(pool._idle.get((image, compile), []))
+
+    def test_checkout_and_refill(self):
+        pool = ContainerPool(1, 2, 60, client_factory=lambda: self.client)
+        try:
+            # 初回はプールが空なので払い出せず、補充が始まる
+            self.assertIsNone(pool.checkout('img'))
+            wait_until(lambda: len(self._idle(pool, 'img')) == 2)
+            c = pool.checkout('img')
+            self.assertIsNotNone(c)
+            self.assertNotIn(c, self._idle(pool, 'img'))
+            wait_until(lambda: len(self._idle(pool, 'img')) == 2)
+
+            # 使用済みコンテナは削除される
+            pool.release([c, None])
+            wait_until(lambda: c in self.client.killed)
+        finally:
+            pool.close()
+        self.assertEqual(self.client.running, {})
+
+    def test_reserve(self):
+        pool = ContainerPool(0, 2, 60, client_factory=lambda: self.client)
+        try:
+            # 払い出し前に予約した分を事前に作成する(max_size上限)
+            pool.reserve('img', 5)
+            wait_until(lambda: len(self._idle(pool, 'img')) == 2)
+            self.assertIsNotNone(pool.checkout('img'))
+        finally:
+            pool.close()
+
+    def test_health_check(self):
+        pool = ContainerPool(2, 2, 0.1, client_factory=lambda: self.client)
+        try:
+            self.assertIsNone(pool.checkout('img', compile=True))
+            wait_until(lambda: len(self._idle(pool, 'img', True)) == 2)
+            dead = self._idle(pool, 'img', True)[0]
+            self.client.running[dead] = False
+            wait_until(lambda: dead in self.client.killed)
+            wait_until(lambda: len(self._idle(pool, 'img', True)) == 2)
+            self.assertNotIn(dead, self._idle(pool, 'img', True))
+        finally:
+            pool.close()
+
+
+class TestCPULocks(unittest.TestCase):
+    @unittest.mock.patch('os.sched_getaffinity', return_value={0, 1, 2})
+    def test_acquire(self, _):
+        with TemporaryDirectory() as tmpdir:
+            a, b = CPULocks(tmpdir), CPULocks(tmpdir)
+            self.assertEqual(a.acquire(1), [0])
+            # 他のプロセス(ここでは別インスタンス)が確保済みのCPUは使わない
+            self.assertEqual(b.acquire(3), [1, 2])
+            b.release()
+            a.release()
+            self.assertEqual(b.acquire(2), [0, 1])
+            b.release()
+
+
+class TestAttach(unittest.TestCase):
+    def test_demux(self):
+        def frame(kind, data):
+            return struct.pack('>BxxxI', kind, len(data)) + data
+
+        async def handler(reader, writer):
+            # dockerの代わりにアップグレード応答を返し、受信したデータを
+            # stderrのフレームを挟みつつ細かいstdoutのフレームに分けて返す
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(b'HTTP/1.1 101 UPGRADED\r\n'
+                         b'Connection: Upgrade\r\n\r\n')
+            data = await reader.readexactly(100000)
+            for i in range(0, len(data), 30000):
+                writer.write(frame(2, b'error'))
+                writer.write(frame(1, data[i:i + 30000]))
+            await writer.drain()
+            writer.close()
+
+        async def main(path):
+            server = await asyncio.start_unix_server(handler, path)
+            client = docker.APIClient(
+                base_url='unix://' + path, version='1.40')
+            strm = await _attach(_attach_params(client), 'container')
+            data = bytes(range(100)) * 1000
+            await strm.write(data[:10], memoryview(data)[10:])
+            self.assertEqual(await strm.readexactly(4), data[:4])
+            self.assertEqual(await strm.readexactly(99990), data[4:99994])
+            self.assertEqual(await strm.readexactly(6), data[99994:])
+            with self.assertRaises(EOFError):
+                await strm.readexactly(1)
+            strm.close()
+            server.close()
+            await server.wait_closed()
+
+        loop = asyncio.new_event_loop()
+        try:
+            with TemporaryDirectory() as tmpdir:
+                loop.run_until_complete(
+                    main(os.path.join(tmpdir, 'docker.sock')))
+        finally:
+            loop.close()
+
+    def test_params(self):
+        client = docker.APIClient(base_url='tcp://docker:2375', version='1.40')
+        self.assertEqual(
+            {'host': 'docker', 'port': 2375}, _attach_params(client))
+        # 作成/削除に使うクライアントと同じTLS設定で接続する
+        for verify, mode in ((True, ssl.CERT_REQUIRED),
+                             (False, ssl.CERT_NONE)):
+            client = docker.APIClient(
+                base_url='tcp://docker:2376', version='1.40',
+                tls=docker.tls.TLSConfig(verify=verify))
+            params = _attach_params(client)
+            self.assertIsInstance(params.pop('ssl'), ssl.SSLContext)
+            self.assertEqual(
+                {'host': 'docker', 'port': 2376, 'server_hostname': 'docker'},
+                params)
+            self.assertEqual(mode, _attach_params(client)['ssl'].verify_mode)
@@ -0,0 +1,42 @@
+import os
+import pickle
+import unittest
+
+import msgpack  # type: ignore
+
+from penguin_judge.job import JudgeJob, decode_job, encode_job, make_job
+from penguin_judge.models import Environment
+
+
+class _Evil(object):
+    def __reduce__(self):
+        return (os.system, ('true',))
+
+
+class TestJudgeJob(unittest.TestCase):
+    def test_roundtrip(self):
+        env = Environment(id=1, compile_image_name=None, test_image_name='t')
+        job = make_job('abc', 'A', [(1, 10), (2, None)], [env])
+        body = encode_job(job)
+        self.assertEqual(job, decode_job(body))
+        self.assertEqual((None, 't'), job.environment(1))
+        self.assertIsNone(job.environment(2))
+        self.assertLess(len(body), len(pickle.dumps(job)))
+
+        job = JudgeJob(contest_id='abc', problem_id='A', submissions=[(1, 2)])
+        self.assertEqual(job, decode_job(encode_job(job)))
+
+    def test_legacy_and_invalid(self):
+        self.assertEqual(
+            JudgeJob('abc', 'A', [(5, None)]),
+            decode_job(pickle.dumps(('abc', 'A', 5))))
+        # 問題の制限を含む以前のメッセージも読み込める(制限は無視する)
+        self.assertEqual(
+            JudgeJob('abc', 'A', [(1, None)], [(1, 'c', 't')]),
+            decode_job(msgpack.packb(
+                [1, 'abc', 'A', [[1, None]], [2, 256, None, 3],
+                 [[1, 'c', 't']]])))
+        for body in (b'', b'invalid', pickle.dumps(_Evil()),
+                     encode_job(JudgeJob('abc', 'A', []))[:-1]):
+            with self.assertRaises(ValueError):
+                decode_job(body)
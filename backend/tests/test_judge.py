@@ -0,0 +1,253 @@
+import asyncio
+from datetime import datetime, timezone, timedelta
+from tempfile import TemporaryDirectory
+import unittest
+import unittest.mock
+
+from zstandard import ZstdCompressor  # type: ignore
+
+from penguin_judge.judge import (
+    AsyncJudgeDriver, JudgeDriver, JudgeTask, JudgeTestInfo, AgentTestResult,
+    AgentError, AgentCompilationResult)
+from penguin_judge.judge.cache import DiskCache
+from penguin_judge.judge.main import (
+    run, run_async, configure as configure_judge)
+from penguin_judge.models import (
+    User, Environment, Contest, Problem, TestCase, Submission, JudgeResult,
+    JudgeStatus, Standing, StandingsState, Token, CompileCache, configure,
+    transaction)
+from penguin_judge.utils import content_hash
+from . import TEST_DB_URL
+
+
+class FakeJudgeDriver(JudgeDriver):
+    # 入力をそのまま出力として返す。入力が'TLE'の場合はTLEとする
+    compiled = 0
+
+    def compile(self, task):
+        FakeJudgeDriver.compiled += 1
+        return AgentCompilationResult(binary=b'binary', time=0.5)
+
+    def tests(self, task, start_test_callback, judge_complete_callback):
+        for test in task.tests:
+            if not start_test_callback(test.id):
+                return
+            judge_complete_callback(test, self.run_test(test))
+
+    def run_test(self, test):
+        if test.input == b'TLE':
+            return AgentError(kind='TimeLimitExceeded')
+        return AgentTestResult(output=test.input, time=0.1, memory_bytes=2048)
+
+
+class FakeAsyncJudgeDriver(AsyncJudgeDriver):
+    def __init__(self):
+        self._driver = FakeJudgeDriver()
+
+    async def compile(self, task):
+        await asyncio.sleep(0)
+        return self._driver.compile(task)
+
+    async def tests(self, task, start_test_callback, judge_complete_callback):
+        for test in task.tests:
+            await asyncio.sleep(0)
+            if not start_test_callback(test.id):
+                return
+            judge_complete_callback(test, self._driver.run_test(test))
+
+
+class TestJudge(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        configure(**{'sqlalchemy.url': TEST_DB_URL}, drop_all=True)
+
+    def setUp(self):
+        tables = (
+            Standing, StandingsState, JudgeResult, Submission, TestCase,
+            Problem, Contest, Environment, Token, User, CompileCache)
+        now = datetime.now(tz=timezone.utc)
+        with transaction() as s:
+            for t in tables:
+                s.query(t).delete(synchronize_session=False)
+            user = User(login_id='user', name='User', salt=b'', password=b'')
+            env = Environment(name='Env', test_image_name='image')
+            s.add_all([user, env, Contest(
+                id='c', title='C', description='', start_time=now,
+                end_time=now + timedelta(hours=1))])
+            s.flush()
+            s.add(Problem(
+                contest_id='c', id='A', title='A', description='',
+                time_limit=1, memory_limit=256, score=100))
+            s.flush()
+            submission = Submission(
+                contest_id='c', problem_id='A', user_id=user.id, code=b'',
+                code_bytes=0, environment_id=env.id,
+                status=JudgeStatus.Running)
+            s.add(submission)
+            s.flush()
+            self.user_id, self.submission_id = user.id, submission.id
+
+    def _task(self, inputs, outputs=None):
+        ctx = ZstdCompressor()
+        outputs = outputs or inputs
+        tests = []
+        with transaction() as s:
+            for i, (x, y) in enumerate(zip(inputs, outputs)):
+                test_id = '{:03d}'.format(i)
+                s.add(TestCase(
+                    contest_id='c', problem_id='A', id=test_id,
+                    input=ctx.compress(x), output=ctx.compress(y)))
+                s.flush()
+                s.add(JudgeResult(
+                    contest_id='c', problem_id='A', test_id=test_id,
+                    submission_id=self.submission_id))
+                tests.append(JudgeTestInfo(
+                    id=test_id, input=ctx.compress(x),
+                    output=ctx.compress(y)))
+        return JudgeTask(
+            id=self.submission_id, contest_id='c', problem_id='A',
+            user_id=self.user_id, code=ctx.compress(b'code'),
+            compile_image_name='compile', test_image_name='test',
+            time_limit=1, memory_limit=256, tests=tests)
+
+    def _results(self):
+        with transaction() as s:
+            submission = s.query(Submission).filter(
+                Submission.id == self.submission_id).one()
+            return submission.to_dict(), {
+                r.test_id: r.to_dict() for r in s.query(JudgeResult)}
+
+    def test_run(self):
+        task = self._task([b'1', b'2', b'TLE'], [b'1', b'3', b'TLE'])
+        self.assertEqual(
+            run(FakeJudgeDriver, task), JudgeStatus.WrongAnswer)
+        submission, results = self._results()
+        self.assertEqual(submission['status'], JudgeStatus.WrongAnswer)
+        self.assertEqual(submission['compile_time'], timedelta(seconds=0.5))
+        self.assertEqual(submission['max_memory'], 2)
+        self.assertEqual(
+            [results[k]['status'] for k in sorted(results)],
+            [JudgeStatus.Accepted, JudgeStatus.WrongAnswer,
+             JudgeStatus.TimeLimitExceeded])
+        self.assertEqual(results['000']['time'], timedelta(seconds=0.1))
+        self.assertNotIn('time', results['002'])
+
+    def test_run_async(self):
+        task = self._task([b'1', b'2', b'TLE'], [b'1', b'3', b'TLE'])
+        configure_judge(result_flush_tests=1)
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(
+                loop.run_until_complete(run_async(FakeAsyncJudgeDriver, task)),
+                JudgeStatus.WrongAnswer)
+        finally:
+            loop.close()
+            configure_judge(result_flush_tests=10)
+        submission, results = self._results()
+        self.assertEqual(submission['status'], JudgeStatus.WrongAnswer)
+        self.assertEqual(submission['compile_time'], timedelta(seconds=0.5))
+        self.assertEqual(
+            [results[k]['status'] for k in sorted(results)],
+            [JudgeStatus.Accepted, JudgeStatus.WrongAnswer,
+             JudgeStatus.TimeLimitExceeded])
+
+    def test_batched_result_writes(self):
+        import penguin_judge.judge.main as judge_main
+        inputs = [str(i).encode('ascii') for i in range(25)]
+        task = self._task(inputs)
+        configure_judge(result_flush_tests=10, result_flush_interval=60000)
+        counter = unittest.mock.Mock(wraps=judge_main.transaction)
+        with unittest.mock.patch.object(judge_main, 'transaction', counter):
+            self.assertEqual(
+                run(FakeJudgeDriver, task), JudgeStatus.Accepted)
+        # 50回の状態更新が10テスト単位の書き込み2回+最終更新1回にまとまる
+        self.assertEqual(counter.call_count, 3)
+        _, results = self._results()
+        self.assertEqual(len(results), 25)
+        self.assertTrue(all(
+            r['status'] == JudgeStatus.Accepted for r in results.values()))
+
+    def test_max_failures(self):
+        task = self._task(
+            [b'1', b'2', b'3', b'4', b'5'], [b'1', b'x', b'3', b'x', b'5'])
+        task.max_failures = 2
+        self.assertEqual(
+            run(FakeJudgeDriver, task), JudgeStatus.WrongAnswer)
+        submission, results = self._results()
+        self.assertEqual(submission['status'], JudgeStatus.WrongAnswer)
+        self.assertEqual(
+            [results[k]['status'] for k in sorted(results)],
+            [JudgeStatus.Accepted, JudgeStatus.WrongAnswer,
+             JudgeStatus.Accepted, JudgeStatus.WrongAnswer,
+             JudgeStatus.Skipped])
+
+    def test_max_failures_async(self):
+        task = self._task(
+            [b'1', b'2', b'3', b'4'], [b'x', b'x', b'3', b'4'])
+        task.max_failures = 1
+        configure_judge(result_flush_tests=2)
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(
+                loop.run_until_complete(run_async(FakeAsyncJudgeDriver, task)),
+                JudgeStatus.WrongAnswer)
+        finally:
+            loop.close()
+            configure_judge(result_flush_tests=10)
+        _, results = self._results()
+        # 打ち切りの記録とバッファ済みの結果も最終更新で書き込まれる
+        self.assertEqual(
+            [results[k]['status'] for k in sorted(results)],
+            [JudgeStatus.WrongAnswer, JudgeStatus.Skipped,
+             JudgeStatus.Skipped, JudgeStatus.Skipped])
+
+    def test_cached_test_data(self):
+        task = self._task([b'1', b'2'])
+        with TemporaryDirectory() as tmpdir:
+            cache = DiskCache(tmpdir, 1024)
+            for test in task.tests:
+                test.input = test.output = b''
+                test.input_hash = test.output_hash = content_hash(
+                    b'1' if test.id == '000' else b'3')
+            cache.put(task.tests[0].input_hash, b'1')
+            # 000はキャッシュから、001はキャッシュに無いためDBから読み込む
+            configure_judge(test_cache_dir=tmpdir)
+            try:
+                self.assertEqual(
+                    run(FakeJudgeDriver, task), JudgeStatus.Accepted)
+                # 終了後はマップが解放されている
+                self.assertIsInstance(task.tests[0].input, memoryview)
+                with self.assertRaises(ValueError):
+                    bytes(task.tests[0].input)
+            finally:
+                configure_judge(test_cache_dir=None)
+
+    def test_compile_cache(self):
+        def _run(**config):
+            task = self._task([b'1'])
+            configure_judge(**config)
+            try:
+                compiled = FakeJudgeDriver.compiled
+                self.assertEqual(
+                    run(FakeJudgeDriver, task), JudgeStatus.Accepted)
+                self.assertEqual(task.code, b'binary')
+                with transaction() as s:
+                    s.query(JudgeResult).delete()
+                    s.query(TestCase).delete()
+                    compile_time = s.query(Submission.compile_time).scalar()
+                self.assertEqual(compile_time, timedelta(seconds=0.5))
+                return FakeJudgeDriver.compiled - compiled
+            finally:
+                configure_judge(
+                    compile_cache_dir=None, compile_cache_db=False)
+
+        with TemporaryDirectory() as tmpdir:
+            self.assertEqual(_run(compile_cache_dir=tmpdir), 1)
+            self.assertEqual(_run(compile_cache_dir=tmpdir), 0)
+            # DBに無いのでコンパイルしてDBに保存する
+            self.assertEqual(_run(compile_cache_db=True), 1)
+        with TemporaryDirectory() as tmpdir:
+            # ローカルに無くてもDBから取得できる
+            self.assertEqual(
+                _run(compile_cache_dir=tmpdir, compile_cache_db=True), 0)
+            self.assertEqual(_run(compile_cache_dir=tmpdir), 0)
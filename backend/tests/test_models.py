@@ -0,0 +1,33 @@
+import unittest
+
+from penguin_judge.models import configure, transaction, upgrade_indexes
+from . import TEST_DB_URL
+
+
+class TestUpgradeIndexes(unittest.TestCase):
+    def setUp(self):
+        configure(**{'sqlalchemy.url': TEST_DB_URL}, drop_all=True)
+
+    def _valid(self, name):
+        with transaction() as s:
+            return s.execute(
+                'SELECT indisvalid FROM pg_index '
+                'WHERE indexrelid = to_regclass(:name)',
+                {'name': name}).scalar()
+
+    def test_upgrade(self):
+        # create_allで作成済みの場合は何もしない
+        self.assertEqual([], upgrade_indexes())
+        with transaction() as s:
+            s.execute('DROP INDEX judge_results_submission_idx')
+            # 作成が中断されて無効なまま残ったインデックス
+            s.execute(
+                'UPDATE pg_index SET indisvalid = false '
+                "WHERE indexrelid = 'submissions_lease_idx'::regclass")
+        self.assertIsNone(self._valid('judge_results_submission_idx'))
+        self.assertFalse(self._valid('submissions_lease_idx'))
+        self.assertEqual(
+            ['judge_results_submission_idx', 'submissions_lease_idx'],
+            upgrade_indexes())
+        self.assertTrue(self._valid('judge_results_submission_idx'))
+        self.assertTrue(self._valid('submissions_lease_idx'))
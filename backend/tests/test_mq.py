@@ -0,0 +1,54 @@
+import unittest
+import unittest.mock
+
+from pika.exceptions import StreamLostError  # type: ignore
+
+from penguin_judge.mq import (
+    PRIORITY_REJUDGE, Publisher, judge_queue_name, priority_of_queue)
+
+
+@unittest.mock.patch('penguin_judge.mq.get_mq_conn_params')
+@unittest.mock.patch('pika.BlockingConnection')
+class TestPublisher(unittest.TestCase):
+    def test_reuse_connection(self, mock_conn, _):
+        p = Publisher(pool_size=2)
+        p.publish(b'0')
+        p.publish_batch([b'1', b'2', b'3'])
+        p.publish_batch([])
+        self.assertEqual(mock_conn.call_count, 1)
+        ch = mock_conn.return_value.channel.return_value
+        self.assertEqual(ch.queue_declare.call_count, 1)
+        self.assertEqual(
+            [c[1]['body'] for c in ch.basic_publish.call_args_list],
+            [b'0', b'1', b'2', b'3'])
+        ch.tx_select.assert_not_called()
+
+    def test_reconnect(self, mock_conn, _):
+        p = Publisher(pool_size=2, confirm=True)
+        p.publish(b'0')
+        ch = mock_conn.return_value.channel.return_value
+        ch.basic_publish.side_effect = [StreamLostError(), None, None]
+        p.publish_batch([b'1', b'2'])
+        self.assertEqual(mock_conn.call_count, 2)
+        self.assertEqual(ch.tx_commit.call_count, 2)
+
+        # トランザクション無しで一部送信済みの場合は再送しない
+        p = Publisher(pool_size=2)
+        ch.basic_publish.side_effect = [None, StreamLostError()]
+        with self.assertRaises(StreamLostError):
+            p.publish_batch([b'1', b'2'])
+
+    def test_headers(self, mock_conn, _):
+        p = Publisher(pool_size=2)
+        p.publish(b'0', routing_key=judge_queue_name(PRIORITY_REJUDGE),
+                  headers={'user_id': 1})
+        p.publish_batch([b'1', b'2'], headers=[{'user_id': 2}, {}])
+        ch = mock_conn.return_value.channel.return_value
+        calls = ch.basic_publish.call_args_list
+        self.assertEqual(calls[0][1]['routing_key'], 'judge_queue.rejudge')
+        self.assertEqual(calls[1][1]['routing_key'], 'judge_queue')
+        self.assertEqual(
+            [c[1]['properties'].headers for c in calls],
+            [{'user_id': 1}, {'user_id': 2}, {}])
+        self.assertEqual(
+            PRIORITY_REJUDGE, priority_of_queue('judge_queue.rejudge'))
@@ -0,0 +1,119 @@
+from base64 import b64encode
+from datetime import datetime, timezone, timedelta
+import unittest
+import unittest.mock
+
+from sqlalchemy import event
+from webtest import TestApp
+
+from penguin_judge.api import app as _app
+from penguin_judge.main import _configure_app
+from penguin_judge.models import Session, Token, configure, transaction
+from . import TEST_DB_URL
+
+# 件数が多くなるため順次走査してはいけないテーブル
+LARGE_TABLES = {'submissions', 'judge_results'}
+
+SEED_STATEMENTS = [
+    "INSERT INTO users (login_id, name, salt, password, admin) "
+    "SELECT 'user' || g, 'User' || g, '', '', g = 1 "
+    "FROM generate_series(1, 500) g",
+    "INSERT INTO environments (name, test_image_name, published) "
+    "VALUES ('Env', 'image', true)",
+    "INSERT INTO contests (id, title, description, start_time, end_time, "
+    "published) SELECT 'c' || g, 'C', '', now() - interval '1 day', "
+    "now() + interval '1 day', true FROM generate_series(1, 200) g",
+    "INSERT INTO problems (contest_id, id, title, description, time_limit, "
+    "memory_limit, score) SELECT 'c' || g, 'A', 'A', '', 1, 256, 100 "
+    "FROM generate_series(1, 200) g",
+    "INSERT INTO tests (contest_id, problem_id, id, input, output) "
+    "SELECT 'c' || g, 'A', t, '', '' "
+    "FROM generate_series(1, 200) g, unnest(ARRAY['000', '001']) t",
+    "INSERT INTO submissions (contest_id, problem_id, user_id, code, "
+    "code_bytes, environment_id, status, created) "
+    "SELECT 'c' || (g % 200 + 1), 'A', (SELECT min(id) FROM users) + g % 500, "
+    "'', 0, (SELECT min(id) FROM environments), "
+    "CASE WHEN g % 1000 = 0 THEN 'Waiting' ELSE 'Accepted' END::judgestatus, "
+    "now() - interval '1 hour' + g * interval '50 ms' "
+    "FROM generate_series(1, 50000) g",
+    "INSERT INTO judge_results (contest_id, problem_id, submission_id, "
+    "test_id, status) SELECT contest_id, problem_id, id, t, 'Accepted' "
+    "FROM submissions, unnest(ARRAY['000', '001']) t",
+]
+
+
+def _seq_scans(plan: dict) -> list:
+    ret = []
+    if plan.get('Node Type') == 'Seq Scan':
+        ret.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        ret.extend(_seq_scans(child))
+    return ret
+
+
+class TestQueryPlans(unittest.TestCase):
+    """主要なAPIが発行するクエリが大きなテーブルを順次走査しないことを
+    実際のクエリのEXPLAINで確認する"""
+
+    @classmethod
+    def setUpClass(cls):
+        configure(**{'sqlalchemy.url': TEST_DB_URL}, drop_all=True)
+        _configure_app({})
+        with transaction() as s:
+            for stmt in SEED_STATEMENTS:
+                s.execute(stmt)
+            user_id, admin_id = s.execute(
+                'SELECT max(id), min(id) FROM users').first()
+            cls.headers = {}
+            expires = datetime.now(tz=timezone.utc) + timedelta(hours=1)
+            for name, uid in (('user', user_id), ('admin', admin_id)):
+                token = bytes([uid % 256]) * 32
+                s.add(Token(token=token, user_id=uid, expires=expires))
+                cls.headers[name] = {
+                    'X-Auth-Token': b64encode(token).decode('ascii')}
+        with transaction() as s:
+            s.execute('ANALYZE')
+
+    def _explain(self, statements):
+        conn = Session.get_bind().raw_connection()
+        try:
+            with conn.cursor() as cur:
+                for stmt, params in statements:
+                    cur.execute('EXPLAIN (FORMAT JSON) ' + stmt, params)
+                    plan = cur.fetchone()[0][0]['Plan']
+                    scans = LARGE_TABLES.intersection(_seq_scans(plan))
+                    self.assertFalse(scans, 'Seq Scan on {}: {}'.format(
+                        scans, stmt))
+        finally:
+            conn.close()
+
+    @unittest.mock.patch('pika.BlockingConnection')
+    @unittest.mock.patch('penguin_judge.mq.get_mq_conn_params')
+    def test_hot_queries(self, *_):
+        app = TestApp(_app)
+        statements = []
+
+        def _capture(conn, cursor, stmt, params, context, executemany):
+            if stmt.lstrip().upper().startswith('SELECT'):
+                statements.append((stmt, params))
+
+        engine = Session.get_bind()
+        event.listen(engine, 'before_cursor_execute', _capture)
+        try:
+            submission_id = app.post_json('/contests/c1/submissions', {
+                'problem_id': 'A', 'environment_id': 1, 'code': 'x',
+            }, headers=self.headers['user'], status=201).json['id']
+            app.get('/contests/c1/submissions', headers=self.headers['user'])
+            cursor = app.get(
+                '/contests/c1/submissions?total=estimate',
+                headers=self.headers['admin']).headers['X-Next-Cursor']
+            app.get('/contests/c1/submissions?cursor=' + cursor,
+                    headers=self.headers['admin'])
+            app.get('/contests/c1/submissions/{}'.format(submission_id),
+                    headers=self.headers['admin'])
+            app.get('/contests/c1/rankings')
+            app.get('/contests/c1/rankings')
+        finally:
+            event.remove(engine, 'before_cursor_execute', _capture)
+        self.assertTrue(any('submissions' in s for s, _ in statements))
+        self._explain(statements)
@@ -0,0 +1,57 @@
+import unittest
+
+from penguin_judge.scheduler import FairScheduler, parse_weights
+
+
+class TestFairScheduler(unittest.TestCase):
+    def _drain(self, s):
+        ret = []
+        while True:
+            x = s.pop()
+            if x is None:
+                return ret
+            ret.append(x)
+
+    def test_parse_weights(self):
+        self.assertEqual(
+            {'submission': 8, 'rejudge': 1},
+            parse_weights('submission:8, rejudge:1,'))
+        with self.assertRaises(ValueError):
+            parse_weights('rejudge:0')
+
+    def test_weighted_classes(self):
+        s = FairScheduler({'submission': 3, 'rejudge': 1})
+        for i in range(8):
+            s.push('rejudge', 1, 'r{}'.format(i))
+        for i in range(3):
+            s.push('submission', 2, 's{}'.format(i))
+        self.assertEqual({'submission': 3, 'rejudge': 8}, s.depth())
+        self.assertEqual(11, len(s))
+        # リジャッジが先に積まれていても提出を優先しつつ、
+        # リジャッジも重みの比率で取り出される
+        expected = ['s0', 's1', 'r0', 's2', 'r1', 'r2', 'r3', 'r4', 'r5',
+                    'r6', 'r7']
+        # peekは状態を変えずにpopと同じ順序を返す
+        self.assertEqual(expected[:4], s.peek(4))
+        self.assertEqual(expected, s.peek(100))
+        self.assertEqual(expected, self._drain(s))
+        self.assertEqual([], s.peek(1))
+        self.assertEqual(0, len(s))
+
+    def test_user_fairness(self):
+        s = FairScheduler({'submission': 1})
+        for i in range(4):
+            s.push('submission', 'a', 'a{}'.format(i))
+        s.push('submission', 'b', 'b0')
+        s.push('submission', None, 'n0')
+        s.push('unknown', 'c', 'c0')
+        expected = ['a0', 'c0', 'b0', 'n0', 'a1', 'a2', 'a3']
+        self.assertEqual(expected, s.peek(7))
+        self.assertEqual(expected, self._drain(s))
+
+    def test_clear(self):
+        s = FairScheduler({'submission': 1})
+        s.push('submission', 1, 'x')
+        s.clear()
+        self.assertIsNone(s.pop())
+        self.assertEqual({'submission': 0}, s.depth())
@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta, timezone
+import json
+import unittest
+import unittest.mock
+
+from penguin_judge import utils
+from penguin_judge.models import JudgeStatus
+
+
+class TestUtils(unittest.TestCase):
+    def test_json_dumps(self):
+        jst = timezone(timedelta(hours=9))
+        o = {
+            'id': 1, 'title': 'ほげ', 'ok': True, 'none': None, 'x': 0.5,
+            'created': datetime(2020, 1, 1, 9, tzinfo=jst),
+            'time': timedelta(milliseconds=1500),
+            'code': b'\x00\x01', 'status': JudgeStatus.Accepted,
+            'tests': [{'status': JudgeStatus.WrongAnswer, 'memory': 2}],
+            '_token_bytes': b'secret',
+        }
+        expected = {
+            'id': 1, 'title': 'ほげ', 'ok': True, 'none': None, 'x': 0.5,
+            'created': '2020-01-01T00:00:00+00:00', 'time': 1.5,
+            'code': 'AAE=', 'status': 'Accepted',
+            'tests': [{'status': 'WrongAnswer', 'memory': 2}],
+        }
+        self.assertEqual(json.loads(utils.json_dumps(o)), expected)
+        with unittest.mock.patch.object(utils, 'orjson', None):
+            self.assertEqual(json.loads(utils.json_dumps(o)), expected)
+            self.assertEqual(utils.json_dumps([]), b'[]')
@@ -0,0 +1,342 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import os
+from tempfile import TemporaryDirectory
+import threading
+import unittest
+import unittest.mock
+
+from pika.exceptions import AMQPError  # type: ignore
+from sqlalchemy import event
+from zstandard import ZstdCompressor  # type: ignore
+
+from penguin_judge.job import JudgeJob, decode_job
+from penguin_judge.judge import JudgeTask
+from penguin_judge.judge.cache import load, store
+from penguin_judge.main import _worker_options
+from penguin_judge.models import (
+    JudgeResult, JudgeStatus, Session, Submission, TestCase, configure,
+    transaction)
+from penguin_judge.utils import content_hash
+from penguin_judge.worker import Worker, hydrate_task
+from . import TEST_DB_URL
+
+SEED_STATEMENTS = [
+    "INSERT INTO users (login_id, name, salt, password) "
+    "VALUES ('user', 'User', '', '')",
+    "INSERT INTO environments (name, compile_image_name, test_image_name) "
+    "VALUES ('Env', 'compile', 'test')",
+    "INSERT INTO contests (id, title, description, start_time, end_time) "
+    "VALUES ('c', 'C', '', now(), now() + interval '1 hour')",
+    "INSERT INTO problems (contest_id, id, title, description, time_limit, "
+    "memory_limit, score, max_failures) "
+    "VALUES ('c', 'A', 'A', '', 2, 256, 100, 1)",
+    "INSERT INTO tests (contest_id, problem_id, id, input_hash, output_hash) "
+    "SELECT 'c', 'A', t, 'i' || t, 'o' || t "
+    "FROM unnest(ARRAY['1', '2', '3']) t",
+    "INSERT INTO submissions (contest_id, problem_id, user_id, code, "
+    "code_bytes, environment_id) SELECT 'c', 'A', "
+    "(SELECT min(id) FROM users), 'code', 4, "
+    "(SELECT min(id) FROM environments)",
+    # ワーカーダウン前にジャッジ済みの結果とジャッジ中だった結果
+    "INSERT INTO judge_results (contest_id, problem_id, submission_id, "
+    "test_id, status) SELECT 'c', 'A', id, t, s::judgestatus "
+    "FROM submissions, (VALUES ('1', 'Accepted'), ('2', 'Running')) v(t, s)",
+]
+
+
+class TestHydrateTask(unittest.TestCase):
+    def setUp(self):
+        configure(**{'sqlalchemy.url': TEST_DB_URL}, drop_all=True)
+        with transaction() as s:
+            for stmt in SEED_STATEMENTS:
+                s.execute(stmt)
+            self.submission_id = s.query(Submission.id).scalar()
+
+    def _hydrate(self, job):
+        statements = []
+
+        def _count(conn, cursor, statement, *args):
+            statements.append(statement)
+        engine = Session.get_bind()
+        event.listen(engine, 'before_cursor_execute', _count)
+        try:
+            with transaction() as s:
+                task = hydrate_task(s, job, self.submission_id, 4)
+        finally:
+            event.remove(engine, 'before_cursor_execute', _count)
+        return task, [x for x in statements if not x.startswith((
+            'BEGIN', 'COMMIT', 'SELECT pg_advisory'))]
+
+    def test_hydrate(self):
+        task, statements = self._hydrate(JudgeJob('c', 'A', []))
+        self.assertEqual('compile', task.compile_image_name)
+        self.assertEqual('test', task.test_image_name)
+        self.assertEqual((2, 256, 4, 1), (
+            task.time_limit, task.memory_limit, task.parallelism,
+            task.max_failures))
+        self.assertEqual(b'code', task.code)
+        self.assertEqual(
+            [('2', 'i2', 'o2'), ('3', 'i3', 'o3')],
+            sorted((t.id, t.input_hash, t.output_hash) for t in task.tests))
+        # 提出+環境+問題, テスト+結果, 状態の更新, 結果の追加 (+順位表)
+        self.assertEqual(1, sum(
+            'FOR UPDATE' in x for x in statements))
+        self.assertEqual(1, sum(
+            x.startswith('INSERT INTO judge_results') for x in statements))
+        with transaction() as s:
+            self.assertEqual(JudgeStatus.Running, s.query(
+                Submission.status).scalar())
+            self.assertEqual(
+                {'1': JudgeStatus.Accepted, '2': JudgeStatus.Running,
+                 '3': JudgeStatus.Waiting},
+                dict(s.query(JudgeResult.test_id, JudgeResult.status)))
+
+        # ジャッジ中の提出は再度ジャッジできる。メッセージに環境が含まれる
+        # 場合は結合しない。問題の制限は変更後の値を使う
+        with transaction() as s:
+            env_id = s.execute('SELECT min(id) FROM environments').scalar()
+            s.execute('UPDATE problems SET time_limit = 1, parallelism = 2')
+        task, statements = self._hydrate(JudgeJob(
+            'c', 'A', [], [(env_id, None, 'x')]))
+        self.assertEqual((None, 'x', 1, 2, 1), (
+            task.compile_image_name, task.test_image_name, task.time_limit,
+            task.parallelism, task.max_failures))
+        self.assertEqual(2, len(task.tests))
+        self.assertFalse(any('environments' in x for x in statements))
+        self.assertFalse(any(
+            x.startswith('INSERT INTO judge_results') for x in statements))
+
+        with transaction() as s:
+            s.query(Submission).update({Submission.status: 'Accepted'})
+        self.assertIsNone(self._hydrate(JudgeJob('c', 'A', []))[0])
+
+    def test_lease(self):
+        job = JudgeJob('c', 'A', [])
+        with transaction() as s:
+            self.assertIsNotNone(hydrate_task(
+                s, job, self.submission_id, 1, owner=('host', 1),
+                lease_timeout=60, priority='rejudge'))
+        with transaction() as s:
+            submission = s.query(Submission).one()
+            self.assertEqual(('host', 1, 'rejudge'), (
+                submission.lease_hostname, submission.lease_pid,
+                submission.lease_priority))
+            self.assertGreater(
+                submission.lease_expires, datetime.now(tz=timezone.utc))
+        # リースが有効な間は再配送されてもジャッジしない
+        with transaction() as s:
+            self.assertIsNone(hydrate_task(
+                s, job, self.submission_id, 1, owner=('other', 2)))
+        with transaction() as s:
+            s.query(Submission).update({
+                Submission.lease_expires:
+                datetime.now(tz=timezone.utc) - timedelta(seconds=1)})
+        with transaction() as s:
+            self.assertIsNotNone(hydrate_task(
+                s, job, self.submission_id, 1, owner=('other', 2)))
+
+
+class TestThreadMode(unittest.TestCase):
+    @unittest.mock.patch('docker.APIClient')
+    def test_shared_client(self, client_class):
+        with TemporaryDirectory() as tmpdir:
+            options = _worker_options({
+                'judge_mode': 'thread', 'test_cache_dir': tmpdir + '/t',
+                'compile_cache_dir': tmpdir + '/c',
+                'container_pool_max': '1', 'test_parallelism': '2'})
+            with Worker({}, 8, options) as worker:
+                self.assertIsInstance(worker._executor, ThreadPoolExecutor)
+                self.assertEqual(8, worker._executor._max_workers)
+                # ジャッジとコンテナプールで1つのクライアントを共有する
+                client_class.assert_called_once_with(max_pool_size=18)
+                client = client_class.return_value
+                self.assertIs(client, worker._judge_class().client)
+                self.assertIs(client, worker._judge_class().client)
+                self.assertIs(
+                    client, worker._container_pool._client_factory())
+            client.close.assert_called_once_with()
+
+
+class TestProcess(unittest.TestCase):
+    def test_hydrate_off_loop(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        threads = []
+
+        def _hydrate(*args, **kwargs):
+            threads.append(threading.current_thread())
+            if len(threads) > 1:
+                raise RuntimeError()
+            return None
+
+        with TemporaryDirectory() as tmpdir, unittest.mock.patch(
+                'penguin_judge.worker.hydrate_task', side_effect=_hydrate):
+            worker = Worker({}, 1, _worker_options({
+                'judge_mode': 'async', 'test_cache_dir': tmpdir + '/t',
+                'compile_cache_dir': tmpdir + '/c'}))
+            worker._loop = loop
+            # ジャッジ不要の場合はackし、失敗した場合は枠のみ返す
+            for acked in (True, False):
+                delivery = unittest.mock.MagicMock()
+                release = unittest.mock.MagicMock(
+                    side_effect=lambda: loop.call_soon(loop.stop))
+                loop.call_soon(
+                    worker._process, delivery, JudgeJob('c', 'A', []), 1,
+                    release)
+                timeout = loop.call_later(5, loop.stop)
+                loop.run_forever()
+                timeout.cancel()
+                release.assert_called_once_with()
+                self.assertEqual(acked, delivery.done.called)
+            # 提出の更新はイベントループのスレッドで行わない
+            self.assertNotIn(threading.main_thread(), threads)
+            self.assertEqual(2, len(threads))
+            worker._hydrator.shutdown()
+
+
+class TestCompileCache(unittest.TestCase):
+    def test_lru(self):
+        with TemporaryDirectory() as tmpdir:
+            worker = Worker({}, 1, _worker_options({
+                'judge_mode': 'async', 'test_cache_dir': tmpdir + '/t',
+                'compile_cache_dir': tmpdir + '/c',
+                'compile_cache_size': '1'}))
+            cache = worker._compile_cache
+            for i, key in enumerate(('a', 'b')):
+                store(cache.path(''), key, b'x' * 2**19)
+                os.utime(cache.path(key), (i, i))
+            # ジャッジプロセスが読み込んだエントリは最近使われたものとして残る
+            self.assertEqual(b'x' * 2**19, load(cache.path(''), 'a'))
+            store(cache.path(''), 'c', b'x')
+            cache.scan()
+            self.assertTrue(cache.contains('a'))
+            self.assertFalse(cache.contains('b'))
+
+    def test_is_compiled(self):
+        with TemporaryDirectory() as tmpdir:
+            worker = Worker({}, 1, _worker_options({
+                'judge_mode': 'async', 'test_cache_dir': tmpdir + '/t',
+                'compile_cache_dir': tmpdir + '/c'}))
+            task = JudgeTask(
+                id=1, contest_id='c', problem_id='A', user_id=1,
+                code=ZstdCompressor().compress(b'code'),
+                compile_image_name='compile', test_image_name='test',
+                time_limit=1, memory_limit=1, parallelism=1, tests=[])
+            self.assertFalse(worker._is_compiled(task))
+            # scan()前でもジャッジプロセスが書き込んだバイナリを見つける
+            store(worker._compile_cache.path(''),
+                  content_hash(b'compile\0code'), b'binary')
+            self.assertTrue(worker._is_compiled(task))
+
+
+class TestPrefetch(unittest.TestCase):
+    def setUp(self):
+        configure(**{'sqlalchemy.url': TEST_DB_URL}, drop_all=True)
+        cctx = ZstdCompressor()
+        with transaction() as s:
+            for stmt in SEED_STATEMENTS[:4] + SEED_STATEMENTS[5:6]:
+                s.execute(stmt)
+            for i in range(2):
+                s.add(TestCase(
+                    contest_id='c', problem_id='A', id=str(i),
+                    input=cctx.compress(b'in' * 100),
+                    input_hash=content_hash(b'in' * 100), input_size=200,
+                    output=cctx.compress(str(i).encode()),
+                    output_hash=content_hash(str(i).encode()),
+                    output_size=1))
+            self.submission_id = s.query(Submission.id).scalar()
+
+    def test_warm(self):
+        with TemporaryDirectory() as tmpdir:
+            worker = Worker({}, 1, _worker_options({
+                'judge_mode': 'async', 'test_cache_dir': tmpdir + '/t',
+                'compile_cache_dir': tmpdir + '/c'}))
+            jobs = [(JudgeJob('c', 'A', []), self.submission_id)]
+            # 上限を超える場合は先読みしない
+            self.assertEqual(
+                {self.submission_id: -1}, worker._warm(jobs, jobs, 300))
+            self.assertFalse(worker._test_cache.contains(
+                content_hash(b'in' * 100)))
+            self.assertEqual(
+                {self.submission_id: 402}, worker._warm(jobs, jobs, 1024))
+            for data in (b'in' * 100, b'0', b'1'):
+                self.assertTrue(worker._test_cache.contains(
+                    content_hash(data)))
+            # キャッシュ済みのデータは数えない
+            self.assertEqual(
+                {self.submission_id: 0}, worker._warm(jobs, jobs, 0))
+
+
+class TestLeaseMaintenance(unittest.TestCase):
+    def setUp(self):
+        configure(**{'sqlalchemy.url': TEST_DB_URL}, drop_all=True)
+        now = datetime.now(tz=timezone.utc)
+        with transaction() as s:
+            for stmt in SEED_STATEMENTS[:6]:
+                s.execute(stmt)
+            s.execute(SEED_STATEMENTS[5])
+            s.execute(SEED_STATEMENTS[5])
+            ids = [x for x, in s.query(Submission.id).order_by(
+                Submission.id)]
+            # 自身がジャッジ中, 停止したワーカーがリジャッジ中, 完了済み
+            for i, (host, expires, status) in enumerate((
+                    ('self', now, 'Running'),
+                    ('dead', now - timedelta(seconds=1), 'Running'),
+                    (None, None, 'Accepted'))):
+                s.query(Submission).filter(Submission.id == ids[i]).update({
+                    Submission.lease_hostname: host,
+                    Submission.lease_pid: host and 1,
+                    Submission.lease_expires: expires,
+                    Submission.lease_priority: host and 'rejudge',
+                    Submission.status: status})
+        self.ids = ids
+
+    def test_renew_and_requeue(self):
+        with TemporaryDirectory() as tmpdir:
+            worker = Worker({}, 1, _worker_options({
+                'judge_mode': 'async', 'test_cache_dir': tmpdir + '/t',
+                'compile_cache_dir': tmpdir + '/c', 'lease_timeout': '60'}))
+            worker._hostname, worker._pid = 'self', 1
+            worker._leased = {self.ids[0]}
+            worker._ch = unittest.mock.MagicMock()
+            publisher = worker._requeue_publisher = unittest.mock.MagicMock()
+            # ブローカーへの送信に失敗した場合は状態を変更せず次回に回収する
+            publisher.publish_batch.side_effect = AMQPError()
+            with self.assertRaises(AMQPError):
+                worker._maintain_leases()
+            with transaction() as s:
+                self.assertEqual(JudgeStatus.Running, s.query(
+                    Submission.status).filter(
+                        Submission.id == self.ids[1]).scalar())
+            publisher.reset_mock(side_effect=True)
+            worker._maintain_leases()
+
+            now = datetime.now(tz=timezone.utc)
+            with transaction() as s:
+                rows = {x.id: x for x in s.query(Submission)}
+                renewed = rows[self.ids[0]]
+                self.assertGreater(
+                    renewed.lease_expires, now + timedelta(seconds=30))
+                self.assertEqual(JudgeStatus.Running, renewed.status)
+                requeued = rows[self.ids[1]]
+                self.assertEqual(JudgeStatus.Waiting, requeued.status)
+                self.assertIsNone(requeued.lease_hostname)
+                self.assertIsNone(requeued.lease_expires)
+                self.assertIsNone(requeued.lease_priority)
+                self.assertIsNone(rows[self.ids[2]].lease_expires)
+            # 取り出した時と同じ優先度クラスのキューに積み直す
+            published = {
+                kwargs['routing_key']: bodies for (bodies,), kwargs
+                in publisher.publish_batch.call_args_list if bodies}
+            self.assertEqual(['judge_queue.rejudge'], list(published))
+            self.assertEqual(1, len(published['judge_queue.rejudge']))
+            job = decode_job(published['judge_queue.rejudge'][0])
+            self.assertEqual(
+                [self.ids[1]], [x for x, _ in job.submissions])
+
+            # 積み直した提出はキューで待っている間は再度積まない
+            publisher.reset_mock()
+            worker._maintain_leases()
+            publisher.publish_batch.assert_not_called()
@@ -37,6 +37,7 @@ export interface Contest {
 export enum JudgeStatus {
   Waiting = 'Waiting',
   Running = 'Running',
+  Skipped = 'Skipped',
   Accepted = 'Accepted',
   CompilationError = 'CompilationError',
   RuntimeError = 'RuntimeError',
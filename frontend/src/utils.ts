@@ -87,6 +87,6 @@ export function input_date_time_elements_to_iso8601(
 
 export function getSubmittionStatusMark(str: string): TemplateResult {
   if (str === JudgeStatus.Accepted) return html`<span class="AC"><x-icon>check_circle</x-icon></span>`;
-  if (str === JudgeStatus.Running || str === JudgeStatus.Waiting) return html``;
+  if (str === JudgeStatus.Running || str === JudgeStatus.Waiting || str === JudgeStatus.Skipped) return html``;
   return html`<span class="WA"><x-icon>error</x-icon></span>`;
 }
@@ -0,0 +1,110 @@
+from argparse import ArgumentParser
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, wait)
+import multiprocessing as mp
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import docker  # noqa: E402
+
+# ワーカー(親プロセス)が読み込むモジュール
+from penguin_judge import models  # noqa: E402
+from penguin_judge.judge import main as judge_main  # noqa: E402, F401
+
+# judge_mode=threadで全スレッドが共有するクライアント
+_shared_client = None
+
+
+def _initializer(db_url):
+    # worker._initializerと同様に子プロセスごとにDBエンジンを作成する
+    from penguin_judge.judge import main  # noqa: F401
+    if db_url:
+        models.configure(**{'sqlalchemy.url': db_url})
+
+
+def _slot(db_url, hold):
+    # 1件のジャッジが保持するもの(Dockerクライアント, DB接続)を確保して待つ。
+    # デーモンに接続しないようにAPIバージョンを指定する
+    client = _shared_client or docker.APIClient(version='1.40')
+    if db_url:
+        with models.transaction() as s:
+            s.execute('SELECT pg_sleep(:t)', {'t': hold})
+    else:
+        time.sleep(hold)
+    return client is not None
+
+
+def pss_kib(pid):
+    """プロセスの比例配分セットサイズ(共有ページは共有数で割る)"""
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def bench(mode, slots, db_url, hold):
+    global _shared_client
+    baseline = pss_kib(os.getpid())
+    if mode == 'thread':
+        if db_url:
+            models.configure(**{
+                'sqlalchemy.url': db_url, 'sqlalchemy.pool_size': slots})
+        _shared_client = docker.APIClient(version='1.40', max_pool_size=slots)
+        executor = ThreadPoolExecutor(max_workers=slots)
+    else:
+        _shared_client = None
+        executor = ProcessPoolExecutor(
+            max_workers=slots, mp_context=mp.get_context('spawn'),
+            initializer=_initializer, initargs=(db_url,))
+    start = time.monotonic()
+    futures = [executor.submit(_slot, db_url, hold) for _ in range(slots)]
+    peak = 0
+    while wait(futures, timeout=0.2).not_done:
+        pids = [os.getpid()]
+        if isinstance(executor, ProcessPoolExecutor):
+            pids += list(executor._processes.keys())
+        total = 0
+        for pid in pids:
+            try:
+                total += pss_kib(pid)
+            except OSError:
+                pass
+        peak = max(peak, total)
+    elapsed = time.monotonic() - start
+    for f in futures:
+        f.result()
+    executor.shutdown()
+    print('{:<8} {:>5} slots  total {:>8.1f} MiB  per slot {:>6.2f} MiB  '
+          '({:.1f} s)'.format(
+              mode, slots, peak / 1024, (peak - baseline) / 1024 / slots,
+              elapsed))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--slots', type=int, nargs='+', default=[4, 16, 32])
+    parser.add_argument('--mode', choices=['process', 'thread'],
+                        nargs='+', default=['process', 'thread'])
+    parser.add_argument('--hold', type=float, default=5.0,
+                        help='各スロットがリソースを保持する秒数')
+    parser.add_argument('--db', default=os.environ.get('PENGUIN_DB_URL'),
+                        help='指定した場合は各スロットがDBに接続する')
+    args = parser.parse_args()
+    for slots in args.slots:
+        for mode in args.mode:
+            bench(mode, slots, args.db, args.hold)
+
+
+if __name__ == '__main__':
+    main()
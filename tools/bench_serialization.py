@@ -0,0 +1,104 @@
+from argparse import ArgumentParser
+from base64 import b64encode
+from datetime import datetime, timedelta, timezone
+import enum
+import json
+import os
+import sys
+import timeit
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+from penguin_judge import utils  # noqa: E402
+from penguin_judge.models import (  # noqa: E402
+    JudgeResult, JudgeStatus, Submission, _Exportable)
+
+
+def legacy_to_dict(self, *, keys=None):
+    # 変更前のdir()による実装
+    if not keys:
+        keys = [k for k in dir(self) if not k.startswith('_')]
+    return {
+        k: getattr(self, k) for k in keys
+        if isinstance(getattr(self, k), self.VALID_TYPES)}
+
+
+def legacy_json_dumps(o):
+    class _JsonEncoder(json.JSONEncoder):
+        def default(self, o):
+            if isinstance(o, datetime):
+                return o.astimezone(tz=timezone.utc).isoformat()
+            if isinstance(o, timedelta):
+                return o.total_seconds()
+            if isinstance(o, bytes):
+                return b64encode(o).decode('ascii')
+            if isinstance(o, enum.Enum):
+                return o.name
+            return super().default(o)
+
+    if isinstance(o, dict):
+        o = {k: v for k, v in o.items() if not k.startswith('_')}
+    return json.dumps(o, cls=_JsonEncoder, separators=(',', ':'))
+
+
+def make_rows(n):
+    now = datetime.now(tz=timezone(timedelta(hours=9)))
+    submissions = [Submission(
+        id=i, contest_id='abc000', problem_id='A', user_id=i % 50,
+        code=b'x' * 256, code_bytes=256, environment_id=1,
+        status=JudgeStatus.Accepted, compile_time=timedelta(seconds=1),
+        max_time=timedelta(milliseconds=120), max_memory=2048, created=now,
+    ) for i in range(n)]
+    results = [JudgeResult(
+        contest_id='abc000', problem_id='A', submission_id=1,
+        test_id='{:03d}'.format(i), status=JudgeStatus.Accepted,
+        time=timedelta(milliseconds=10), memory=1024) for i in range(n)]
+    return submissions, results
+
+
+def list_submissions(submissions):
+    return [s.to_summary_dict() for s in submissions]
+
+
+def get_submission(submission, results):
+    ret = submission.to_dict()
+    ret['tests'] = [r.to_dict() for r in results]
+    return ret
+
+
+def bench(name, func, number):
+    t = timeit.timeit(func, number=number) / number
+    print('{:<40} {:>10.3f} ms'.format(name, t * 1000))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--number', type=int, default=50)
+    args = parser.parse_args()
+    submissions, results = make_rows(args.rows)
+    n = args.number
+
+    def _run(label, dumps):
+        bench(label + ' list_submissions',
+              lambda: dumps(list_submissions(submissions)), n)
+        bench(label + ' get_submission',
+              lambda: dumps(get_submission(submissions[0], results)), n)
+
+    assert (json.loads(legacy_json_dumps(get_submission(
+        submissions[0], results))) == json.loads(utils.json_dumps(
+            get_submission(submissions[0], results))))
+
+    with patch.object(_Exportable, 'to_dict', legacy_to_dict):
+        _run('dir()+json', legacy_json_dumps)
+    with patch.object(utils, 'orjson', None):
+        _run('compiled+json', utils.json_dumps)
+    if utils.orjson is not None:
+        _run('compiled+orjson', utils.json_dumps)
+    else:
+        print('orjson is not installed')
+
+
+if __name__ == '__main__':
+    main()